@@ -1,135 +1,848 @@
 # app.py
-import os, json
+import os, sys, csv, io, json, hashlib, itertools, operator, queue, re, tempfile, threading, time
+from bisect import bisect_left
+from collections import Counter, OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from gettext import translation
+from types import MappingProxyType
+import click
 import psycopg2
-from psycopg2.extras import RealDictCursor
-from datetime import datetime, timedelta
-from flask import Flask, render_template, request, redirect, url_for, session, flash
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2.pool import PoolError
+from datetime import date, datetime, timedelta
+from flask import (
+    Flask, Response, current_app, render_template, request, redirect, url_for,
+    session, flash, g, jsonify, stream_with_context, before_render_template, template_rendered
+)
+from flask.cli import with_appcontext
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+from werkzeug.datastructures import MultiDict
 from werkzeug.security import generate_password_hash, check_password_hash
 from markupsafe import Markup
-import smtplib
-from email.mime.text import MIMEText
-from apscheduler.schedulers.background import BackgroundScheduler
 
+# smtplib/email and apscheduler are imported where they are used, so that
+# web workers which never send mail or schedule jobs don't pay for them
+
+
+def default_config():
+    return dict(
+        DB_POOL_MIN_SIZE=int(os.environ.get("DB_POOL_MIN_SIZE", 1)),
+        DB_POOL_MAX_SIZE=int(os.environ.get("DB_POOL_MAX_SIZE", 5)),
+        # seconds an idle connection above the minimum is kept open
+        DB_POOL_IDLE_TIMEOUT=float(os.environ.get("DB_POOL_IDLE_TIMEOUT", 300)),
+        # seconds to wait for a free connection before giving up
+        DB_POOL_CHECKOUT_TIMEOUT=float(os.environ.get("DB_POOL_CHECKOUT_TIMEOUT", 10)),
+        # connections idle longer than this are pinged before being handed out
+        DB_POOL_PING_AFTER=float(os.environ.get("DB_POOL_PING_AFTER", 30)),
+        DASHBOARD_PAGE_SIZE=int(os.environ.get("DASHBOARD_PAGE_SIZE", 30)),
+        # reports on the patient detail page rendered with their form data;
+        # older ones load it when opened
+        DETAIL_RAW_FORM_ROWS=int(os.environ.get("DETAIL_RAW_FORM_ROWS", 5)),
+        # reports shown per page of a patient's own assessment history
+        PATIENT_HISTORY_PAGE_SIZE=int(os.environ.get("PATIENT_HISTORY_PAGE_SIZE", 10)),
+        # werkzeug method string, e.g. "scrypt:16384:8:1" or "pbkdf2:sha256:600000";
+        # stored hashes made with other settings are rehashed at login
+        PASSWORD_HASH_METHOD=os.environ.get("PASSWORD_HASH_METHOD", "scrypt"),
+        # threads hashing at once per process, and callers allowed to queue
+        PASSWORD_HASH_WORKERS=int(os.environ.get("PASSWORD_HASH_WORKERS", 2)),
+        PASSWORD_HASH_MAX_PENDING=int(os.environ.get("PASSWORD_HASH_MAX_PENDING", 8)),
+        # seconds a caller beyond that waits before getting a 503
+        PASSWORD_HASH_WAIT=float(os.environ.get("PASSWORD_HASH_WAIT", 5)),
+        # "" keeps the dashboard/stats cache in process; redis://... shares it
+        CACHE_URL=os.environ.get("CACHE_URL", ""),
+        # seconds a cached page is served; also how long other workers can
+        # lag behind a write when the cache is in process
+        CACHE_TTL=float(os.environ.get("CACHE_TTL", 30)),
+        CACHE_MAX_ENTRIES=int(os.environ.get("CACHE_MAX_ENTRIES", 512)),
+        # rows fetched per round trip by the research export
+        EXPORT_BATCH_SIZE=int(os.environ.get("EXPORT_BATCH_SIZE", 2000)),
+        # compiled templates are kept here so every worker after the first
+        # skips parsing them; "" turns that off
+        TEMPLATE_CACHE_DIR=os.environ.get(
+            "TEMPLATE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "my_health_app-templates")),
+        # {% cache %} blocks render once per process and locale
+        FRAGMENT_CACHE=os.environ.get("FRAGMENT_CACHE", "1") == "1",
+        DEFAULT_LOCALE=os.environ.get("DEFAULT_LOCALE", "th"),
+        # adds a Server-Timing header (db, template and total time) to every response
+        SERVER_TIMING=os.environ.get("SERVER_TIMING", "0") == "1",
+        # when set, /metrics wants "Authorization: Bearer <token>"
+        METRICS_TOKEN=os.environ.get("METRICS_TOKEN", ""),
+        # per-statement stats for /stats/sql; statements slower than SQL_SLOW_MS
+        # get an EXPLAIN (ANALYZE, BUFFERS) sample, at most one per statement
+        # every SQL_EXPLAIN_INTERVAL seconds
+        SQL_PROFILE=os.environ.get("SQL_PROFILE", "1") == "1",
+        SQL_SLOW_MS=float(os.environ.get("SQL_SLOW_MS", 200)),
+        SQL_EXPLAIN_INTERVAL=float(os.environ.get("SQL_EXPLAIN_INTERVAL", 300)),
+        SQL_EXPLAIN_TIMEOUT=os.environ.get("SQL_EXPLAIN_TIMEOUT", "30s"),
+        # slow statement samples kept in memory per process
+        SQL_SLOW_SAMPLES=int(os.environ.get("SQL_SLOW_SAMPLES", 50)),
+        SMTP_HOST=os.environ.get("SMTP_HOST", "smtp.gmail.com"),
+        SMTP_PORT=int(os.environ.get("SMTP_PORT", 465)),
+        SMTP_SSL=os.environ.get("SMTP_SSL", "1") == "1",
+        # authenticated SMTP sessions opened in parallel per outbox batch
+        SMTP_CONNECTIONS=int(os.environ.get("SMTP_CONNECTIONS", 2)),
+        OUTBOX_BATCH_SIZE=int(os.environ.get("OUTBOX_BATCH_SIZE", 50)),
+        OUTBOX_MAX_ATTEMPTS=int(os.environ.get("OUTBOX_MAX_ATTEMPTS", 5)),
+        # first retry delay in seconds, doubled on every further attempt
+        OUTBOX_RETRY_BASE=int(os.environ.get("OUTBOX_RETRY_BASE", 60)),
+        # "leader": web workers run the reminder job, one elected leader at a time
+        # "off": web workers never start scheduler threads (use `flask reminder-worker`)
+        SCHEDULER_MODE=os.environ.get("SCHEDULER_MODE", "leader"),
+        # seconds between leadership attempts on processes that are not the leader
+        SCHEDULER_LEADER_POLL=float(os.environ.get("SCHEDULER_LEADER_POLL", 60)),
+        # upper bound on the leader's sleep; new reports are due 14 days out, so
+        # anything shorter than that never misses a reminder
+        REMINDER_MAX_SLEEP=float(os.environ.get("REMINDER_MAX_SLEEP", 900)),
+        # how long a migration waits for a table lock before failing
+        MIGRATION_LOCK_TIMEOUT=os.environ.get("MIGRATION_LOCK_TIMEOUT", "10s"),
+    )
 
 
-app = Flask(__name__)
-app.secret_key = "very_secret_key_here"
+# routes and CLI commands are collected here and attached by create_app()
+_routes = []
+_commands = []
 
-##DB_PATH = os.environ.get("DATABASE_PATH", "database.db")
 
+def route(rule, **options):
+    def register(view):
+        _routes.append((rule, view, options))
+        return view
+    return register
 
-# ---------------- DB ---------------- #
-def get_db():
-    db_url = os.environ["DATABASE_URL"]
 
-    sslmode = "require" if "render.com" in db_url else "disable"
+def cli_command(name):
+    def register(fn):
+        command = click.command(name)(with_appcontext(fn))
+        _commands.append(command)
+        return command
+    return register
 
-    return psycopg2.connect(
-        db_url,
-        cursor_factory=RealDictCursor,
-        sslmode=sslmode
-    )
 
-## ---------- email reminder (2 weeks) ---------- #
+# ---------------- Translations ---------------- #
+TRANSLATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "translations")
+LOCALES = ("th", "en")
 
-def ensure_email_sent_column():
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("""
-        ALTER TABLE symptoms
-        ADD COLUMN IF NOT EXISTS email_sent BOOLEAN DEFAULT FALSE;
-    """)
-    conn.commit()
-    cur.close()
-    conn.close()
-    print("✅ email_sent column ensured")
 
+@lru_cache(maxsize=None)
+def get_translations(locale):
+    """Compiled catalog for a locale, read once per process."""
+    return translation("messages", TRANSLATIONS_DIR, [locale], fallback=True)
 
-def ensure_submitted_at_column():
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("""
-        ALTER TABLE symptoms
-        ADD COLUMN IF NOT EXISTS submitted_at TIMESTAMP;
-    """)
-    conn.commit()
-    cur.close()
-    conn.close()
-
-def send_reminder_email(to_email):
-    msg = MIMEText(
-        "ครบกำหนด 2 สัปดาห์หลังจากการบันทึกอาการภูมิแพ้ของคุณ\n\n"
-        "กรุณาเข้าสู่ระบบเพื่อประเมินอาการอีกครั้ง "
-        "หรือปรึกษาแพทย์หากอาการไม่ดีขึ้น\n\n"
-        "Allergy Monitoring System"
-    )
-    msg["Subject"] = "แจ้งเตือนติดตามอาการภูมิแพ้ (2 สัปดาห์)"
-    msg["From"] = os.environ["EMAIL"]
-    msg["To"] = to_email
-
-    with smtplib.SMTP_SSL("smtp.gmail.com", 465) as server:
-        server.login(
-            os.environ["EMAIL"],
-            os.environ["EMAIL_PASSWORD"]
-        )
-        server.send_message(msg)
 
-    print(f"📧 Email sent to {to_email}")
+def current_locale():
+    return g.get("locale") or current_app.config["DEFAULT_LOCALE"]
 
-def check_two_weeks_passed():
-    conn = get_db()
-    cur = conn.cursor()
 
-    cur.execute("""
-        SELECT s.id, p.email
-        FROM symptoms s
-        JOIN patient_profiles p ON s.user_id = p.user_id
-        WHERE s.submitted_at IS NOT NULL
-        AND s.submitted_at + INTERVAL '14 days' <= NOW()
-        AND s.email_sent = FALSE
-        AND p.email IS NOT NULL
-    """)
+def choose_locale(lang, remembered, accept_languages, default):
+    """?lang= first, then the choice remembered in the session, then the browser's."""
+    if lang in LOCALES:
+        return lang
+    if remembered in LOCALES:
+        return remembered
+    return accept_languages.best_match(LOCALES, default)
 
-    rows = cur.fetchall()
 
-    for row in rows:
-        send_reminder_email(row["email"])
+# reminder emails go out in the locale the patient last chose
+REMEMBER_LOCALE_SQL = """
+    UPDATE patient_profiles SET locale = %(locale)s
+    WHERE user_id = %(user_id)s AND locale IS DISTINCT FROM %(locale)s
+"""
 
-        cur.execute("""
-            UPDATE symptoms
-            SET email_sent = TRUE
-            WHERE id = %s
-        """, (row["id"],))
 
-    conn.commit()
-    cur.close()
-    conn.close()
+def select_locale():
+    lang = request.args.get("lang")
+    if lang in LOCALES:
+        session["locale"] = lang
+        if session.get("role") == "patient":
+            conn = get_db()
+            cur = conn.cursor()
+            cur.execute(REMEMBER_LOCALE_SQL, {"locale": lang, "user_id": session["user_id"]})
+            conn.commit()
+            cur.close()
+    g.locale = choose_locale(
+        lang, session.get("locale"), request.accept_languages, current_app.config["DEFAULT_LOCALE"]
+    )
+
+
+def translate(locale, message, **params):
+    """message in locale, %-formatted with params."""
+    text = get_translations(locale).gettext(message)
+    return text % params if params else text
+
+
+def _(message, **params):
+    return translate(current_locale(), message, **params)
+
+
+def N_(message):
+    """Marks a string for the catalogs; translated later, per locale."""
+    return message
+
+
+# ---------------- Metrics ---------------- #
+# name -> (type, help) of everything /metrics exports
+METRIC_HELP = {
+    "http_requests_total": ("counter", "Requests served, by endpoint, method and status."),
+    "http_request_duration_seconds": ("histogram", "Wall time per request."),
+    "db_connect_seconds_total": ("counter", "Time spent getting a connection in get_db()."),
+    "db_query_seconds_total": ("counter", "Time spent executing statements."),
+    "db_queries_total": ("counter", "Statements executed."),
+    "db_rows_total": ("counter", "Rows returned by statements."),
+    "template_render_seconds": ("histogram", "Time spent rendering a template."),
+    "reminder_job_duration_seconds": ("histogram", "Time one run of the reminder job took."),
+    "reminders_queued_total": ("counter", "Reminder emails put in the outbox."),
+    "emails_sent_total": ("counter", "Outbox emails sent."),
+    "emails_failed_total": ("counter", "Outbox email delivery attempts that failed."),
+    "db_pool_connections": ("gauge", "Pooled connections in this process, by state."),
+}
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metrics:
+    """Counters and histograms for this process, in the Prometheus text format.
+
+    Each thread records into its own shard, so recording takes no lock;
+    render() adds the shards up. Shards of finished threads are folded
+    into one when new threads register. Every sample carries a ``worker``
+    label (the pid): each gunicorn worker counts on its own, and without
+    the label a scrape landing on another worker would look like a
+    counter reset. Sum over worker in queries, e.g.
+    ``sum without (worker) (rate(http_requests_total[5m]))``.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []  # (thread, shard)
+        self._retired = ({}, {})
+        self.pid = os.getpid()
+
+    def _shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = ({}, {})  # counters, histograms
+            with self._lock:
+                live = []
+                for thread, old in self._shards:
+                    if thread.is_alive():
+                        live.append((thread, old))
+                    else:
+                        self._merge(self._retired, old)
+                live.append((threading.current_thread(), shard))
+                self._shards = live
+        return shard
+
+    def inc(self, name, value=1, **labels):
+        counters = self._shard()[0]
+        key = (name, tuple(sorted(labels.items())))
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        histograms = self._shard()[1]
+        key = (name, tuple(sorted(labels.items())))
+        slots = histograms.get(key)
+        if slots is None:
+            # one count per bucket plus +Inf, then the sum
+            slots = histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        slots[bisect_left(self.buckets, value)] += 1
+        slots[-1] += value
+
+    @staticmethod
+    def _merge(into, shard):
+        for key, value in dict(shard[0]).items():
+            into[0][key] = into[0].get(key, 0) + value
+        for key, slots in dict(shard[1]).items():
+            total = into[1].setdefault(key, [0] * len(slots))
+            for i, value in enumerate(list(slots)):
+                total[i] += value
+
+    def snapshot(self):
+        """(counters, histograms) summed over every thread."""
+        total = ({}, {})
+        with self._lock:
+            for shard in [self._retired] + [shard for _, shard in self._shards]:
+                self._merge(total, shard)
+        return total
+
+    def render(self, gauges=()):
+        counters, histograms = self.snapshot()
+        samples = {}
+        for (name, labels), value in counters.items():
+            samples.setdefault(name, []).append((name, labels, value))
+        for (name, labels), slots in histograms.items():
+            lines = samples.setdefault(name, [])
+            cumulative = 0
+            for le, count in zip(self.buckets + ("+Inf",), slots):
+                cumulative += count
+                lines.append((name + "_bucket", labels + (("le", str(le)),), cumulative))
+            lines.append((name + "_sum", labels, slots[-1]))
+            lines.append((name + "_count", labels, cumulative))
+        for name, labels, value in gauges:
+            samples.setdefault(name, []).append((name, labels, value))
+
+        worker = (("worker", os.getpid()),)
+        out = []
+        for name in sorted(samples):
+            kind, text = METRIC_HELP.get(name, ("untyped", name))
+            out.append(f"# HELP {name} {text}")
+            out.append(f"# TYPE {name} {kind}")
+            for sample, labels, value in samples[name]:
+                labels = ",".join(f'{k}="{metric_label(v)}"' for k, v in worker + labels)
+                out.append(f"{sample}{{{labels}}} {value}")
+        return "\n".join(out) + "\n"
+
+
+def metric_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+metrics = Metrics()
+
+
+class RequestTimings:
+    """What the current request spent where; see start_request_timings()."""
+    __slots__ = ("endpoint", "started", "db_connect", "db_query", "queries", "rows",
+                 "template", "template_started")
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.started = time.perf_counter()
+        self.db_connect = self.db_query = self.template = 0.0
+        self.queries = self.rows = 0
+        self.template_started = None
+
+
+# the running request's RequestTimings, if any; cursors and get_db() add to it
+_timings = threading.local()
+
+
+def current_timings():
+    return getattr(_timings, "current", None)
+
+
+def start_request_timings():
+    _timings.current = RequestTimings(request.endpoint or "unmatched")
+
+
+def record_request_metrics(response):
+    timings = current_timings()
+    if timings is None:
+        return response
+    _timings.current = None
+
+    total = time.perf_counter() - timings.started
+    endpoint = timings.endpoint
+    metrics.inc("http_requests_total", endpoint=endpoint, method=request.method, status=response.status_code)
+    metrics.observe("http_request_duration_seconds", total, endpoint=endpoint)
+    if timings.queries or timings.db_connect:
+        metrics.inc("db_connect_seconds_total", timings.db_connect, endpoint=endpoint)
+        metrics.inc("db_query_seconds_total", timings.db_query, endpoint=endpoint)
+        metrics.inc("db_queries_total", timings.queries, endpoint=endpoint)
+        metrics.inc("db_rows_total", timings.rows, endpoint=endpoint)
+
+    if current_app.config["SERVER_TIMING"]:
+        response.headers.add("Server-Timing", ", ".join((
+            f"db-connect;dur={timings.db_connect * 1000:.1f}",
+            f'db;dur={timings.db_query * 1000:.1f};desc="{timings.queries} queries, {timings.rows} rows"',
+            f"tpl;dur={timings.template * 1000:.1f}",
+            f"total;dur={total * 1000:.1f}",
+        )))
+    return response
+
+
+def template_started(app, template, context, **extra):
+    timings = current_timings()
+    if timings is not None:
+        timings.template_started = time.perf_counter()
+
+
+def template_finished(app, template, context, **extra):
+    timings = current_timings()
+    if timings is not None and timings.template_started is not None:
+        elapsed = time.perf_counter() - timings.template_started
+        timings.template += elapsed
+        timings.template_started = None
+        metrics.observe("template_render_seconds", elapsed, template=template.name)
+
+
+# ---------------- SQL profiling ---------------- #
+_SQL_NOISE = (
+    (re.compile(r"--[^\n]*|/\*.*?\*/", re.S), " "),
+    (re.compile(r"'(?:[^']|'')*'"), "?"),              # string literals
+    (re.compile(r"%\(\w+\)s|%s|\$\d+"), "?"),           # parameters
+    (re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?\b"), "?"),  # numbers, not the 1 in vas_score1
+    (re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)"), "(?+)"),  # IN lists, VALUES rows
+    (re.compile(r"\(\?\+\)(?:\s*,\s*\(\?\+\))+"), "(?+), ..."),
+    (re.compile(r"\s+"), " "),
+)
+
+
+@lru_cache(maxsize=2048)
+def sql_fingerprint(query):
+    """(id, normalized text) of a statement: literals and parameters become
+    ?, so every run of the same statement shares one fingerprint."""
+    if isinstance(query, bytes):
+        query = query.decode("utf-8", "replace")
+    text = str(query)
+    for pattern, replacement in _SQL_NOISE:
+        text = pattern.sub(replacement, text)
+    text = text.strip()
+    return hashlib.md5(text.encode()).hexdigest()[:12], text
+
+
+class SqlProfile:
+    """Per-fingerprint statement stats for this process, and EXPLAIN plans
+    of slow statements.
+
+    A statement slower than ``slow_after`` seconds is handed (at most once
+    per fingerprint every ``explain_every`` seconds) to a background thread
+    that re-runs it under EXPLAIN (ANALYZE, BUFFERS) in a read-only
+    transaction on its own connection, keeps the plan in a ring buffer and
+    writes it to slow_query_log. The request that ran the statement does
+    not wait for any of that.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.slow_after = 0.2
+        self.explain_every = 300.0
+        self.explain_timeout = "30s"
+        self.samples = deque(maxlen=50)
+        self._lock = threading.Lock()
+        self._stats = {}  # fingerprint -> {"query", "calls", "seconds", "max", "rows", "endpoints"}
+        self._explained = {}  # fingerprint -> monotonic time of the last sample
+        self._connect = None  # (dsn, connect kwargs) of the database being profiled
+        self._queue = None
+        self._pid = None
+
+    def configure(self, config):
+        self.enabled = config["SQL_PROFILE"]
+        self.slow_after = config["SQL_SLOW_MS"] / 1000
+        self.explain_every = config["SQL_EXPLAIN_INTERVAL"]
+        self.explain_timeout = config["SQL_EXPLAIN_TIMEOUT"]
+        if self.samples.maxlen != config["SQL_SLOW_SAMPLES"]:
+            self.samples = deque(self.samples, maxlen=config["SQL_SLOW_SAMPLES"])
+
+    def connect_to(self, dsn, connect_kwargs):
+        kwargs = dict(connect_kwargs)
+        kwargs.pop("cursor_factory", None)  # plain cursors: the explainer is not profiled
+        self._connect = (dsn, kwargs)
+
+    def record(self, cursor, query, params, seconds, rows, endpoint):
+        fingerprint, text = sql_fingerprint(query)
+        explain = False
+        with self._lock:
+            stat = self._stats.get(fingerprint)
+            if stat is None:
+                stat = self._stats[fingerprint] = {
+                    "query": text, "calls": 0, "seconds": 0.0, "max": 0.0, "rows": 0, "endpoints": Counter(),
+                }
+            stat["calls"] += 1
+            stat["seconds"] += seconds
+            stat["rows"] += rows
+            stat["endpoints"][endpoint] += 1
+            if seconds > stat["max"]:
+                stat["max"] = seconds
+            if seconds >= self.slow_after and self._connect is not None:
+                now = time.monotonic()
+                last = self._explained.get(fingerprint)
+                if last is None or now - last >= self.explain_every:
+                    self._explained[fingerprint] = now
+                    explain = True
+        if explain:
+            self._submit({
+                "fingerprint": fingerprint, "query": text, "endpoint": endpoint,
+                "ms": round(seconds * 1000, 2), "rows": rows,
+                "captured_at": datetime.now().isoformat(timespec="seconds"),
+                "sql": cursor.mogrify(query, params),
+            })
+
+    def _submit(self, sample):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._queue = queue.Queue(maxsize=100)
+                    threading.Thread(target=self._explain_loop, args=(self._queue,),
+                                     name="sql-explain", daemon=True).start()
+                    self._pid = os.getpid()
+        try:
+            self._queue.put_nowait(sample)
+        except queue.Full:  # the explainer is behind; this sample is dropped
+            pass
+
+    def _explain_loop(self, samples):
+        conn = None
+        while True:
+            sample = samples.get()
+            # the statement with its parameter values never outlives this loop
+            sql = sample.pop("sql")
+            try:
+                if conn is None or conn.closed:
+                    dsn, kwargs = self._connect
+                    conn = psycopg2.connect(dsn, **kwargs)
+                sample["plan"] = self._explain(conn, sql)
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        INSERT INTO slow_query_log (fingerprint, query, endpoint, duration_ms, rows, plan)
+                        VALUES (%s, %s, %s, %s, %s, %s)
+                    """, (sample["fingerprint"], sample["query"], sample["endpoint"],
+                          sample["ms"], sample["rows"], sample["plan"]))
+                    cur.execute("DELETE FROM slow_query_log WHERE captured_at < NOW() - INTERVAL '30 days'")
+                conn.commit()
+            except psycopg2.Error as e:
+                print(f"⚠️ slow query sample not saved: {e}".strip())
+                if conn is not None and not conn.closed:
+                    conn.rollback()
+            self.samples.append(sample)
+
+    def _explain(self, conn, sql):
+        if isinstance(sql, bytes):
+            sql = sql.decode("utf-8", "replace")
+        if not sql.lstrip().lower().startswith(("select", "with")):
+            return None
+        try:
+            with conn.cursor() as cur:
+                # data-modifying statements fail here instead of running twice
+                cur.execute("SET TRANSACTION READ ONLY")
+                cur.execute("SET LOCAL statement_timeout = %s", (self.explain_timeout,))
+                cur.execute("EXPLAIN (ANALYZE, BUFFERS) " + sql)
+                return "\n".join(row[0] for row in cur.fetchall())
+        except psycopg2.Error as e:
+            return f"(no plan: {str(e).strip()})"
+        finally:
+            conn.rollback()
+
+    def top(self, limit=20, order="seconds"):
+        """The `limit` fingerprints with the highest total (or mean, or max) time."""
+        with self._lock:
+            rows = [dict(stat, fingerprint=fp, endpoints=dict(stat["endpoints"]))
+                    for fp, stat in self._stats.items()]
+        for row in rows:
+            row["mean"] = row["seconds"] / row["calls"]
+        rows.sort(key=operator.itemgetter(order), reverse=True)
+        return rows[:limit]
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self._explained.clear()
+            self.samples.clear()
+
+
+sql_profile = SqlProfile()
+
+
+@cli_command("sql-top")
+@click.option("--limit", default=10, show_default=True, help="statements to show")
+@click.option("--hours", default=24.0, show_default=True, help="look this far back")
+@click.option("--plans/--no-plans", default=False, help="print the latest plan of each statement")
+def sql_top_command(limit, hours, plans):
+    """Slowest statements sampled into slow_query_log, by every process."""
+    cur = get_db().cursor()
+    cur.execute("""
+        SELECT fingerprint,
+               COUNT(*) AS samples,
+               MAX(duration_ms) AS max_ms,
+               AVG(duration_ms) AS mean_ms,
+               MAX(captured_at) AS last_seen,
+               (ARRAY_AGG(query ORDER BY captured_at DESC))[1] AS query,
+               (ARRAY_AGG(endpoint ORDER BY captured_at DESC))[1] AS endpoint,
+               (ARRAY_AGG(plan ORDER BY captured_at DESC))[1] AS plan
+        FROM slow_query_log
+        WHERE captured_at >= NOW() - make_interval(secs => %s)
+        GROUP BY fingerprint
+        ORDER BY MAX(duration_ms) DESC
+        LIMIT %s
+    """, (hours * 3600, limit))
+    rows = cur.fetchall()
+    if not rows:
+        print(f"no slow statements sampled in the last {hours:g}h")
+        return
 
+    for r in rows:
+        print(f"{r['fingerprint']}  max {r['max_ms']:9.1f} ms  mean {r['mean_ms']:9.1f} ms  "
+              f"{r['samples']:4} samples  last {r['last_seen']:%Y-%m-%d %H:%M}  {r['endpoint']}")
+        print(f"    {r['query'][:300]}")
+        if plans and r["plan"]:
+            print("\n".join("      " + line for line in r["plan"].splitlines()))
+        print()
 
 
+##DB_PATH = os.environ.get("DATABASE_PATH", "database.db")
 
 
+# ---------------- DB ---------------- #
+class PoolTimeout(PoolError):
+    pass
+
+
+class InstrumentedCursor(RealDictCursor):
+    """RealDictCursor that adds statement time, statements and returned rows
+    to the running request's timings, and reports each statement to
+    sql_profile when profiling is on."""
+
+    def _timed(self, run, query, params, *args):
+        """run(query, *args), timed; params are what EXPLAIN re-runs it with."""
+        timings = current_timings()
+        if timings is None and not sql_profile.enabled:
+            return run(query, *args)
+        started = time.perf_counter()
+        result = run(query, *args)
+        elapsed = time.perf_counter() - started
+
+        # client-side cursors hold the whole result after execute
+        rows = max(self.rowcount, 0) if self.name is None and self.description is not None else 0
+        if timings is not None:
+            timings.db_query += elapsed
+            timings.queries += 1
+            timings.rows += rows
+        if sql_profile.enabled:
+            endpoint = timings.endpoint if timings is not None else "background"
+            sql_profile.record(self, query, params, elapsed, rows, endpoint)
+        return result
+
+    def execute(self, query, vars=None):
+        return self._timed(super().execute, query, vars, vars)
+
+    def executemany(self, query, vars_list):
+        return self._timed(super().executemany, query, None, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        return self._timed(super().copy_expert, sql, None, file, size)
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(size)
+        timings = current_timings()
+        if self.name is not None and timings is not None:  # server-side cursor
+            timings.rows += len(rows)
+        return rows
+
+
+class ConnectionPool:
+    """Thread-safe psycopg2 connection pool.
+
+    Connections above ``min_size`` are closed once they sit idle for
+    ``idle_timeout`` seconds. A connection that was idle longer than
+    ``ping_after`` seconds is checked with ``SELECT 1`` before it is handed
+    out, so a connection dropped by the server is replaced transparently.
+    """
+
+    def __init__(self, dsn, min_size=1, max_size=5, idle_timeout=300.0,
+                 checkout_timeout=10.0, ping_after=30.0, **connect_kwargs):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        self.ping_after = ping_after
+        self.connect_kwargs = connect_kwargs
+        self.pid = os.getpid()
+
+        self._cond = threading.Condition()
+        self._idle = deque()  # (conn, returned_at), most recently used on the right
+        self._size = 0
+        self._counters = {
+            "connects": 0,
+            "closes": 0,
+            "checkouts": 0,
+            "waits": 0,
+            "timeouts": 0,
+            "health_check_failures": 0,
+        }
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn, **self.connect_kwargs)
+        with self._cond:
+            self._counters["connects"] += 1
+        return conn
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self._cond:
+            self._counters["closes"] += 1
+
+    def _healthy(self, conn, returned_at):
+        if conn.closed:
+            return False
+        if time.monotonic() - returned_at < self.ping_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _reap_idle(self):
+        # caller holds self._cond; oldest idle connections are on the left
+        expired = []
+        now = time.monotonic()
+        while (self._idle and self._size > self.min_size
+               and now - self._idle[0][1] > self.idle_timeout):
+            expired.append(self._idle.popleft()[0])
+            self._size -= 1
+        return expired
+
+    def getconn(self):
+        deadline = time.monotonic() + self.checkout_timeout
+        conn = returned_at = None
+
+        with self._cond:
+            waited = False
+            while True:
+                if self._idle:
+                    conn, returned_at = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._counters["timeouts"] += 1
+                    raise PoolTimeout(
+                        f"no database connection available after {self.checkout_timeout}s"
+                    )
+                if not waited:
+                    self._counters["waits"] += 1
+                    waited = True
+                self._cond.wait(remaining)
+            self._counters["checkouts"] += 1
+
+        if conn is not None:
+            if self._healthy(conn, returned_at):
+                return conn
+            with self._cond:
+                self._counters["health_check_failures"] += 1
+            self._close(conn)
+
+        # the slot is already reserved in self._size, fill it with a new connection
+        try:
+            return self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    def putconn(self, conn):
+        if not conn.closed and conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            # never hand a connection with an open transaction to the next borrower
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                conn.close()
+
+        with self._cond:
+            if conn.closed:
+                self._size -= 1
+                self._counters["closes"] += 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            expired = self._reap_idle()
+            self._cond.notify()
+
+        for c in expired:
+            self._close(c)
+
+    def closeall(self):
+        with self._cond:
+            idle = [c for c, _ in self._idle]
+            self._idle.clear()
+            self._size -= len(idle)
+        for c in idle:
+            self._close(c)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                **self._counters,
+            }
+
+
+_pool_lock = threading.Lock()
+
+
+def db_sslmode(db_url):
+    return "require" if "render.com" in db_url else "disable"
+
+
+def get_pool():
+    # a pool inherited through fork() shares sockets with the parent, so each
+    # worker process builds its own (the inherited one is simply dropped)
+    pool = current_app.extensions.get("db_pool")
+    if pool is None or pool.pid != os.getpid():
+        with _pool_lock:
+            pool = current_app.extensions.get("db_pool")
+            if pool is None or pool.pid != os.getpid():
+                config = current_app.config
+                db_url = os.environ["DATABASE_URL"]
+                pool = ConnectionPool(
+                    db_url,
+                    min_size=config["DB_POOL_MIN_SIZE"],
+                    max_size=config["DB_POOL_MAX_SIZE"],
+                    idle_timeout=config["DB_POOL_IDLE_TIMEOUT"],
+                    checkout_timeout=config["DB_POOL_CHECKOUT_TIMEOUT"],
+                    ping_after=config["DB_POOL_PING_AFTER"],
+                    cursor_factory=InstrumentedCursor,
+                    sslmode=db_sslmode(db_url)
+                )
+                current_app.extensions["db_pool"] = pool
+                sql_profile.connect_to(db_url, pool.connect_kwargs)
+    return pool
 
 
+def get_db():
+    # one pooled connection per app/request context, returned on teardown
+    if "db" not in g:
+        timings = current_timings()
+        started = time.perf_counter()
+        g.db = get_pool().getconn()
+        if timings is not None:
+            timings.db_connect += time.perf_counter() - started
+    return g.db
 
-# ---- run once on app start ----
-ensure_email_sent_column()
-ensure_submitted_at_column()
 
-scheduler = BackgroundScheduler()
-scheduler.add_job(check_two_weeks_passed, "interval", minutes=1)
-scheduler.start()
-print("🟢 Reminder scheduler started")
+def release_db(exc):
+    conn = g.pop("db", None)
+    if conn is not None:
+        get_pool().putconn(conn)
 
 
+# ---------------- Schema migrations ---------------- #
+# Ordered, idempotent schema changes, applied by `flask migrate`. Each one
+# runs in its own transaction and is recorded in schema_version; the app
+# itself only checks the recorded version.
+MIGRATIONS = []
+MIGRATION_LOCK_KEY = 727_002  # pg advisory lock id held while migrating
 
 
+def migration(version, name):
+    def register(fn):
+        assert not MIGRATIONS or version > MIGRATIONS[-1][0], "migrations must be ordered"
+        MIGRATIONS.append((version, name, fn))
+        return fn
+    return register
 
 
-def init_db():
-    conn = get_db()
-    cur = conn.cursor()
+def latest_schema_version():
+    return MIGRATIONS[-1][0]
 
+
+@migration(1, "users, patient_profiles, symptoms, patient_history")
+def create_tables(cur):
     # USERS
     cur.execute("""
     CREATE TABLE IF NOT EXISTS users (
@@ -255,662 +968,2710 @@ def init_db():
     )
     """)
 
-    conn.commit()
-    conn.close()
 
-init_db()
-# ---------------- Helpers ---------------- #
-def classify_pattern(days_per_week: int) -> str:
-    return "persistent" if days_per_week >= 4 else "intermittent"
+@migration(2, "symptoms.email_sent, symptoms.submitted_at")
+def add_email_sent_and_submitted_at(cur):
+    cur.execute("""
+        ALTER TABLE symptoms
+        ADD COLUMN IF NOT EXISTS email_sent BOOLEAN DEFAULT FALSE;
+    """)
+    cur.execute("""
+        ALTER TABLE symptoms
+        ADD COLUMN IF NOT EXISTS submitted_at TIMESTAMP;
+    """)
 
-def calculate_follow_up(prev_follow_up, avg_vas, pattern, used_steroid_before):
-    # reset condition
-    if avg_vas < 5 and pattern == "intermittent":
-        return 0
 
-    # first time worsening
-    if avg_vas >= 5 and prev_follow_up == 0:
-        return 1
+@migration(3, "dashboard search indexes, patient_profiles.record_count")
+def add_dashboard_search(cur):
+    # per-patient report counter, kept up to date by patient_form
+    cur.execute("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'patient_profiles' AND column_name = 'record_count'
+    """)
+    if cur.fetchone() is None:
+        cur.execute("""
+            ALTER TABLE patient_profiles
+            ADD COLUMN record_count INTEGER NOT NULL DEFAULT 0
+        """)
+        cur.execute("""
+            UPDATE patient_profiles p
+            SET record_count = c.n
+            FROM (SELECT user_id, COUNT(*) AS n FROM symptoms GROUP BY user_id) c
+            WHERE p.user_id = c.user_id
+        """)
 
-    # follow_up = 1 logic
-    if prev_follow_up == 1:
-        if used_steroid_before == "yes":
-            return 2
-        return 1
+    # keyset pagination on (full_name, id)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS users_patient_name_idx
+        ON users ((COALESCE(full_name, '')), id)
+        WHERE role = 'patient'
+    """)
 
-    # follow_up = 2 stays 2
-    if prev_follow_up >= 2:
-        return 2
+    # phone / hospital number are searched by prefix
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS patient_profiles_phone_idx
+        ON patient_profiles (phone text_pattern_ops)
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS patient_profiles_hospital_number_idx
+        ON patient_profiles (hospital_number text_pattern_ops)
+    """)
 
-    return prev_follow_up
+    # name / email are searched by substring, which needs trigram indexes
+    cur.execute("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")
+    if cur.fetchone() is None:
+        print("⚠️ pg_trgm not available, name/email search will not be indexed")
+    else:
+        cur.execute("SAVEPOINT trgm")
+        try:
+            cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS users_full_name_trgm_idx
+                ON users USING gin (full_name gin_trgm_ops)
+            """)
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS patient_profiles_email_trgm_idx
+                ON patient_profiles USING gin (email gin_trgm_ops)
+            """)
+            cur.execute("RELEASE SAVEPOINT trgm")
+        except psycopg2.Error as e:
+            cur.execute("ROLLBACK TO SAVEPOINT trgm")
+            print(f"⚠️ could not create trigram indexes: {e}")
+
+
+@migration(4, "symptoms.treatment_codes")
+def add_treatment_codes(cur):
+    cur.execute("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'symptoms' AND column_name = 'treatment_codes'
+    """)
+    if cur.fetchone() is None:
+        cur.execute("ALTER TABLE symptoms ADD COLUMN treatment_codes SMALLINT")
+
+        terms = []
+        params = []
+        for code, keywords in LEGACY_TREATMENT_KEYWORDS:
+            hit = " OR ".join(["strpos(rec, %s) > 0"] * len(keywords))
+            terms.append(f"CASE WHEN {hit} THEN %s ELSE 0 END")
+            params += [*keywords, code]
+
+        cur.execute(f"""
+            UPDATE symptoms s
+            SET treatment_codes = c.codes
+            FROM (
+                SELECT id, ({" + ".join(terms)}) AS codes
+                FROM (
+                    SELECT id, LOWER(COALESCE(recommendation, '')) AS rec
+                    FROM symptoms
+                ) r
+            ) c
+            WHERE s.id = c.id
+        """, params)
+        print(f"✅ treatment_codes backfilled for {cur.rowcount} rows")
 
-# ---------------- Medicine Algorithm ---------------- #
-def generate_recommendation(pattern, avg_vas, follow_up, used_steroid_answer):
-    saline = (
-        "ล้างจมูกด้วยน้ำเกลือ (Normal saline irrigation)\n"
-        "– วันละ 1–2 ครั้ง\n\n"
-    )
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS symptoms_treatment_codes_idx
+        ON symptoms (treatment_codes)
+    """)
 
-    oral_ah = (
-        "ยาต้านฮิสตามีนชนิดรับประทาน รุ่นที่ 2\n"
-        "– วันละ 1 ครั้ง\n\n"
-    )
 
-    leuko = (
-        "Leukotriene receptor antagonist (LTRA)\n"
-        "– วันละ 1 ครั้ง\n\n"
-    )
+@migration(5, "stats_summary")
+def add_stats_summary(cur):
+    cur.execute("SELECT to_regclass('stats_summary') AS t")
+    if cur.fetchone()["t"] is None:
+        cur.execute("""
+            CREATE TABLE stats_summary (
+                metric TEXT NOT NULL,
+                bucket TEXT NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (metric, bucket)
+            )
+        """)
+        rebuild_stats_summary(cur)
 
-    incs_standard = (
-        "ยาสเตียรอยด์พ่นจมูก\n"
-        "– 2 sprays/nostril วันละครั้ง\n"
-    )
 
-    incs_high = (
-        "ยาสเตียรอยด์พ่นจมูก (เพิ่มขนาดยา)\n"
-        "– 2 sprays/nostril วันละ 2 ครั้ง\n"
-    )
+@migration(6, "email_outbox")
+def add_email_outbox(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS email_outbox (
+            id SERIAL PRIMARY KEY,
+            symptom_id INTEGER UNIQUE REFERENCES symptoms(id) ON DELETE CASCADE,
+            to_email TEXT NOT NULL,
+            subject TEXT NOT NULL,
+            body TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            last_error TEXT,
+            created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            sent_at TIMESTAMP
+        )
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS email_outbox_pending_idx
+        ON email_outbox (next_attempt_at)
+        WHERE status = 'pending'
+    """)
 
-    # ================= STATE 0 =================
-    if follow_up == 0:
-        if pattern == "intermittent" and avg_vas < 5:
-            return saline + "เลือกอย่างใดอย่างหนึ่ง\n\n" + oral_ah + "หรือ\n\n" + leuko
 
-        if (pattern == "intermittent" and avg_vas >= 5) or \
-           (pattern == "persistent" and avg_vas < 5):
-            return saline + "เลือกอย่างใดอย่างหนึ่ง\n\n" + oral_ah + "หรือ\n\n" + incs_standard
+@migration(7, "symptoms.reminder_due_at")
+def add_reminder_due_at(cur):
+    cur.execute("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'symptoms' AND column_name = 'reminder_due_at'
+    """)
+    if cur.fetchone() is None:
+        cur.execute("ALTER TABLE symptoms ADD COLUMN reminder_due_at TIMESTAMP")
+        # patients without an email get no reminder, so no due date
+        cur.execute("""
+            UPDATE symptoms s
+            SET reminder_due_at = s.submitted_at + INTERVAL '14 days'
+            FROM patient_profiles p
+            WHERE s.submitted_at IS NOT NULL
+            AND p.user_id = s.user_id AND p.email IS NOT NULL
+        """)
+
+    # only unsent rows are ever looked up by due date
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS symptoms_reminder_due_idx
+        ON symptoms (reminder_due_at)
+        WHERE email_sent = FALSE
+    """)
 
-        if pattern == "persistent" and avg_vas >= 5:
-            return saline + incs_standard
 
-    # ================= STATE 1 =================
-    if follow_up == 1:
-        if avg_vas < 5:
-            return "อาการดีขึ้น → ลดระดับยา และใช้ยาต่ออีก 2 สัปดาห์"
+@migration(8, "symptoms (user_id, created_at) index")
+def add_symptoms_user_created_idx(cur):
+    # serves every per-patient history read in created_at order
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS symptoms_user_created_idx
+        ON symptoms (user_id, created_at DESC)
+    """)
 
-        if used_steroid_answer == "no":
-            return saline + incs_standard
 
-        return (
-            "ส่งพบแพทย์เฉพาะทาง\n"
-            "ประเมินการวินิจฉัยและการใช้ยา\n\n"
-            + incs_high
+@migration(9, "import_runs")
+def add_import_runs(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS import_runs (
+            id SERIAL PRIMARY KEY,
+            source TEXT NOT NULL,
+            fingerprint TEXT NOT NULL UNIQUE,
+            records_done INTEGER NOT NULL DEFAULT 0,
+            imported INTEGER NOT NULL DEFAULT 0,
+            rejected INTEGER NOT NULL DEFAULT 0,
+            started_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            finished_at TIMESTAMP
         )
+    """)
 
-    # ================= STATE 2 =================
-    if follow_up == 2:
-        if avg_vas < 5:
-            return "อาการดีขึ้น → ลดระดับยา และใช้ยาต่ออีก 2 สัปดาห์"
 
-        return (
-            "ส่งพบแพทย์เฉพาะทาง\n"
-            "ประเมินการวินิจฉัยและการใช้ยา\n\n"
-            + incs_high
+@migration(10, "rescore_runs")
+def add_rescore_runs(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS rescore_runs (
+            id SERIAL PRIMARY KEY,
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            rows_seen INTEGER NOT NULL DEFAULT 0,
+            rows_changed INTEGER NOT NULL DEFAULT 0,
+            started_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            finished_at TIMESTAMP
         )
+    """)
 
-    # ================= STATE 3 =================
-    if follow_up == 3:
-        if avg_vas < 5:
-            return "อาการดีขึ้น → ลดระดับยา และใช้ยาต่ออีก 2 สัปดาห์"
-        return (
-        "ภูมิคุ้มกันบัมบัดด้วยสารก่อภูมิแพ้\n"
-        "ควรได้รับการผ่าตัด"
+
+@migration(11, "patient_profiles.locale")
+def add_patient_locale(cur):
+    cur.execute("ALTER TABLE patient_profiles ADD COLUMN IF NOT EXISTS locale TEXT")
+
+
+@migration(12, "slow_query_log")
+def add_slow_query_log(cur):
+    # EXPLAIN samples of slow statements, written by SqlProfile
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS slow_query_log (
+            id BIGSERIAL PRIMARY KEY,
+            captured_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            fingerprint TEXT NOT NULL,
+            query TEXT NOT NULL,
+            endpoint TEXT,
+            duration_ms REAL NOT NULL,
+            rows INTEGER,
+            plan TEXT
         )
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS slow_query_log_captured_idx
+        ON slow_query_log (captured_at)
+    """)
 
-# ---------------- Routes ---------------- #
 
-@app.route("/", methods=["GET"])
-def index():
-    return redirect(url_for("welcome"))
+@migration(13, "symptoms form columns, compact raw_form")
+def add_form_columns(cur):
+    cur.execute("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'symptoms' AND column_name = 'vas_score1'
+    """)
+    if cur.fetchone() is None:
+        sql_types = {float: "REAL", int: "SMALLINT", bool: "BOOLEAN"}
+        cur.execute("ALTER TABLE symptoms " + ", ".join(
+            f"ADD COLUMN {column} {sql_types[kind]}" for _, column, kind in FORM_COLUMNS
+        ))
+
+        # same rules as form_answer(): malformed answers become NULL here
+        # and stay in raw_form below, so nothing the patient wrote is lost
+        terms = []
+        params = []
+        for field, column, kind in FORM_COLUMNS:
+            if kind is bool:
+                terms.append(f"{column} = CASE raw_form ->> %s WHEN 'yes' THEN TRUE WHEN 'no' THEN FALSE END")
+                params.append(field)
+            else:
+                pattern = (_FLOAT_ANSWER if kind is float else _INT_ANSWER).pattern
+                terms.append(f"{column} = CASE WHEN raw_form ->> %s ~ %s "
+                             f"THEN (raw_form ->> %s)::{sql_types[kind]} END")
+                params += [field, pattern, field]
+        cur.execute(f"""
+            UPDATE symptoms SET {", ".join(terms)}
+            WHERE jsonb_typeof(raw_form) = 'object'
+        """, params)
+        print(f"✅ form columns backfilled for {cur.rowcount} rows")
+
+        moved = ", ".join(f"CASE WHEN {column} IS NOT NULL THEN %s END" for _, column, _ in FORM_COLUMNS)
+        cur.execute(f"""
+            UPDATE symptoms
+            SET raw_form = (
+                SELECT COALESCE(jsonb_object_agg(COALESCE(k.short, e.key), e.value), '{{}}'::jsonb)
+                FROM jsonb_each(raw_form) e
+                LEFT JOIN unnest(%s::text[], %s::text[]) AS k(name, short) ON k.name = e.key
+                WHERE e.key <> ALL(%s::text[] || array_remove(ARRAY[{moved}]::text[], NULL))
+                  AND e.value NOT IN ('null', '""')
+            )
+            WHERE jsonb_typeof(raw_form) = 'object'
+        """, [
+            list(RAW_FORM_KEYS), list(RAW_FORM_KEYS.values()), list(RAW_FORM_DROPPED),
+            *(field for field, _, _ in FORM_COLUMNS),
+        ])
+        print(f"✅ raw_form compacted for {cur.rowcount} rows")
+
+    # ad-hoc cohort queries: raw_form @> '{"pt": "2"}'
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS symptoms_raw_form_idx
+        ON symptoms USING gin (raw_form jsonb_path_ops)
+    """)
 
-@app.route("/welcome")
-def welcome():
-    return render_template("welcome.html")
 
-# ---------- Login ---------- #
-@app.route("/login", methods=["GET", "POST"])
-def login():
-    if request.method == "POST":
-        conn = get_db()
-        cur = conn.cursor()
+def run_migrations(conn):
+    """Apply pending migrations in order. Returns [(version, name)] applied."""
+    cur = conn.cursor()
+    applied = []
+    for version, name, fn in MIGRATIONS:
+        # serialises concurrent migrators; released with each transaction
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_KEY,))
+        cur.execute("SET LOCAL lock_timeout = %s", (current_app.config["MIGRATION_LOCK_TIMEOUT"],))
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMP NOT NULL DEFAULT NOW()
+            )
+        """)
+        cur.execute("SELECT 1 FROM schema_version WHERE version = %s", (version,))
+        if cur.fetchone() is not None:
+            conn.commit()
+            continue
 
+        fn(cur)
         cur.execute(
-            "SELECT * FROM users WHERE username = %s",
-            (request.form["username"],)
+            "INSERT INTO schema_version (version, name) VALUES (%s, %s)",
+            (version, name)
         )
-        user = cur.fetchone()
-        conn.close()
-
-        if user and check_password_hash(user["password"], request.form["password"]):
-            session["user_id"] = user["id"]
-            session["role"] = user["role"]
-            return redirect(
-                url_for("doctor_dashboard" if user["role"] == "doctor" else "patient_form")
-            )
+        conn.commit()
+        applied.append((version, name))
+    cur.close()
+    return applied
 
-        flash("Invalid login", "danger")
 
-    return render_template("login.html")
+def current_schema_version(conn):
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT MAX(version) AS v FROM schema_version")
+        version = cur.fetchone()["v"] or 0
+    except psycopg2.ProgrammingError:  # no schema_version table yet
+        version = 0
+    conn.rollback()
+    cur.close()
+    return version
+
+
+@cli_command("migrate")
+def migrate_command():
+    """Apply pending schema migrations."""
+    for version, name in run_migrations(get_db()):
+        print(f"✅ migration {version}: {name}")
+    print(f"🟢 schema at version {latest_schema_version()}")
+
+
+def check_schema_version():
+    # one cheap query per process; a newer schema is fine (rolling deploys)
+    if current_app.extensions.get("schema_checked"):
+        return
+    current = current_schema_version(get_db())
+    if current < latest_schema_version():
+        raise RuntimeError(
+            f"database schema is at version {current}, this app needs "
+            f"{latest_schema_version()}: run `flask migrate`"
+        )
+    current_app.extensions["schema_checked"] = True
 
-# ---------- Signup ---------- #
-@app.route("/signup", methods=["GET", "POST"])
-def signup():
-    if request.method == "POST":
-        print("SIGNUP FORM:", dict(request.form))
-        conn = get_db()
-        cur = conn.cursor()
+## ---------- email reminder (2 weeks) ---------- #
 
-        try:
-            role = request.form["role"]
+REMINDER_SUBJECT = N_("Allergy follow-up reminder (2 weeks)")
+REMINDER_BODY = N_(
+    "It has been 2 weeks since you recorded your allergy symptoms.\n\n"
+    "Please log in to assess your symptoms again, "
+    "or see a doctor if they have not improved.\n\n"
+    "Allergy Monitoring System"
+)
+
+
+def reminder_texts():
+    """(locales, subjects, bodies) as parallel lists, one entry per locale."""
+    catalogs = [get_translations(locale) for locale in LOCALES]
+    return (
+        list(LOCALES),
+        [c.gettext(REMINDER_SUBJECT) for c in catalogs],
+        [c.gettext(REMINDER_BODY) for c in catalogs],
+    )
 
-            # 0️⃣ CHECK DOCTOR CODE
-            if role == "doctor":
-                if request.form.get("doctor_code") != "SECRET123":
-                    flash("Invalid doctor signup code", "danger")
-                    return redirect(url_for("signup"))
 
-            # 1️⃣ CREATE USER (RETURNING id is REQUIRED for PostgreSQL)
-            cur.execute(
-                """
-                INSERT INTO users (username, password, role, full_name)
-                VALUES (%s, %s, %s, %s)
-                RETURNING id
-                """,
-                (
-                    request.form["username"],
-                    generate_password_hash(request.form["password"]),
-                    role,
-                    request.form["full_name"]
-                )
+def enqueue_due_reminders(cur):
+    # symptoms.email_sent now means "handed to the outbox"; delivery state
+    # lives in email_outbox. Only rows that made it into the outbox (now or
+    # earlier) are flagged; an unknown locale falls back to DEFAULT_LOCALE.
+    # Due rows of patients without an email lose their due date, so they
+    # drop out of every later scan.
+    locales, subjects, bodies = reminder_texts()
+    default = get_translations(current_app.config["DEFAULT_LOCALE"])
+    cur.execute("""
+        WITH due AS (
+            SELECT s.id, p.email,
+                   COALESCE(t.subject, %(subject)s) AS subject,
+                   COALESCE(t.body, %(body)s) AS body
+            FROM symptoms s
+            JOIN patient_profiles p ON p.user_id = s.user_id
+            LEFT JOIN unnest(%(locales)s::text[], %(subjects)s::text[], %(bodies)s::text[])
+                 AS t(locale, subject, body)
+              ON t.locale = COALESCE(p.locale, %(default_locale)s)
+            WHERE s.email_sent = FALSE
+            AND s.reminder_due_at <= NOW()
+            AND p.email IS NOT NULL
+            FOR UPDATE OF s SKIP LOCKED
+        ), queued AS (
+            INSERT INTO email_outbox (symptom_id, to_email, subject, body)
+            SELECT id, email, subject, body FROM due
+            ON CONFLICT (symptom_id) DO NOTHING
+            RETURNING symptom_id
+        ), flagged AS (
+            UPDATE symptoms SET email_sent = TRUE
+            WHERE id IN (SELECT symptom_id FROM queued)
+               OR id IN (SELECT o.symptom_id FROM email_outbox o JOIN due ON due.id = o.symptom_id)
+        ), unreachable AS (
+            UPDATE symptoms s SET reminder_due_at = NULL
+            WHERE s.email_sent = FALSE
+            AND s.reminder_due_at <= NOW()
+            AND NOT EXISTS (
+                SELECT 1 FROM patient_profiles p
+                WHERE p.user_id = s.user_id AND p.email IS NOT NULL
             )
-            user_id = cur.fetchone()["id"]
-
-            # 2️⃣ PATIENT PROFILE
-            if role == "patient":
-                cur.execute(
-                    """
-                    INSERT INTO patient_profiles
-                    (user_id, email, phone, address, dob, gender,
-                     emergency_contact, insurance_provider, hospital_number)
-                    VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s)
-                    """,
-                    (
-                        user_id,
-                        request.form.get("email"),
-                        request.form.get("phone"),
-                        request.form.get("address"),
-                        request.form.get("dob"),
-                        request.form.get("gender"),
-                        request.form.get("emergency_contact"),
-                        request.form.get("insurance_provider"),
-                        request.form.get("hospital_number")
-                    )
-                )
+        )
+        SELECT COUNT(*) AS queued FROM queued
+    """, {
+        "locales": locales, "subjects": subjects, "bodies": bodies,
+        "default_locale": current_app.config["DEFAULT_LOCALE"],
+        "subject": default.gettext(REMINDER_SUBJECT),
+        "body": default.gettext(REMINDER_BODY),
+    })
+    return cur.fetchone()["queued"]
+
+
+def smtp_session(smtp):
+    import smtplib
+
+    host, port = smtp["SMTP_HOST"], smtp["SMTP_PORT"]
+    if smtp["SMTP_SSL"]:
+        server = smtplib.SMTP_SSL(host, port, timeout=30)
+    else:
+        server = smtplib.SMTP(host, port, timeout=30)
+
+    # a local stand-in (e.g. aiosmtpd) runs without authentication
+    if os.environ.get("EMAIL_PASSWORD"):
+        server.login(os.environ["EMAIL"], os.environ["EMAIL_PASSWORD"])
+    return server
+
+
+def send_outbox_chunk(rows, smtp):
+    """Send rows over one SMTP session. Returns (sent ids, [(id, error)])."""
+    import smtplib
+    from email.mime.text import MIMEText
+
+    sent, failed = [], []
+    try:
+        with smtp_session(smtp) as server:
+            for i, row in enumerate(rows):
+                msg = MIMEText(row["body"])
+                msg["Subject"] = row["subject"]
+                msg["From"] = os.environ["EMAIL"]
+                msg["To"] = row["to_email"]
+                try:
+                    server.send_message(msg)
+                except smtplib.SMTPServerDisconnected as e:
+                    failed += [(r["id"], str(e)) for r in rows[i:]]
+                    break
+                except smtplib.SMTPException as e:
+                    failed.append((row["id"], str(e)))
+                else:
+                    sent.append(row["id"])
+    except (smtplib.SMTPException, OSError) as e:
+        done = set(sent) | {row_id for row_id, _ in failed}
+        failed += [(r["id"], str(e)) for r in rows if r["id"] not in done]
+    return sent, failed
+
+
+def mark_outbox(cur, sent, failed):
+    if sent:
+        cur.execute("""
+            UPDATE email_outbox
+            SET status = 'sent', sent_at = NOW(), last_error = NULL
+            WHERE id = ANY(%s)
+        """, (sent,))
+
+    if failed:
+        max_attempts = int(current_app.config["OUTBOX_MAX_ATTEMPTS"])
+        retry_base = int(current_app.config["OUTBOX_RETRY_BASE"])
+        execute_values(cur, f"""
+            UPDATE email_outbox o
+            SET attempts = o.attempts + 1,
+                last_error = f.error,
+                status = CASE WHEN o.attempts + 1 >= {max_attempts}
+                              THEN 'failed' ELSE 'pending' END,
+                next_attempt_at = NOW() + make_interval(secs => {retry_base} * power(2, o.attempts))
+            FROM (VALUES %s) AS f(id, error)
+            WHERE o.id = f.id
+        """, failed)
+
+
+def dispatch_outbox():
+    """Deliver due outbox rows batch by batch. Returns (sent, failed) counts."""
+    config = current_app.config
+    batch_size = config["OUTBOX_BATCH_SIZE"]
+    workers = max(1, config["SMTP_CONNECTIONS"])
+    # sender threads have no app context, so they get the settings they need
+    send_chunk = partial(
+        send_outbox_chunk,
+        smtp={k: config[k] for k in ("SMTP_HOST", "SMTP_PORT", "SMTP_SSL")}
+    )
+    total_sent = total_failed = 0
 
-                # 3️⃣ PATIENT HISTORY
-                history_data = {
-                    "symptom_year_pattern": request.form.get("symptom_year_pattern"),
-
-                    "season_summer": bool(request.form.get("season_summer")),
-                    "season_rainy": bool(request.form.get("season_rainy")),
-                    "season_winter": bool(request.form.get("season_winter")),
-                    "season_summer_rainy": bool(request.form.get("season_summer_rainy")),
-                    "season_rainy_winter": bool(request.form.get("season_rainy_winter")),
-                    "season_uncertain": bool(request.form.get("season_uncertain")),
-
-                    "duration_per_year": request.form.get("duration_per_year"),
-                    "weekly_frequency": request.form.get("weekly_frequency"),
-
-                    "time_6_12": bool(request.form.get("time_6_12")),
-                    "time_12_18": bool(request.form.get("time_12_18")),
-                    "time_18_24": bool(request.form.get("time_18_24")),
-                    "time_24_6": bool(request.form.get("time_24_6")),
-                    "time_all_day": bool(request.form.get("time_all_day")),
-                    "time_uncertain": bool(request.form.get("time_uncertain")),
-
-                    "living_area": request.form.get("living_area"),
-                    "near_road": request.form.get("near_road") == "yes",
-                    "housing_type": request.form.get("housing_type"),
-                    "air_conditioner": request.form.get("air_conditioner") == "yes",
-
-                    "pet_cat": bool(request.form.get("pet_cat")),
-                    "pet_dog": bool(request.form.get("pet_dog")),
-                    "pet_bird": bool(request.form.get("pet_bird")),
-                    "pet_other": request.form.get("pet_other"),
-
-                    "trigger_dust": bool(request.form.get("trigger_dust")),
-                    "trigger_pollen": bool(request.form.get("trigger_pollen")),
-                    "trigger_animal": bool(request.form.get("trigger_animal")),
-                    "trigger_smoke": bool(request.form.get("trigger_smoke")),
-                    "trigger_cold_air": bool(request.form.get("trigger_cold_air")),
-                    "trigger_pollution": bool(request.form.get("trigger_pollution")),
-                    "trigger_stress": bool(request.form.get("trigger_stress")),
-                    "trigger_other": request.form.get("trigger_other"),
-
-                    "smoking_status": request.form.get("smoking_status"),
-                    "cigarettes_per_day": (
-                        int(request.form.get("cigarettes_per_day"))
-                        if request.form.get("cigarettes_per_day")
-                        else None
-                    ),
-                    "quit_years": (
-                        int(request.form.get("quit_years"))
-                        if request.form.get("quit_years")
-                        else None
-                    ),
-
-                    "secondhand_smoke": request.form.get("secondhand_smoke"),
-
-                    "drug_allergy": request.form.get("drug_allergy"),
-                    "drug_allergy_name": request.form.get("drug_allergy_name"),
-                    "drug_allergy_symptom": request.form.get("drug_allergy_symptom"),
-
-                    "food_allergy": request.form.get("food_allergy"),
-                    "food_allergy_name": request.form.get("food_allergy_name"),
-                    "food_allergy_symptom": request.form.get("food_allergy_symptom"),
-
-                    "natural_allergy": request.form.get("natural_allergy"),
-                    "natural_allergy_symptom": request.form.get("natural_allergy_symptom"),
-
-                    "family_asthma": ",".join(request.form.getlist("family_asthma")),
-                    "family_rhinitis": ",".join(request.form.getlist("family_rhinitis")),
-                    "family_allergic_conjunctivitis": ",".join(request.form.getlist("family_allergic_conjunctivitis")),
-                    "family_atopic_dermatitis": ",".join(request.form.getlist("family_atopic_dermatitis")),
-
-                    "work_performance": request.form.get("work_performance"),
-                    "physical_activity_problem": request.form.get("physical_activity_problem"),
-                    "stairs_problem": request.form.get("stairs_problem"),
-
-                    "work_less_physical": request.form.get("work_less_physical"),
-                    "work_careful_physical": request.form.get("work_careful_physical"),
-
-                    "work_less_emotional": request.form.get("work_less_emotional"),
-                    "work_careless_emotional": request.form.get("work_careless_emotional"),
-
-                    "daily_activity_limit": request.form.get("daily_activity_limit"),
-
-                    "feel_calm": request.form.get("feel_calm"),
-                    "feel_energetic": request.form.get("feel_energetic"),
-                    "feel_sad": request.form.get("feel_sad"),
-                    "social_limit": request.form.get("social_limit"),
-                }
+    conn = get_db()
+    cur = conn.cursor()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            # rows stay locked until the batch is marked, so concurrent
+            # dispatchers skip them instead of sending twice
+            cur.execute("""
+                SELECT id, to_email, subject, body
+                FROM email_outbox
+                WHERE status = 'pending' AND next_attempt_at <= NOW()
+                ORDER BY next_attempt_at
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            """, (batch_size,))
+            rows = cur.fetchall()
+            if not rows:
+                conn.rollback()
+                break
+
+            chunks = [rows[i::workers] for i in range(workers) if rows[i::workers]]
+            sent, failed = [], []
+            for chunk_sent, chunk_failed in executor.map(send_chunk, chunks):
+                sent += chunk_sent
+                failed += chunk_failed
+
+            mark_outbox(cur, sent, failed)
+            conn.commit()
+            total_sent += len(sent)
+            total_failed += len(failed)
 
-                columns = ", ".join(history_data.keys())
-                placeholders = ", ".join(["%s"] * len(history_data))
+            if len(rows) < batch_size:
+                break
 
-                cur.execute(
-                    f"""
-                    INSERT INTO patient_history (user_id, {columns})
-                    VALUES (%s, {placeholders})
-                    """,
-                    (user_id, *history_data.values())
-                )
+    cur.close()
+    return total_sent, total_failed
 
-            conn.commit()
 
-            flash(
-                "สมัครสมาชิกสำเร็จ กรุณาเข้าสู่ระบบและกรอกแบบประเมินอาการ\n\n"
-                "Signup successful. Please log in and complete the assessment form.",
-                "success"
+def seconds_until_next_reminder():
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT EXTRACT(EPOCH FROM LEAST(
+            (
+                SELECT s.reminder_due_at
+                FROM symptoms s
+                WHERE s.email_sent = FALSE
+                AND s.reminder_due_at IS NOT NULL
+                AND EXISTS (
+                    SELECT 1 FROM patient_profiles p
+                    WHERE p.user_id = s.user_id AND p.email IS NOT NULL
+                )
+                ORDER BY s.reminder_due_at
+                LIMIT 1
+            ),
+            (
+                SELECT MIN(next_attempt_at)
+                FROM email_outbox
+                WHERE status = 'pending'
             )
-            return redirect(url_for("login"))
-
-        except Exception as e:
-            conn.rollback()
-            flash(f"Signup error: {e}", "danger")
-
-        finally:
-            conn.close()
+        ) - NOW()) AS wait
+    """)
+    wait = cur.fetchone()["wait"]
+    conn.rollback()
+    cur.close()
 
-    return render_template("signup.html")
+    max_sleep = current_app.config["REMINDER_MAX_SLEEP"]
+    if wait is None:
+        return max_sleep
+    return min(max_sleep, max(1.0, float(wait)))
 
-# ---------- Doctor Dashboard ---------- #
-@app.route("/doctor_dashboard")
-def doctor_dashboard():
-    if session.get("role") != "doctor":
-        return redirect(url_for("login"))
 
+def check_two_weeks_passed():
+    started = time.perf_counter()
     conn = get_db()
     cur = conn.cursor()
+    queued = enqueue_due_reminders(cur)
+    conn.commit()
+    cur.close()
 
-    cur.execute("""
-        SELECT 
-            u.id,
-            u.full_name,
-            p.phone,
-            p.email,
-            COUNT(s.id) AS record_count
-        FROM users u
-        LEFT JOIN patient_profiles p ON u.id = p.user_id
-        LEFT JOIN symptoms s ON u.id = s.user_id
-        WHERE u.role = 'patient'
-        GROUP BY u.id, u.full_name, p.phone, p.email
-        ORDER BY u.full_name
-    """)
+    sent, failed = dispatch_outbox()
+    metrics.observe("reminder_job_duration_seconds", time.perf_counter() - started)
+    metrics.inc("reminders_queued_total", queued)
+    metrics.inc("emails_sent_total", sent)
+    metrics.inc("emails_failed_total", failed)
+    if queued or sent or failed:
+        print(f"📧 Reminders: {queued} queued, {sent} sent, {failed} failed")
 
-    patients = cur.fetchall()
-    conn.close()
 
-    return render_template("doctor_dashboard.html", patients=patients)
 
+REMINDER_LOCK_KEY = 727_001  # pg advisory lock id shared by every scheduler
 
-## ---------- Doctor Stats ---------- #
-@app.route("/doctor_stats")
-def doctor_stats():
-    if session.get("role") != "doctor":
-        return redirect(url_for("login"))
 
-    conn = get_db()
-    cur = conn.cursor()
+class LeaderLock:
+    """Postgres session advisory lock held on a dedicated connection.
+
+    Only the process holding the lock runs the reminder job. The lock is
+    released by the server when the holder's connection dies, after which
+    another process picks it up on its next tick. Followers don't keep a
+    connection around: each attempt that fails to get the lock closes its
+    connection again.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.conn = None
+        self.held = False
+
+    def acquire(self):
+        try:
+            if self.conn is None or self.conn.closed:
+                pool = get_pool()
+                self.conn = psycopg2.connect(pool.dsn, **pool.connect_kwargs)
+                self.conn.autocommit = True
+                self.held = False
+
+            with self.conn.cursor() as cur:
+                if self.held:
+                    cur.execute("SELECT 1")
+                else:
+                    cur.execute("SELECT pg_try_advisory_lock(%s) AS ok", (self.key,))
+                    self.held = cur.fetchone()["ok"]
+        except psycopg2.Error:
+            self.release()
+        if not self.held:
+            self.release()
+        return self.held
+
+    def release(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except psycopg2.Error:
+                pass
+        self.conn = None
+        self.held = False
+
+
+leader_lock = None
+
+
+def run_reminder_job():
+    """Run the reminder job if this process is the leader.
+
+    Returns the number of seconds to sleep before the next run: until the
+    next reminder or retry is due for the leader, the leader poll interval
+    for everyone else.
+    """
+    global leader_lock
+    if leader_lock is None:
+        leader_lock = LeaderLock(REMINDER_LOCK_KEY)
+    if not leader_lock.acquire():
+        return current_app.config["SCHEDULER_LEADER_POLL"]
+
+    check_two_weeks_passed()
+    return seconds_until_next_reminder()
+
+
+def start_scheduler(app, blocking=False):
+    from apscheduler.schedulers.background import BackgroundScheduler
+    from apscheduler.schedulers.blocking import BlockingScheduler
+
+    scheduler = BlockingScheduler() if blocking else BackgroundScheduler()
+
+    def tick():
+        delay = app.config["SCHEDULER_LEADER_POLL"]
+        try:
+            with app.app_context():
+                delay = run_reminder_job()
+        finally:
+            scheduler.add_job(
+                tick, "date", run_date=datetime.now() + timedelta(seconds=delay)
+            )
+
+    scheduler.add_job(tick, "date", run_date=datetime.now())
+    scheduler.start()
+    return scheduler
+
+
+_scheduler_lock = threading.Lock()
+
+
+def start_scheduler_once():
+    # started lazily in each serving process (after any fork); leader
+    # election makes sure only one of them actually sends reminders
+    app = current_app._get_current_object()
+    if current_app.config["SCHEDULER_MODE"] != "leader" or "scheduler" in app.extensions:
+        return
+    with _scheduler_lock:
+        if "scheduler" not in app.extensions:
+            app.extensions["scheduler"] = start_scheduler(app)
+            print("🟢 Reminder scheduler started")
+
+
+@cli_command("reminder-worker")
+def reminder_worker_command():
+    """Run the reminder scheduler in the foreground, without the web app."""
+    print("🟢 Reminder worker started")
+    start_scheduler(current_app._get_current_object(), blocking=True)
+
+
+
+# ---------------- Password hashing ---------------- #
+class HashPoolBusy(Exception):
+    pass
+
+
+class HashPool:
+    """Runs password hashing on a few worker threads instead of the request
+    thread.
+
+    hashlib's scrypt/pbkdf2 release the GIL, so threads hash in parallel,
+    but never more than ``workers`` at a time. Up to ``max_pending`` more
+    callers may queue; anyone beyond that waits at most ``wait`` seconds for
+    a slot and then gets HashPoolBusy (served as 503), so a login burst
+    queues briefly instead of pinning every CPU.
+    """
+
+    def __init__(self, method, workers, max_pending, wait):
+        self.pid = os.getpid()
+        self.method = method
+        self.wait = wait
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hash")
+        self._slots = threading.BoundedSemaphore(workers + max_pending)
+        # the stored form of the method with werkzeug's defaults filled in,
+        # e.g. "scrypt" -> "scrypt:32768:8:1"
+        self.prefix = generate_password_hash("", method).split("$", 1)[0]
+
+    def run(self, fn, *args, **kwargs):
+        if not self._slots.acquire(timeout=self.wait):
+            raise HashPoolBusy()
+        try:
+            return self._executor.submit(fn, *args, **kwargs).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self.run(generate_password_hash, password, self.method)
+
+    def verify(self, pwhash, password):
+        return self.run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        return pwhash.split("$", 1)[0] != self.prefix
+
+
+_hash_pool_lock = threading.Lock()
+
+
+def get_hash_pool():
+    # worker threads don't survive fork(), so each process makes its own
+    pool = current_app.extensions.get("hash_pool")
+    if pool is None or pool.pid != os.getpid():
+        with _hash_pool_lock:
+            pool = current_app.extensions.get("hash_pool")
+            if pool is None or pool.pid != os.getpid():
+                config = current_app.config
+                pool = HashPool(
+                    config["PASSWORD_HASH_METHOD"],
+                    workers=config["PASSWORD_HASH_WORKERS"],
+                    max_pending=config["PASSWORD_HASH_MAX_PENDING"],
+                    wait=config["PASSWORD_HASH_WAIT"],
+                )
+                current_app.extensions["hash_pool"] = pool
+    return pool
+
+
+def hash_pool_busy(exc):
+    return (
+        _("Too many sign-ins right now, please try again in a moment."),
+        503,
+        {"Retry-After": "2"}
+    )
+
+
+# ---------------- Cache ---------------- #
+class LocalCache:
+    """In-process LRU cache with per-entry expiry.
+
+    Each worker process has its own copy, so a write in one worker only
+    invalidates that worker's entries; the others catch up within the TTL.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def version(self):
+        return self._version
+
+    def bump(self):
+        with self._lock:
+            self._version += 1
+            # old-version keys can never be read again
+            self._entries.clear()
+
+
+def cache_json_default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+class RedisCache:
+    """Cache shared by all workers through Redis (or anything that speaks
+    its protocol). Errors are treated as misses so a cache outage only costs
+    speed. Values are stored as JSON, never pickled: whoever can write to
+    the Redis must not be able to run code in the workers. Dates come back
+    as ISO strings."""
+
+    VERSION_KEY = "cache:version"
+
+    def __init__(self, url):
+        import redis
+
+        self._redis = redis.Redis.from_url(url)
+        self._errors = (redis.RedisError, OSError)
+
+    def get(self, key):
+        try:
+            raw = self._redis.get(key)
+        except self._errors:
+            return None
+        if raw is None:
+            return None
+        try:
+            return json.loads(raw)
+        except ValueError:  # not JSON (e.g. written by an older version)
+            return None
+
+    def set(self, key, value, ttl):
+        try:
+            self._redis.set(key, json.dumps(value, default=cache_json_default), ex=max(1, int(ttl)))
+        except self._errors:
+            pass
+
+    def version(self):
+        try:
+            return int(self._redis.get(self.VERSION_KEY) or 0)
+        except self._errors:
+            return None
+
+    def bump(self):
+        try:
+            self._redis.incr(self.VERSION_KEY)
+        except self._errors:
+            pass
+
+
+class Cache:
+    """Versioned cache for computed view data.
+
+    Keys include a global data version; signup, patient_form, imports and
+    re-scoring bump it, which orphans every older entry at once. The CLI
+    commands can only bump a shared (Redis) version; see
+    invalidate_cache_from_cli().
+    """
+
+    def __init__(self, backend, ttl):
+        self.pid = os.getpid()
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = Counter()
+        self.misses = Counter()
+
+    def lookup(self, name, key):
+        """(full key or None if the backend is down, cached value or None)."""
+        version = self.backend.version()
+        if version is None:  # backend unavailable
+            self.misses[name] += 1
+            return None, None
+
+        full_key = f"{name}:{version}:{key}"
+        value = self.backend.get(full_key)
+        if value is not None:
+            self.hits[name] += 1
+        else:
+            self.misses[name] += 1
+        return full_key, value
+
+    def store(self, full_key, value):
+        if full_key is not None:
+            self.backend.set(full_key, value, self.ttl)
+        return value
+
+    def fetch(self, name, key, compute):
+        full_key, value = self.lookup(name, key)
+        if value is not None:
+            return value
+        return self.store(full_key, compute())
+
+    async def fetch_async(self, name, key, compute):
+        """fetch() for a coroutine function; the backend calls are short and
+        stay synchronous."""
+        full_key, value = self.lookup(name, key)
+        if value is not None:
+            return value
+        return self.store(full_key, await compute())
+
+    def invalidate(self):
+        self.backend.bump()
+
+    def stats(self):
+        return {
+            "backend": type(self.backend).__name__,
+            "ttl": self.ttl,
+            "views": {
+                name: {"hits": self.hits[name], "misses": self.misses[name]}
+                for name in sorted(set(self.hits) | set(self.misses))
+            },
+        }
+
+
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    cache = current_app.extensions.get("cache")
+    if cache is None or cache.pid != os.getpid():
+        with _cache_lock:
+            cache = current_app.extensions.get("cache")
+            if cache is None or cache.pid != os.getpid():
+                config = current_app.config
+                backend = None
+                if config["CACHE_URL"]:
+                    try:
+                        backend = RedisCache(config["CACHE_URL"])
+                    except ImportError:
+                        print("⚠️ CACHE_URL is set but the redis package is missing; caching in process")
+                if backend is None:
+                    backend = LocalCache(config["CACHE_MAX_ENTRIES"])
+                cache = Cache(backend, config["CACHE_TTL"])
+                current_app.extensions["cache"] = cache
+    return cache
+
+
+def invalidate_cache_from_cli():
+    """Bump the cache version from a CLI command. The command runs in its
+    own process, so with the in-process cache there is nothing to bump that
+    a web worker would see; returns a note saying so instead."""
+    cache = get_cache()
+    if isinstance(cache.backend, LocalCache):
+        return (f"web workers show the change within CACHE_TTL ({cache.ttl:g}s); "
+                "set CACHE_URL to make it immediate")
+    cache.invalidate()
+    return None
+
+
+# ---------------- Templates ---------------- #
+class FragmentCacheExtension(Extension):
+    """`{% cache "name" %}...{% endcache %}` renders its body once per
+    process and locale and reuses the markup after that.
+
+    Only for sections that depend on nothing but the locale: no request
+    data, no flashes, no per-user values.
+    """
+    tags = {"cache"}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(fragment_cache={}, fragment_cache_enabled=True, fragment_locale=None)
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [nodes.Const(parser.name), parser.parse_expression()]
+        body = parser.parse_statements(("name:endcache",), drop_needle=True)
+        return nodes.CallBlock(self.call_method("_render", args), [], [], body).set_lineno(lineno)
+
+    def _render(self, template, name, caller):
+        env = self.environment
+        if not env.fragment_cache_enabled:
+            return caller()
+        key = (template, name, env.fragment_locale())
+        markup = env.fragment_cache.get(key)
+        if markup is not None:
+            return markup
+        if env.is_async:
+            return self._store_async(key, caller())
+        markup = env.fragment_cache[key] = caller()
+        return markup
+
+    async def _store_async(self, key, rendering):
+        markup = self.environment.fragment_cache[key] = await rendering
+        return markup
+
+
+def configure_templates(app, locale=current_locale, bytecode_pattern="__jinja2_%s.cache"):
+    """Set up app's Jinja environment; must run before anything touches
+    app.jinja_env. locale returns the locale of the request being served.
+    Environments compiling differently (async) need their own pattern."""
+    options = dict(app.jinja_options, extensions=[FragmentCacheExtension, "jinja2.ext.i18n"])
+    cache_dir = app.config["TEMPLATE_CACHE_DIR"]
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        options["bytecode_cache"] = FileSystemBytecodeCache(cache_dir, bytecode_pattern)
+    app.jinja_options = options
+
+    env = app.jinja_env
+    env.fragment_cache_enabled = app.config["FRAGMENT_CACHE"]
+    env.fragment_locale = locale
+    env.install_gettext_callables(
+        lambda message: get_translations(locale()).gettext(message),
+        lambda singular, plural, n: get_translations(locale()).ngettext(singular, plural, n),
+        newstyle=True,
+    )
+
+
+# ---------------- Helpers ---------------- #
+def like_escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def classify_pattern(days_per_week: int) -> str:
+    return "persistent" if days_per_week >= 4 else "intermittent"
+
+
+# form answers kept in their own symptoms columns: (form field, column, type)
+FORM_COLUMNS = (
+    ("vas_score1", "vas_score1", float),
+    ("vas_score2", "vas_score2", float),
+    ("vas_score3", "vas_score3", float),
+    ("symptom_frequency", "symptom_frequency", int),
+    ("used_steroid_before", "used_steroid_before", bool),
+    ("medicine_effect", "medicine_effect_answer", int),
+    ("Frequently sneeze", "tnss_sneeze", int),
+    ("Stuffed nose", "tnss_stuffed", int),
+    ("runny nose", "tnss_runny", int),
+    ("itchy nose", "tnss_itchy", int),
+)
+FORM_COLUMN_NAMES = tuple(column for _, column, _ in FORM_COLUMNS)
+
+# the rest of the form stays in raw_form, under short keys and without
+# empty answers; report_date is dropped, it is the row's created_at
+RAW_FORM_KEYS = {
+    "phlegm_throat": "pt", "itchy_eyes": "ie", "watery_eyes": "we",
+    "chronic_cough": "cc", "itchy_throat": "it", "sore_throat": "st",
+    "headache": "ha", "dry_mouth": "dm", "fatigue": "fa", "snoring": "sn",
+    "mouth_breathing": "mb", "poor_sleep": "ps", "daytime_sleepiness": "ds",
+    "loss_of_smell": "ls", "other_symptom": "os",
+}
+RAW_FORM_NAMES = {short: name for name, short in RAW_FORM_KEYS.items()}
+RAW_FORM_DROPPED = ("report_date",)
+
+_INT_ANSWER = re.compile(r"^\s*-?\d+\s*$")
+_FLOAT_ANSWER = re.compile(r"^\s*-?\d+(\.\d+)?\s*$")
+
+
+def form_answer(value, kind):
+    """A form answer as ``kind``; None when missing or malformed."""
+    if value is None:
+        return None
+    if kind is bool:
+        return {"yes": True, "no": False}.get(value)
+    if kind is int:
+        return int(value) if _INT_ANSWER.match(value) else None
+    return float(value) if _FLOAT_ANSWER.match(value) else None
+
+
+def form_column_values(form):
+    return {column: form_answer(form.get(field), kind) for field, column, kind in FORM_COLUMNS}
+
+
+def compact_form(form):
+    """raw_form for a submitted form: the answers without a column of their
+    own, plus any that could not be stored in theirs."""
+    skip = {
+        field for field, _, kind in FORM_COLUMNS
+        if form_answer(form.get(field), kind) is not None
+    }.union(RAW_FORM_DROPPED)
+    return {
+        RAW_FORM_KEYS.get(k, k): v
+        for k, v in ((k, form.get(k)) for k in form)
+        if k not in skip and v not in (None, "")
+    }
+
+
+def expand_form(row):
+    """The answers of a symptoms row (typed columns + raw_form) keyed by
+    form field, as the patient detail page shows them."""
+    data = {}
+    for field, column, kind in FORM_COLUMNS:
+        value = row[column]
+        if value is None:
+            continue
+        if kind is bool:
+            data[field] = "yes" if value else "no"
+        elif kind is float:
+            data[field] = f"{value:g}"
+        else:
+            data[field] = str(value)
+    for key, value in (row["raw_form"] or {}).items():
+        data[RAW_FORM_NAMES.get(key, key)] = value
+    return data
+
+
+PROFILE_FIELDS = (
+    "email", "phone", "address", "dob", "gender",
+    "emergency_contact", "insurance_provider", "hospital_number",
+)
+
+
+def build_history_data(form):
+    """Map signup form fields (a MultiDict) to patient_history columns."""
+    return {
+        "symptom_year_pattern": form.get("symptom_year_pattern"),
+
+        "season_summer": bool(form.get("season_summer")),
+        "season_rainy": bool(form.get("season_rainy")),
+        "season_winter": bool(form.get("season_winter")),
+        "season_summer_rainy": bool(form.get("season_summer_rainy")),
+        "season_rainy_winter": bool(form.get("season_rainy_winter")),
+        "season_uncertain": bool(form.get("season_uncertain")),
+
+        "duration_per_year": form.get("duration_per_year"),
+        "weekly_frequency": form.get("weekly_frequency"),
+
+        "time_6_12": bool(form.get("time_6_12")),
+        "time_12_18": bool(form.get("time_12_18")),
+        "time_18_24": bool(form.get("time_18_24")),
+        "time_24_6": bool(form.get("time_24_6")),
+        "time_all_day": bool(form.get("time_all_day")),
+        "time_uncertain": bool(form.get("time_uncertain")),
+
+        "living_area": form.get("living_area"),
+        "near_road": form.get("near_road") == "yes",
+        "housing_type": form.get("housing_type"),
+        "air_conditioner": form.get("air_conditioner") == "yes",
+
+        "pet_cat": bool(form.get("pet_cat")),
+        "pet_dog": bool(form.get("pet_dog")),
+        "pet_bird": bool(form.get("pet_bird")),
+        "pet_other": form.get("pet_other"),
+
+        "trigger_dust": bool(form.get("trigger_dust")),
+        "trigger_pollen": bool(form.get("trigger_pollen")),
+        "trigger_animal": bool(form.get("trigger_animal")),
+        "trigger_smoke": bool(form.get("trigger_smoke")),
+        "trigger_cold_air": bool(form.get("trigger_cold_air")),
+        "trigger_pollution": bool(form.get("trigger_pollution")),
+        "trigger_stress": bool(form.get("trigger_stress")),
+        "trigger_other": form.get("trigger_other"),
+
+        "smoking_status": form.get("smoking_status"),
+        "cigarettes_per_day": (
+            int(form.get("cigarettes_per_day"))
+            if form.get("cigarettes_per_day")
+            else None
+        ),
+        "quit_years": (
+            int(form.get("quit_years"))
+            if form.get("quit_years")
+            else None
+        ),
+
+        "secondhand_smoke": form.get("secondhand_smoke"),
+
+        "drug_allergy": form.get("drug_allergy"),
+        "drug_allergy_name": form.get("drug_allergy_name"),
+        "drug_allergy_symptom": form.get("drug_allergy_symptom"),
+
+        "food_allergy": form.get("food_allergy"),
+        "food_allergy_name": form.get("food_allergy_name"),
+        "food_allergy_symptom": form.get("food_allergy_symptom"),
+
+        "natural_allergy": form.get("natural_allergy"),
+        "natural_allergy_symptom": form.get("natural_allergy_symptom"),
+
+        "family_asthma": ",".join(form.getlist("family_asthma")),
+        "family_rhinitis": ",".join(form.getlist("family_rhinitis")),
+        "family_allergic_conjunctivitis": ",".join(form.getlist("family_allergic_conjunctivitis")),
+        "family_atopic_dermatitis": ",".join(form.getlist("family_atopic_dermatitis")),
+
+        "work_performance": form.get("work_performance"),
+        "physical_activity_problem": form.get("physical_activity_problem"),
+        "stairs_problem": form.get("stairs_problem"),
+
+        "work_less_physical": form.get("work_less_physical"),
+        "work_careful_physical": form.get("work_careful_physical"),
+
+        "work_less_emotional": form.get("work_less_emotional"),
+        "work_careless_emotional": form.get("work_careless_emotional"),
+
+        "daily_activity_limit": form.get("daily_activity_limit"),
+
+        "feel_calm": form.get("feel_calm"),
+        "feel_energetic": form.get("feel_energetic"),
+        "feel_sad": form.get("feel_sad"),
+        "social_limit": form.get("social_limit"),
+    }
+
+
+HISTORY_COLUMNS = tuple(build_history_data(MultiDict()))
+
+# (label, column) for the history panel on the patient detail page
+HISTORY_FIELDS = (
+    ("Symptom year pattern", "symptom_year_pattern"),
+    ("Season: summer", "season_summer"),
+    ("Season: rainy", "season_rainy"),
+    ("Season: winter", "season_winter"),
+    ("Season: summer+rainy", "season_summer_rainy"),
+    ("Season: rainy+winter", "season_rainy_winter"),
+    ("Season: uncertain", "season_uncertain"),
+    ("Duration per year", "duration_per_year"),
+    ("Weekly frequency", "weekly_frequency"),
+    ("Time 06-12", "time_6_12"),
+    ("Time 12-18", "time_12_18"),
+    ("Time 18-24", "time_18_24"),
+    ("Time 24-06", "time_24_6"),
+    ("All day", "time_all_day"),
+    ("Time uncertain", "time_uncertain"),
+    ("Living area", "living_area"),
+    ("Near road", "near_road"),
+    ("Housing type", "housing_type"),
+    ("Air conditioner", "air_conditioner"),
+    ("Pet: cat", "pet_cat"),
+    ("Pet: dog", "pet_dog"),
+    ("Pet: bird", "pet_bird"),
+    ("Pet: other", "pet_other"),
+    ("Trigger: dust", "trigger_dust"),
+    ("Trigger: pollen", "trigger_pollen"),
+    ("Trigger: animal", "trigger_animal"),
+    ("Trigger: smoke", "trigger_smoke"),
+    ("Trigger: cold air", "trigger_cold_air"),
+    ("Trigger: pollution", "trigger_pollution"),
+    ("Trigger: stress", "trigger_stress"),
+    ("Trigger: other", "trigger_other"),
+    ("Smoking status", "smoking_status"),
+    ("Cigarettes per day", "cigarettes_per_day"),
+    ("Years since quit", "quit_years"),
+    ("Secondhand smoke", "secondhand_smoke"),
+    ("Drug allergy", "drug_allergy"),
+    ("Drug allergy name", "drug_allergy_name"),
+    ("Drug allergy symptom", "drug_allergy_symptom"),
+    ("Food allergy", "food_allergy"),
+    ("Food allergy name", "food_allergy_name"),
+    ("Food allergy symptom", "food_allergy_symptom"),
+    ("Natural allergy", "natural_allergy"),
+    ("Natural allergy symptom", "natural_allergy_symptom"),
+    ("Family: asthma", "family_asthma"),
+    ("Family: rhinitis", "family_rhinitis"),
+    ("Family: allergic conjunctivitis", "family_allergic_conjunctivitis"),
+    ("Family: atopic dermatitis", "family_atopic_dermatitis"),
+    ("Work performance", "work_performance"),
+    ("Physical activity problem", "physical_activity_problem"),
+    ("Stairs problem", "stairs_problem"),
+    ("Work less physical", "work_less_physical"),
+    ("Work careful physical", "work_careful_physical"),
+    ("Work less emotional", "work_less_emotional"),
+    ("Work careless emotional", "work_careless_emotional"),
+    ("Daily activity limit", "daily_activity_limit"),
+    ("Feel calm", "feel_calm"),
+    ("Feel energetic", "feel_energetic"),
+    ("Feel sad", "feel_sad"),
+    ("Social limit", "social_limit"),
+)
+
+
+def history_rows(patient):
+    """(label, value) pairs for HISTORY_FIELDS, blank answers as None."""
+    if not patient:
+        return [(label, None) for label, key in HISTORY_FIELDS]
+    return [(label, patient[key] if patient[key] != "" else None) for label, key in HISTORY_FIELDS]
+
+# ---------------- Medicine Algorithm ---------------- #
+# treatment codes, OR-ed together into symptoms.treatment_codes
+TX_SALINE = 1
+TX_ORAL_AH = 2
+TX_LTRA = 4
+TX_INCS_STANDARD = 8
+TX_INCS_HIGH = 16
+TX_REFERRAL = 32
+TX_IMMUNOTHERAPY = 64
+TX_SURGERY = 128
+
+TREATMENT_CODES = {
+    "saline": TX_SALINE,
+    "oral_ah": TX_ORAL_AH,
+    "ltra": TX_LTRA,
+    "incs_standard": TX_INCS_STANDARD,
+    "incs_high": TX_INCS_HIGH,
+    "referral": TX_REFERRAL,
+    "immunotherapy": TX_IMMUNOTHERAPY,
+    "surgery": TX_SURGERY,
+}
+
+def codes_with(mask):
+    """All treatment_codes values sharing a bit with mask, for index-friendly
+    ``treatment_codes = ANY(%s)`` filters."""
+    return [c for c in range(1, max(TREATMENT_CODES.values()) * 2) if c & mask]
+
+# Recommendation fragments. The Thai text is the source: it is what gets
+# stored in symptoms.recommendation. Other locales translate it for display.
+SALINE = N_(
+    "ล้างจมูกด้วยน้ำเกลือ (Normal saline irrigation)\n"
+    "– วันละ 1–2 ครั้ง\n\n"
+)
+
+ORAL_AH = N_(
+    "ยาต้านฮิสตามีนชนิดรับประทาน รุ่นที่ 2\n"
+    "– วันละ 1 ครั้ง\n\n"
+)
+
+LEUKO = N_(
+    "Leukotriene receptor antagonist (LTRA)\n"
+    "– วันละ 1 ครั้ง\n\n"
+)
+
+INCS_STANDARD = N_(
+    "ยาสเตียรอยด์พ่นจมูก\n"
+    "– 2 sprays/nostril วันละครั้ง\n"
+)
+
+INCS_HIGH = N_(
+    "ยาสเตียรอยด์พ่นจมูก (เพิ่มขนาดยา)\n"
+    "– 2 sprays/nostril วันละ 2 ครั้ง\n"
+)
+
+STEP_DOWN = N_("อาการดีขึ้น → ลดระดับยา และใช้ยาต่ออีก 2 สัปดาห์")
+
+REFER = N_(
+    "ส่งพบแพทย์เฉพาะทาง\n"
+    "ประเมินการวินิจฉัยและการใช้ยา\n\n"
+)
+
+CHOOSE_ONE = N_("เลือกอย่างใดอย่างหนึ่ง\n\n")
+OR = N_("หรือ\n\n")
+
+IMMUNOTHERAPY_SURGERY = N_(
+    "ภูมิคุ้มกันบัมบัดด้วยสารก่อภูมิแพ้\n"
+    "ควรได้รับการผ่าตัด"
+)
+
+
+def _recommend(follow_up, pattern, severe, used_steroid):
+    """The guideline itself: (recommendation fragments, treatment codes)."""
+    # ================= STATE 0 =================
+    if follow_up == 0:
+        if pattern == "intermittent" and not severe:
+            return (
+                (SALINE, CHOOSE_ONE, ORAL_AH, OR, LEUKO),
+                TX_SALINE | TX_ORAL_AH | TX_LTRA
+            )
+
+        if (pattern == "intermittent" and severe) or \
+           (pattern == "persistent" and not severe):
+            return (
+                (SALINE, CHOOSE_ONE, ORAL_AH, OR, INCS_STANDARD),
+                TX_SALINE | TX_ORAL_AH | TX_INCS_STANDARD
+            )
+
+        if pattern == "persistent" and severe:
+            return (SALINE, INCS_STANDARD), TX_SALINE | TX_INCS_STANDARD
+
+    # ================= STATE 1 =================
+    if follow_up == 1:
+        if not severe:
+            return (STEP_DOWN,), 0
+
+        if not used_steroid:
+            return (SALINE, INCS_STANDARD), TX_SALINE | TX_INCS_STANDARD
+
+        return (REFER, INCS_HIGH), TX_REFERRAL | TX_INCS_HIGH
+
+    # ================= STATE 2 =================
+    if follow_up == 2:
+        if not severe:
+            return (STEP_DOWN,), 0
+
+        return (REFER, INCS_HIGH), TX_REFERRAL | TX_INCS_HIGH
+
+    # ================= STATE 3 =================
+    if follow_up == 3:
+        if not severe:
+            return (STEP_DOWN,), 0
+        return (IMMUNOTHERAPY_SURGERY,), TX_IMMUNOTHERAPY | TX_SURGERY
+
+    return (), 0
+
+
+def _next_follow_up(follow_up, pattern, severe, used_steroid):
+    """Follow-up state after a report: 0 controlled, 1-3 escalating."""
+    if not severe and pattern == "intermittent":
+        return 0
+    if severe and follow_up < 3:
+        if follow_up == 1 and not used_steroid:
+            return 1
+        return follow_up + 1
+    return follow_up
+
+
+Decision = namedtuple("Decision", "recommendation codes next_follow_up")
+
+FOLLOW_UP_STATES = (0, 1, 2, 3)
+PATTERNS = ("intermittent", "persistent")
+
+
+def _build_decisions():
+    table, fragments = {}, {}
+    for key in itertools.product(FOLLOW_UP_STATES, PATTERNS, (False, True), (False, True)):
+        parts, codes = _recommend(*key)
+        text = sys.intern("".join(parts)) if parts else None
+        table[key] = Decision(text, codes, _next_follow_up(*key))
+        if text:
+            fragments[text] = parts
+    return MappingProxyType(table), MappingProxyType(fragments)
+
+
+# every (follow_up, pattern, severe, used_steroid) the guideline can see,
+# worked out once; each distinct recommendation text exists once in memory
+DECISIONS, RECOMMENDATION_FRAGMENTS = _build_decisions()
+NO_DECISION = Decision(None, 0, None)
+
+
+def decide(follow_up, pattern, avg_vas, used_steroid_answer):
+    """Decision for one report. used_steroid_answer is the form's "yes"/"no";
+    anything other than "yes" counts as no."""
+    decision = DECISIONS.get((follow_up, pattern, avg_vas >= 5, used_steroid_answer == "yes"))
+    if decision is None:
+        return Decision(None, 0, follow_up)
+    return decision
 
-    # total patients
-    cur.execute(
-        "SELECT COUNT(*) AS c FROM users WHERE role = 'patient'"
+
+@lru_cache(maxsize=None)
+def recommendation_texts(locale):
+    """Stored recommendation text -> the same recommendation in locale, put
+    together once per process from the translated fragments."""
+    catalog = get_translations(locale)
+    return MappingProxyType({
+        text: sys.intern("".join(map(catalog.gettext, parts)))
+        for text, parts in RECOMMENDATION_FRAGMENTS.items()
+    })
+
+
+def localize_recommendation(text, locale):
+    """A stored recommendation in locale; text the guideline no longer
+    produces (older rows) is shown as stored."""
+    return recommendation_texts(locale).get(text, text)
+
+
+def decide_many(follow_ups, patterns, avg_vases, used_steroid_answers):
+    """decide() over parallel sequences, e.g. columns fetched for re-scoring.
+
+    Keys are built and looked up with map/zip only, so no Python frame runs
+    per row. Rows outside the table get NO_DECISION.
+    """
+    keys = zip(
+        follow_ups,
+        patterns,
+        map(operator.ge, avg_vases, itertools.repeat(5)),
+        map(operator.eq, used_steroid_answers, itertools.repeat("yes")),
     )
-    total_patients = cur.fetchone()["c"]
+    return list(map(DECISIONS.get, keys, itertools.repeat(NO_DECISION)))
+
+
+# fragments of the recommendation text above, used to code rows written
+# before treatment_codes existed
+LEGACY_TREATMENT_KEYWORDS = [
+    (TX_SALINE, ("ล้างจมูกด้วยน้ำเกลือ", "saline")),
+    (TX_ORAL_AH, ("ฮิสตามีน", "antihistamine")),
+    (TX_LTRA, ("leukotriene", "ltra")),
+    (TX_INCS_STANDARD, ("sprays/nostril วันละครั้ง",)),
+    (TX_INCS_HIGH, ("เพิ่มขนาดยา",)),
+    (TX_REFERRAL, ("ส่งพบแพทย์", "refer")),
+    (TX_IMMUNOTHERAPY, ("ภูมิคุ้มกัน",)),
+    (TX_SURGERY, ("ผ่าตัด",)),
+]
+
+# ---------------- Doctor stats summary ---------------- #
+# stats_summary holds one counter per (metric, bucket), describing each
+# patient's latest symptoms row, so doctor_stats never scans symptoms.
+COMBO_BUCKETS = {
+    ("intermittent", "mild"): "im_mild",
+    ("intermittent", "modsev"): "im_mod",
+    ("persistent", "mild"): "per_mild",
+    ("persistent", "modsev"): "per_mod",
+}
+
+TREATMENT_STAT_MASKS = {
+    "oral_antihistamine": TX_ORAL_AH,
+    "incs": TX_INCS_STANDARD | TX_INCS_HIGH,
+    "ltra": TX_LTRA,
+    "saline": TX_SALINE,
+    "referral": TX_REFERRAL | TX_SURGERY,
+}
+
+def vas_bucket(avg_vas):
+    # round() halves to even, as the original stats page did; the SQL in
+    # rebuild_stats_summary rounds double precision the same way
+    return min(10, max(0, round(avg_vas)))
+
+def stat_treatments(treatment_codes):
+    codes = treatment_codes or 0
+    return [name for name, mask in TREATMENT_STAT_MASKS.items() if codes & mask]
+
+def latest_symptom_buckets(row):
+    pattern = (row["pattern"] or "").lower()
+    avg_vas = float(row["avg_vas"]) if row["avg_vas"] is not None else 0.0
+    severity = "mild" if avg_vas < 5 else "modsev"
+
+    buckets = [("vas", str(vas_bucket(avg_vas)))]
+    if (pattern, severity) in COMBO_BUCKETS:
+        buckets.append(("combo", COMBO_BUCKETS[(pattern, severity)]))
+    buckets += [("treatment", t) for t in stat_treatments(row["treatment_codes"])]
+    return buckets
+
+BUMP_STATS_SQL = """
+    INSERT INTO stats_summary (metric, bucket, count)
+    SELECT * FROM unnest(%s::text[], %s::text[], %s::int[])
+    ON CONFLICT (metric, bucket)
+    DO UPDATE SET count = stats_summary.count + EXCLUDED.count
+"""
+
+
+def stats_deltas(added=(), removed=()):
+    """BUMP_STATS_SQL parameters for the given buckets, or None if they cancel out."""
+    deltas = Counter(added)
+    deltas.subtract(removed)
+    rows = [(metric, bucket, n) for (metric, bucket), n in deltas.items() if n]
+    if not rows:
+        return None
+    return [list(column) for column in zip(*rows)]
+
+
+def bump_stats(cur, added=(), removed=()):
+    params = stats_deltas(added, removed)
+    if params:
+        cur.execute(BUMP_STATS_SQL, params)
+
+def rebuild_stats_summary(cur):
+    cur.execute("DELETE FROM stats_summary")
 
-    # gender breakdown
     cur.execute("""
-        SELECT COALESCE(p.gender, 'unknown') AS gender, COUNT(*) AS c
+        INSERT INTO stats_summary (metric, bucket, count)
+        SELECT 'gender', COALESCE(NULLIF(p.gender, ''), 'unknown'), COUNT(*)
         FROM users u
         LEFT JOIN patient_profiles p ON u.id = p.user_id
         WHERE u.role = 'patient'
-        GROUP BY COALESCE(p.gender, 'unknown')
+        GROUP BY 2
     """)
-    gender_rows = cur.fetchall()
-    genders = {r["gender"] or "unknown": r["c"] for r in gender_rows}
 
-    # latest symptom row per patient
-    cur.execute("""
-        SELECT s.*
-        FROM symptoms s
-        WHERE s.id IN (
-            SELECT MAX(id)
+    # same rules as latest_symptom_buckets, evaluated in the database
+    treatment_values = ", ".join(["(%s, %s)"] * len(TREATMENT_STAT_MASKS))
+    treatment_params = [v for item in TREATMENT_STAT_MASKS.items() for v in item]
+
+    cur.execute(f"""
+        WITH latest AS (
+            SELECT DISTINCT ON (user_id)
+                LOWER(COALESCE(pattern, '')) AS pattern,
+                COALESCE(avg_vas, 0) AS avg_vas,
+                COALESCE(treatment_codes, 0) AS codes
             FROM symptoms
-            GROUP BY user_id
+            ORDER BY user_id, id DESC
+        ),
+        buckets AS (
+            SELECT 'vas' AS metric,
+                   LEAST(10, GREATEST(0, ROUND(avg_vas::float8)))::int::text AS bucket
+            FROM latest
+            UNION ALL
+            SELECT 'combo',
+                   CASE pattern WHEN 'intermittent' THEN 'im_' WHEN 'persistent' THEN 'per_' END
+                   || CASE WHEN avg_vas < 5 THEN 'mild' ELSE 'mod' END
+            FROM latest
+            UNION ALL
+            SELECT 'treatment', t.name
+            FROM latest
+            CROSS JOIN (VALUES {treatment_values}) AS t(name, mask)
+            WHERE latest.codes & t.mask <> 0
         )
-    """)
-    latest_rows = cur.fetchall()
-
-    conn.close()
-
-    # compute combos and treatment / VAS counts in Python
-    im_mild = im_mod = per_mild = per_mod = 0
-    treatments = {
-        "oral_antihistamine": 0,
-        "incs": 0,
-        "ltra": 0,
-        "saline": 0,
-        "referral": 0
-    }
-    vas_counts = [0] * 11  # 0..10
+        INSERT INTO stats_summary (metric, bucket, count)
+        SELECT metric, bucket, COUNT(*)
+        FROM buckets
+        WHERE bucket IS NOT NULL
+        GROUP BY metric, bucket
+    """, treatment_params)
+
+@cli_command("rebuild-stats")
+def rebuild_stats_command():
+    """Recompute stats_summary from users and symptoms."""
+    conn = get_db()
+    cur = conn.cursor()
+    rebuild_stats_summary(cur)
+    conn.commit()
+    note = invalidate_cache_from_cli()
+    cur.close()
+    print("✅ stats_summary rebuilt")
+    if note:
+        print(f"   {note}")
 
-    for r in latest_rows:
-        pattern = (r["pattern"] or "").lower()
-        avg_vas = float(r["avg_vas"]) if r["avg_vas"] is not None else 0.0
-        severity = "mild" if avg_vas < 5 else "modsev"
 
-        if pattern == "intermittent":
-            if severity == "mild":
-                im_mild += 1
-            else:
-                im_mod += 1
-        elif pattern == "persistent":
-            if severity == "mild":
-                per_mild += 1
-            else:
-                per_mod += 1
-
-        rec = (r["recommendation"] or "").lower()
-        if "ฮิสตามีน" in rec or "antihistamine" in rec or "oral_ah" in rec:
-            treatments["oral_antihistamine"] += 1
-        if "สเตียรอยด์" in rec or "steroid" in rec or "incs" in rec:
-            treatments["incs"] += 1
-        if "leukotriene" in rec or "ltra" in rec or "leuko" in rec:
-            treatments["ltra"] += 1
-        if "ล้างจมูกด้วยน้ำเกลือ" in rec or "normal saline" in rec or "saline" in rec:
-            treatments["saline"] += 1
-        if "ส่งพบแพทย์" in rec or "refer" in rec or "ผ่าตัด" in rec:
-            treatments["referral"] += 1
-
-        v = int(round(avg_vas))
-        if v < 0:
-            v = 0
-        if v > 10:
-            v = 10
-        vas_counts[v] += 1
-
-    combo_counts = [im_mild, im_mod, per_mild, per_mod]
+# ---------------- Re-scoring ---------------- #
+RESCORED_FIELDS = ("pattern", "recommendation", "treatment_codes", "follow_up")
 
-    return render_template(
-        "doctor_stats.html",
-        total_patients=total_patients,
-        genders=genders,
-        combo_counts=combo_counts,
-        treatments=treatments,
-        vas_counts=vas_counts
+
+def rescore_rows(rows, state):
+    """Replay the follow-up chain over rows in (user_id, created_at) order.
+
+    ``state`` carries (user_id, follow_up) across calls, so a patient may
+    span batches. Yields (row, recomputed values) for every row.
+    """
+    user_id, follow_up = state
+    for row in rows:
+        if row["user_id"] != user_id:
+            user_id, follow_up = row["user_id"], 0
+
+        freq = row["symptom_frequency"]
+        pattern = classify_pattern(freq) if freq is not None else row["pattern"]
+        used_steroid = "yes" if row["used_steroid_before"] else "no"
+        decision = decide(follow_up, pattern, row["avg_vas"], used_steroid)
+        follow_up = decision.next_follow_up
+        yield row, (pattern, decision.recommendation, decision.codes, follow_up)
+    state[:] = [user_id, follow_up]
+
+
+@cli_command("rescore")
+@click.option("--dry-run", is_flag=True, help="report what would change, write nothing")
+@click.option("--diff", "diff_path", type=click.Path(dir_okay=False),
+              help="write every change as CSV (symptom_id, field, old, new)")
+@click.option("--batch-size", default=5000, show_default=True)
+@click.option("--restart", is_flag=True, help="start over instead of resuming an unfinished run")
+def rescore_command(dry_run, diff_path, batch_size, restart):
+    """Recompute pattern, recommendation, treatment codes and follow-up
+    state for every symptoms row with the current guideline."""
+    conn = get_db()
+    cur = conn.cursor()
+
+    run_id, after_user = None, 0
+    if not dry_run:
+        cur.execute("""
+            SELECT id, last_user_id FROM rescore_runs
+            WHERE finished_at IS NULL
+            ORDER BY id DESC
+            LIMIT 1
+        """)
+        run = cur.fetchone()
+        if run and not restart:
+            run_id, after_user = run["id"], run["last_user_id"]
+            print(f"↩️ resuming after patient {after_user}")
+        else:
+            cur.execute("UPDATE rescore_runs SET finished_at = NOW() WHERE finished_at IS NULL")
+            cur.execute("INSERT INTO rescore_runs DEFAULT VALUES RETURNING id")
+            run_id = cur.fetchone()["id"]
+        conn.commit()
+
+    # WITH HOLD keeps the cursor open across the per-batch commits
+    rows = conn.cursor(name="rescore_symptoms", withhold=True)
+    rows.itersize = batch_size
+    rows.execute("""
+        SELECT id, user_id, avg_vas, pattern, recommendation, treatment_codes, follow_up,
+               symptom_frequency, used_steroid_before
+        FROM symptoms
+        WHERE user_id > %s AND avg_vas IS NOT NULL
+        ORDER BY user_id, created_at, id
+    """, (after_user,))
+
+    diff_file = open(diff_path, "w", newline="", encoding="utf-8") if diff_path else None
+    diff = csv.writer(diff_file) if diff_file else None
+    if diff:
+        diff.writerow(["symptom_id", "field", "old", "new"])
+
+    state = [None, 0]
+    seen = changed = 0
+    field_changes = Counter()
+    started = time.monotonic()
+    try:
+        while True:
+            batch = rows.fetchmany(batch_size)
+            if not batch:
+                break
+
+            updates = []
+            for row, values in rescore_rows(batch, state):
+                old = tuple(row[f] for f in RESCORED_FIELDS)
+                if old == values:
+                    continue
+                updates.append((row["id"], *values))
+                for field, before, after in zip(RESCORED_FIELDS, old, values):
+                    if before != after:
+                        field_changes[field] += 1
+                        if diff:
+                            diff.writerow([row["id"], field, before, after])
+            seen += len(batch)
+            changed += len(updates)
+
+            if not dry_run:
+                if updates:
+                    execute_values(cur, """
+                        UPDATE symptoms s
+                        SET pattern = v.pattern,
+                            recommendation = v.recommendation,
+                            treatment_codes = v.treatment_codes,
+                            follow_up = v.follow_up
+                        FROM (VALUES %s) AS v(id, pattern, recommendation, treatment_codes, follow_up)
+                        WHERE s.id = v.id
+                    """, updates, template="(%s, %s, %s, %s::smallint, %s)", page_size=1000)
+                # the last patient may continue in the next batch, so the
+                # checkpoint is the one before it; redoing it is harmless
+                finished_user = max(
+                    (r["user_id"] for r in batch if r["user_id"] != state[0]),
+                    default=after_user
+                )
+                after_user = max(after_user, finished_user)
+                cur.execute("""
+                    UPDATE rescore_runs
+                    SET last_user_id = %s, rows_seen = rows_seen + %s,
+                        rows_changed = rows_changed + %s, updated_at = NOW()
+                    WHERE id = %s
+                """, (after_user, len(batch), len(updates), run_id))
+                conn.commit()
+
+            elapsed = time.monotonic() - started
+            print(f"… {seen} rows, {changed} changed, {seen / elapsed:.0f} rows/s")
+    finally:
+        rows.close()
+        if diff_file:
+            diff_file.close()
+
+    elapsed = time.monotonic() - started
+    summary = ", ".join(f"{field} {n}" for field, n in field_changes.most_common()) or "nothing"
+    if dry_run:
+        conn.rollback()
+        print(f"🔎 dry run: {changed} of {seen} rows would change ({summary}) in {elapsed:.1f}s")
+        return
+
+    rebuild_stats_summary(cur)
+    cur.execute("UPDATE rescore_runs SET finished_at = NOW() WHERE id = %s", (run_id,))
+    conn.commit()
+    note = invalidate_cache_from_cli()
+    cur.close()
+    print(f"✅ {changed} of {seen} rows rescored ({summary}) in {elapsed:.1f}s, "
+          f"{seen / max(elapsed, 1e-9):.0f} rows/s; stats rebuilt")
+    if note:
+        print(f"   {note}")
+
+
+# ---------------- Bulk patient import ---------------- #
+STAGING_COLUMNS = ("line_no", "username", "password", "full_name") + PROFILE_FIELDS + HISTORY_COLUMNS
+
+
+def read_patient_records(path):
+    """Yield (record number, MultiDict or None, error or None) from a .csv
+    or .jsonl file. Fields are named like the signup form; in JSONL a
+    multi-select field (family_asthma, ...) may be a list."""
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.endswith((".jsonl", ".ndjson")):
+            n = 0
+            for line in f:
+                if not line.strip():
+                    continue
+                n += 1
+                try:
+                    record = json.loads(line)
+                    if not isinstance(record, dict):
+                        raise ValueError("expected a JSON object")
+                except ValueError as e:
+                    yield n, None, f"bad JSON: {e}"
+                    continue
+                yield n, MultiDict({k: v for k, v in record.items() if v is not None}), None
+        else:
+            for n, record in enumerate(csv.DictReader(f), start=1):
+                yield n, MultiDict(record), None
+
+
+def prepare_patient(form):
+    """Validate one record and map it to staging values (password still in
+    clear text). Raises ValueError."""
+    for field in ("username", "password", "full_name"):
+        if not form.get(field):
+            raise ValueError(f"{field} is required")
+
+    profile = [form.get(field) or None for field in PROFILE_FIELDS]
+    dob = PROFILE_FIELDS.index("dob")
+    if profile[dob]:
+        try:
+            profile[dob] = datetime.fromisoformat(str(profile[dob])).date()
+        except ValueError:
+            raise ValueError(f"dob: not a date: {profile[dob]!r}")
+
+    history = build_history_data(form)
+    return [form["username"], form["password"], form["full_name"], *profile, *history.values()]
+
+
+def copy_text(value):
+    """Encode one value for COPY ... FROM STDIN (text format)."""
+    if value is None:
+        return "\\N"
+    if value is True or value is False:
+        return "t" if value else "f"
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
     )
 
-# ---------- Patient Detail ---------- #
-@app.route("/patient/<int:patient_id>")
-def patient_detail(patient_id):
-    if session.get("role") != "doctor":
-        return redirect(url_for("login"))
 
+def load_patient_batch(cur, rows):
+    """COPY staged rows in and move them to users, patient_profiles and
+    patient_history with set-based inserts. Returns the staged rows whose
+    username was already taken, as [(line_no, username)]."""
+    profile_columns = ", ".join(PROFILE_FIELDS)
+    history_columns = ", ".join(HISTORY_COLUMNS)
+
+    # shaped after the real tables, emptied by every commit
+    cur.execute(f"""
+        CREATE TEMP TABLE IF NOT EXISTS import_staging ON COMMIT DELETE ROWS AS
+        SELECT 0 AS line_no, u.id AS user_id, u.username, u.password, u.full_name,
+               {", ".join("p." + c for c in PROFILE_FIELDS)},
+               {", ".join("h." + c for c in HISTORY_COLUMNS)}
+        FROM users u, patient_profiles p, patient_history h
+        WITH NO DATA
+    """)
+
+    buf = io.StringIO()
+    for row in rows:
+        buf.write("\t".join(map(copy_text, row)))
+        buf.write("\n")
+    buf.seek(0)
+    cur.copy_expert(f"COPY import_staging ({', '.join(STAGING_COLUMNS)}) FROM STDIN", buf)
+
+    cur.execute("""
+        WITH new_users AS (
+            INSERT INTO users (username, password, role, full_name)
+            SELECT username, password, 'patient', full_name
+            FROM import_staging
+            ORDER BY line_no
+            ON CONFLICT (username) DO NOTHING
+            RETURNING id, username
+        )
+        UPDATE import_staging s
+        SET user_id = n.id
+        FROM new_users n
+        WHERE s.username = n.username
+    """)
+    cur.execute(f"""
+        INSERT INTO patient_profiles (user_id, {profile_columns})
+        SELECT user_id, {profile_columns}
+        FROM import_staging
+        WHERE user_id IS NOT NULL
+    """)
+    cur.execute(f"""
+        INSERT INTO patient_history (user_id, {history_columns})
+        SELECT user_id, {history_columns}
+        FROM import_staging
+        WHERE user_id IS NOT NULL
+    """)
+
+    cur.execute("""
+        SELECT COALESCE(gender, 'unknown') AS gender, COUNT(*) AS n
+        FROM import_staging
+        WHERE user_id IS NOT NULL
+        GROUP BY 1
+    """)
+    bump_stats(cur, added=Counter({("gender", r["gender"]): r["n"] for r in cur.fetchall()}))
+
+    cur.execute("""
+        SELECT line_no, username FROM import_staging
+        WHERE user_id IS NULL
+        ORDER BY line_no
+    """)
+    return [(r["line_no"], r["username"]) for r in cur.fetchall()]
+
+
+def file_fingerprint(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+@cli_command("import-patients")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--batch-size", default=1000, show_default=True, help="records per transaction")
+@click.option("--workers", type=int, default=None, help="password hashing processes [default: CPU count]")
+@click.option("--errors", "errors_path", type=click.Path(dir_okay=False),
+              help="CSV report of rejected records [default: PATH.errors.csv]")
+@click.option("--restart", is_flag=True, help="import the file again even if it was imported before")
+def import_patients_command(path, batch_size, workers, errors_path, restart):
+    """Bulk-create patient accounts from a CSV or JSONL file.
+
+    Progress is committed after every batch; running the same file again
+    resumes after the last committed batch.
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    errors_path = errors_path or path + ".errors.csv"
+    hash_password = partial(generate_password_hash, method=current_app.config["PASSWORD_HASH_METHOD"])
     conn = get_db()
     cur = conn.cursor()
 
-    # patient + profile + history
     cur.execute("""
-        SELECT 
+        INSERT INTO import_runs (source, fingerprint)
+        VALUES (%s, %s)
+        ON CONFLICT (fingerprint) DO UPDATE SET source = EXCLUDED.source
+        RETURNING id, records_done, finished_at
+    """, (os.path.abspath(path), file_fingerprint(path)))
+    run = cur.fetchone()
+    if run["finished_at"] and not restart:
+        conn.rollback()
+        print(f"⚠️ {path} was already imported on {run['finished_at']:%Y-%m-%d %H:%M} (use --restart)")
+        return
+    if restart:
+        cur.execute("""
+            UPDATE import_runs
+            SET records_done = 0, imported = 0, rejected = 0,
+                started_at = NOW(), updated_at = NOW(), finished_at = NULL
+            WHERE id = %s
+        """, (run["id"],))
+        run["records_done"] = 0
+    conn.commit()
+
+    done = run["records_done"]
+    if done:
+        print(f"↩️ resuming after record {done}")
+
+    records = itertools.islice(read_patient_records(path), done, None)
+    imported = rejected = 0
+    note = None
+    started = time.monotonic()
+    # spawn, not fork: the workers must not inherit this process's DB socket
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool, \
+            open(errors_path, "a" if done else "w", newline="", encoding="utf-8") as error_file:
+        report = csv.writer(error_file)
+        if not done:
+            report.writerow(["record", "username", "error"])
+
+        while True:
+            batch = list(itertools.islice(records, batch_size))
+            if not batch:
+                break
+
+            rows, failures, seen = [], [], set()
+            for n, form, error in batch:
+                username = form.get("username") if form else None
+                if error is None:
+                    try:
+                        row = prepare_patient(form)
+                        if username in seen:
+                            raise ValueError("username appears twice in this batch")
+                    except ValueError as e:
+                        error = str(e)
+                if error:
+                    failures.append((n, username, error))
+                    continue
+                seen.add(username)
+                rows.append([n, *row])
+
+            chunk = max(1, len(rows) // ((workers or os.cpu_count() or 1) * 4))
+            hashes = pool.map(hash_password, [r[2] for r in rows], chunksize=chunk)
+            for row, hashed in zip(rows, hashes):
+                row[2] = hashed
+
+            taken = load_patient_batch(cur, rows) if rows else []
+            failures += [(n, username, "username already exists") for n, username in taken]
+            imported += len(rows) - len(taken)
+            rejected += len(failures)
+
+            cur.execute("""
+                UPDATE import_runs
+                SET records_done = %s, imported = imported + %s, rejected = rejected + %s,
+                    updated_at = NOW()
+                WHERE id = %s
+            """, (batch[-1][0], len(rows) - len(taken), len(failures), run["id"]))
+            conn.commit()
+            if len(rows) > len(taken):
+                note = invalidate_cache_from_cli()
+
+            report.writerows(sorted(failures))
+            error_file.flush()
+            print(f"… {batch[-1][0]} records read, {imported} imported, {rejected} rejected")
+
+    cur.execute("UPDATE import_runs SET finished_at = NOW() WHERE id = %s", (run["id"],))
+    conn.commit()
+    cur.close()
+
+    elapsed = time.monotonic() - started
+    print(f"✅ {imported} patients imported, {rejected} rejected in {elapsed:.1f}s")
+    if rejected:
+        print(f"   see {errors_path}")
+    if note:
+        print(f"   {note}")
+
+
+# ---------------- Research export ---------------- #
+EXPORT_COLUMNS = (
+    "symptom_id", "user_id", "created_at", "tnss", "avg_vas", "pattern",
+    "follow_up", "medicine_effect", "treatment_codes",
+) + FORM_COLUMN_NAMES
+
+
+def export_filters(date_from=None, date_to=None, pattern=None, treatment=None):
+    """WHERE clause and params over symptoms ``s``. date_to is inclusive."""
+    where, params = ["TRUE"], []
+    if date_from:
+        where.append("s.created_at >= %s")
+        params.append(date_from)
+    if date_to:
+        where.append("s.created_at < %s")
+        params.append(date_to + timedelta(days=1))
+    if pattern:
+        where.append("s.pattern = %s")
+        params.append(pattern)
+    if treatment:
+        where.append("s.treatment_codes = ANY(%s)")
+        params.append(codes_with(TREATMENT_CODES[treatment]))
+    return " AND ".join(where), params
+
+
+def export_rows(conn, batch_size, **filters):
+    """Yield the header, then batches of row tuples, for the export.
+
+    Rows come from a server-side cursor, so memory use doesn't grow with the
+    result. raw_form is flattened in the query into one column per known
+    form field (RAW_FORM_KEYS); anything else it holds (answers that could
+    not be typed, fields the form no longer has) goes to form.other as JSON.
+    The columns are fixed, so the export is a single pass in one statement.
+    """
+    where, params = export_filters(**filters)
+
+    form_keys = sorted(RAW_FORM_KEYS, key=str.lower)
+    yield (EXPORT_COLUMNS + tuple("form." + k for k in form_keys) + ("form.other",)
+           + HISTORY_COLUMNS)
+
+    form_columns = "".join(", s.raw_form ->> %s" for _ in form_keys)
+    history_columns = "".join(", h." + c for c in HISTORY_COLUMNS)
+    # plain tuple cursor: no per-row dicts for millions of rows
+    cur = conn.cursor(name="export_symptoms", cursor_factory=psycopg2.extensions.cursor)
+    cur.itersize = batch_size
+    cur.execute(f"""
+        SELECT s.id, s.user_id, s.created_at, s.tnss, s.avg_vas, s.pattern,
+               s.follow_up, s.medicine_effect, s.treatment_codes,
+               {", ".join("s." + c for c in FORM_COLUMN_NAMES)}
+               {form_columns},
+               CASE WHEN jsonb_typeof(s.raw_form) = 'object'
+                    THEN NULLIF(s.raw_form - %s::text[], '{{}}'::jsonb)::text
+                    ELSE s.raw_form::text
+               END
+               {history_columns}
+        FROM symptoms s
+        LEFT JOIN patient_history h ON h.user_id = s.user_id
+        WHERE {where}
+        ORDER BY s.id
+    """, [RAW_FORM_KEYS[k] for k in form_keys] + [list(RAW_FORM_KEYS.values())] + params)
+    try:
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        cur.close()
+        conn.rollback()
+
+
+def export_csv_chunks(conn, batch_size, **filters):
+    """export_rows() encoded as CSV text, one chunk per batch."""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    rows = export_rows(conn, batch_size, **filters)
+    writer.writerow(next(rows))
+    for batch in rows:
+        writer.writerows(batch)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
+
+
+def write_parquet(path, conn, batch_size, **filters):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise click.ClickException("Parquet export needs pyarrow (pip install pyarrow)")
+
+    rows = export_rows(conn, batch_size, **filters)
+    header = next(rows)
+    types = {
+        "symptom_id": pa.int32(), "user_id": pa.int32(), "created_at": pa.timestamp("us"),
+        "tnss": pa.int32(), "avg_vas": pa.float32(), "follow_up": pa.int32(),
+        "medicine_effect": pa.int32(), "treatment_codes": pa.int16(),
+        "cigarettes_per_day": pa.int32(), "quit_years": pa.int32(),
+    }
+    kinds = {float: pa.float32(), int: pa.int16(), bool: pa.bool_()}
+    types.update((column, kinds[kind]) for _, column, kind in FORM_COLUMNS)
+    history = build_history_data(MultiDict())
+    schema = pa.schema([
+        (name, types.get(name)
+         or (pa.bool_() if isinstance(history.get(name), bool) else pa.string()))
+        for name in header
+    ])
+
+    total = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        for batch in rows:
+            columns = list(zip(*batch))
+            writer.write_batch(pa.record_batch(
+                [pa.array(col, type=field.type) for col, field in zip(columns, schema)],
+                schema=schema
+            ))
+            total += len(batch)
+    return total
+
+
+@cli_command("export-symptoms")
+@click.argument("path", type=click.Path(dir_okay=False, writable=True))
+@click.option("--from", "date_from", type=click.DateTime(["%Y-%m-%d"]), help="first report day")
+@click.option("--to", "date_to", type=click.DateTime(["%Y-%m-%d"]), help="last report day (inclusive)")
+@click.option("--pattern", type=click.Choice(["intermittent", "persistent"]))
+@click.option("--treatment", type=click.Choice(list(TREATMENT_CODES)))
+@click.option("--format", "fmt", type=click.Choice(["csv", "parquet"]),
+              help="[default: from the file extension]")
+def export_symptoms_command(path, date_from, date_to, pattern, treatment, fmt):
+    """Export symptom reports joined with patient history to CSV or Parquet."""
+    fmt = fmt or ("parquet" if path.endswith(".parquet") else "csv")
+    filters = dict(
+        date_from=date_from and date_from.date(),
+        date_to=date_to and date_to.date(),
+        pattern=pattern,
+        treatment=treatment,
+    )
+    batch_size = current_app.config["EXPORT_BATCH_SIZE"]
+
+    started = time.monotonic()
+    if fmt == "parquet":
+        total = write_parquet(path, get_db(), batch_size, **filters)
+    else:
+        total = 0
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            rows = export_rows(get_db(), batch_size, **filters)
+            writer.writerow(next(rows))
+            for batch in rows:
+                writer.writerows(batch)
+                total += len(batch)
+    print(f"✅ {total} rows written to {path} in {time.monotonic() - started:.1f}s")
+
+
+# ---------------- Routes ---------------- #
+
+@route("/", methods=["GET"])
+def index():
+    return redirect(url_for("welcome"))
+
+@route("/welcome")
+def welcome():
+    return render_template("welcome.html")
+
+# ---------- Login ---------- #
+@route("/login", methods=["GET", "POST"])
+def login():
+    if request.method == "POST":
+        conn = get_db()
+        cur = conn.cursor()
+
+        cur.execute(
+            "SELECT * FROM users WHERE username = %s",
+            (request.form["username"],)
+        )
+        user = cur.fetchone()
+
+        hasher = get_hash_pool()
+        if user and hasher.verify(user["password"], request.form["password"]):
+            # hashes made under older cost settings are upgraded on login
+            if hasher.needs_rehash(user["password"]):
+                cur.execute(
+                    "UPDATE users SET password = %s WHERE id = %s",
+                    (hasher.hash(request.form["password"]), user["id"])
+                )
+                conn.commit()
+
+            session["user_id"] = user["id"]
+            session["role"] = user["role"]
+            return redirect(
+                url_for("doctor_dashboard" if user["role"] == "doctor" else "patient_form")
+            )
+
+        flash(_("Invalid login"), "danger")
+
+    return render_template("login.html")
+
+# ---------- Signup ---------- #
+@route("/signup", methods=["GET", "POST"])
+def signup():
+    if request.method == "POST":
+        conn = get_db()
+        cur = conn.cursor()
+
+        try:
+            role = request.form["role"]
+
+            # 0️⃣ CHECK DOCTOR CODE
+            if role == "doctor":
+                if request.form.get("doctor_code") != "SECRET123":
+                    flash(_("Invalid doctor signup code"), "danger")
+                    return redirect(url_for("signup"))
+
+            # 1️⃣ CREATE USER (RETURNING id is REQUIRED for PostgreSQL)
+            cur.execute(
+                """
+                INSERT INTO users (username, password, role, full_name)
+                VALUES (%s, %s, %s, %s)
+                RETURNING id
+                """,
+                (
+                    request.form["username"],
+                    get_hash_pool().hash(request.form["password"]),
+                    role,
+                    request.form["full_name"]
+                )
+            )
+            user_id = cur.fetchone()["id"]
+
+            # 2️⃣ PATIENT PROFILE
+            if role == "patient":
+                cur.execute(
+                    """
+                    INSERT INTO patient_profiles
+                    (user_id, email, phone, address, dob, gender,
+                     emergency_contact, insurance_provider, hospital_number, locale)
+                    VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
+                    """,
+                    (
+                        user_id,
+                        request.form.get("email"),
+                        request.form.get("phone"),
+                        request.form.get("address"),
+                        request.form.get("dob"),
+                        request.form.get("gender"),
+                        request.form.get("emergency_contact"),
+                        request.form.get("insurance_provider"),
+                        request.form.get("hospital_number"),
+                        current_locale()
+                    )
+                )
+
+                bump_stats(cur, added=[("gender", request.form.get("gender") or "unknown")])
+
+                # 3️⃣ PATIENT HISTORY
+                history_data = build_history_data(request.form)
+
+                columns = ", ".join(history_data.keys())
+                placeholders = ", ".join(["%s"] * len(history_data))
+
+                cur.execute(
+                    f"""
+                    INSERT INTO patient_history (user_id, {columns})
+                    VALUES (%s, {placeholders})
+                    """,
+                    (user_id, *history_data.values())
+                )
+
+            conn.commit()
+            if role == "patient":
+                get_cache().invalidate()
+
+            flash(
+                _("Signup successful. Please log in and complete the assessment form."),
+                "success"
+            )
+            return redirect(url_for("login"))
+
+        except HashPoolBusy:
+            conn.rollback()
+            raise  # 503 + Retry-After from hash_pool_busy
+        except Exception as e:
+            conn.rollback()
+            flash(_("Signup error: %(error)s", error=e), "danger")
+
+    return render_template("signup.html")
+
+# ---------- Doctor Dashboard ---------- #
+def dashboard_page_query(args, page_size):
+    """(sql, params, filters) for one dashboard page from the request args."""
+    query = args.get("query", "").strip()
+    after_name = args.get("after_name")
+    after_id = args.get("after_id", type=int)
+
+    where = ["u.role = 'patient'"]
+    params = {"limit": page_size + 1}
+
+    if query:
+        # name/email by substring (trigram indexes), phone/HN by prefix
+        where.append("""u.id IN (
+            SELECT id FROM users WHERE full_name ILIKE %(contains)s
+            UNION
+            SELECT user_id FROM patient_profiles
+            WHERE email ILIKE %(contains)s
+               OR phone LIKE %(prefix)s
+               OR hospital_number LIKE %(prefix)s
+        )""")
+        params["contains"] = "%" + like_escape(query) + "%"
+        params["prefix"] = like_escape(query) + "%"
+
+    treatment = args.get("treatment", "")
+    if treatment in TREATMENT_CODES:
+        # patients whose latest report carries this treatment code
+        where.append("""u.id IN (
+            SELECT s.user_id FROM symptoms s
+            WHERE s.treatment_codes = ANY(%(codes)s)
+              AND NOT EXISTS (
+                  SELECT 1 FROM symptoms n
+                  WHERE n.user_id = s.user_id AND n.id > s.id
+              )
+        )""")
+        params["codes"] = codes_with(TREATMENT_CODES[treatment])
+    else:
+        treatment = ""
+
+    if after_name is not None and after_id is not None:
+        where.append("(COALESCE(u.full_name, ''), u.id) > (%(after_name)s, %(after_id)s)")
+        params["after_name"] = after_name
+        params["after_id"] = after_id
+
+    sql = f"""
+        SELECT
             u.id,
             u.full_name,
-
-            -- profile
-            p.email,
             p.phone,
-            p.address,
-            p.dob,
-            p.gender,
-            p.emergency_contact,
-            p.insurance_provider,
-            p.hospital_number,
-
-            -- history
-            h.symptom_year_pattern,
-            h.season_summer, h.season_rainy, h.season_winter,
-            h.season_summer_rainy, h.season_rainy_winter, h.season_uncertain,
-            h.duration_per_year, h.weekly_frequency,
-            h.time_6_12, h.time_12_18, h.time_18_24, h.time_24_6, h.time_all_day, h.time_uncertain,
-            h.living_area, h.near_road, h.housing_type, h.air_conditioner,
-            h.pet_cat, h.pet_dog, h.pet_bird, h.pet_other,
-            h.trigger_dust, h.trigger_pollen, h.trigger_animal,
-            h.trigger_smoke, h.trigger_cold_air, h.trigger_pollution, h.trigger_stress, h.trigger_other,
-            h.smoking_status, h.cigarettes_per_day, h.quit_years, h.secondhand_smoke,
-            h.drug_allergy, h.drug_allergy_name, h.drug_allergy_symptom,
-            h.food_allergy, h.food_allergy_name, h.food_allergy_symptom,
-            h.natural_allergy, h.natural_allergy_symptom,
-            h.family_asthma, h.family_rhinitis, h.family_allergic_conjunctivitis, h.family_atopic_dermatitis,
-            h.work_performance, h.physical_activity_problem, h.stairs_problem,
-            h.work_less_physical, h.work_careful_physical,
-            h.work_less_emotional, h.work_careless_emotional,
-            h.daily_activity_limit,
-            h.feel_calm, h.feel_energetic, h.feel_sad, h.social_limit
+            p.email,
+            COALESCE(p.record_count, 0) AS record_count
         FROM users u
         LEFT JOIN patient_profiles p ON u.id = p.user_id
-        LEFT JOIN patient_history h ON u.id = h.user_id
-        WHERE u.id = %s
-    """, (patient_id,))
-    patient = cur.fetchone()
+        WHERE {" AND ".join(where)}
+        ORDER BY COALESCE(u.full_name, ''), u.id
+        LIMIT %(limit)s
+    """
+    filters = {"query": query, "treatment": treatment, "is_first_page": after_id is None}
+    return sql, params, filters
+
+
+def dashboard_context(patients, page_size, filters):
+    next_page = None
+    if len(patients) > page_size:
+        patients = patients[:page_size]
+        last = patients[-1]
+        next_page = {"after_name": last["full_name"] or "", "after_id": last["id"]}
+
+    return dict(
+        filters,
+        patients=patients,
+        treatments=list(TREATMENT_CODES),
+        next_page=next_page,
+    )
 
-    # all symptom rows
-    cur.execute("""
-        SELECT * FROM symptoms
-        WHERE user_id = %s
-        ORDER BY created_at DESC
-    """, (patient_id,))
+
+@route("/doctor_dashboard")
+def doctor_dashboard():
+    if session.get("role") != "doctor":
+        return redirect(url_for("login"))
+
+    page_size = current_app.config["DASHBOARD_PAGE_SIZE"]
+    sql, params, filters = dashboard_page_query(request.args, page_size)
+
+    def load_page():
+        cur = get_db().cursor()
+        cur.execute(sql, params)
+        rows = [dict(r) for r in cur.fetchall()]
+        cur.close()
+        return rows
+
+    patients = get_cache().fetch(
+        "doctor_dashboard", json.dumps(params, sort_keys=True), load_page
+    )
+    return render_template("doctor_dashboard.html", **dashboard_context(patients, page_size, filters))
+
+
+## ---------- Doctor Stats ---------- #
+@route("/doctor_stats")
+def doctor_stats():
+    if session.get("role") != "doctor":
+        return redirect(url_for("login"))
+
+    return render_template("doctor_stats.html", **get_cache().fetch("doctor_stats", "", load_stats))
+
+
+STATS_SQL = "SELECT metric, bucket, count FROM stats_summary WHERE count <> 0"
+
+
+def load_stats():
+    cur = get_db().cursor()
+    cur.execute(STATS_SQL)
     rows = cur.fetchall()
+    cur.close()
+    return stats_context(rows)
 
-    # VAS rows (date-wise)
-    cur.execute("""
-        SELECT DATE(created_at) AS date, avg_vas, recommendation
-        FROM symptoms
-        WHERE user_id = %s
-        ORDER BY DATE(created_at)
-    """, (patient_id,))
-    vas_rows = cur.fetchall()
 
-    conn.close()
+def stats_context(rows):
+    counts = {(r["metric"], r["bucket"]): r["count"] for r in rows}
+
+    genders = {b: n for (metric, b), n in counts.items() if metric == "gender"}
+    total_patients = sum(genders.values())
+    combo_counts = [
+        counts.get(("combo", b), 0)
+        for b in ("im_mild", "im_mod", "per_mild", "per_mod")
+    ]
+    treatments = {t: counts.get(("treatment", t), 0) for t in TREATMENT_STAT_MASKS}
+    vas_counts = [counts.get(("vas", str(v)), 0) for v in range(11)]  # 0..10
 
+    return dict(
+        total_patients=total_patients,
+        genders=genders,
+        combo_counts=combo_counts,
+        treatments=treatments,
+        vas_counts=vas_counts
+    )
+
+# ---------- Patient Detail ---------- #
+# patient + profile + history
+PATIENT_DETAIL_SQL = """
+    SELECT 
+        u.id,
+        u.full_name,
+
+        -- profile
+        p.email,
+        p.phone,
+        p.address,
+        p.dob,
+        p.gender,
+        p.emergency_contact,
+        p.insurance_provider,
+        p.hospital_number,
+
+        -- history
+        h.symptom_year_pattern,
+        h.season_summer, h.season_rainy, h.season_winter,
+        h.season_summer_rainy, h.season_rainy_winter, h.season_uncertain,
+        h.duration_per_year, h.weekly_frequency,
+        h.time_6_12, h.time_12_18, h.time_18_24, h.time_24_6, h.time_all_day, h.time_uncertain,
+        h.living_area, h.near_road, h.housing_type, h.air_conditioner,
+        h.pet_cat, h.pet_dog, h.pet_bird, h.pet_other,
+        h.trigger_dust, h.trigger_pollen, h.trigger_animal,
+        h.trigger_smoke, h.trigger_cold_air, h.trigger_pollution, h.trigger_stress, h.trigger_other,
+        h.smoking_status, h.cigarettes_per_day, h.quit_years, h.secondhand_smoke,
+        h.drug_allergy, h.drug_allergy_name, h.drug_allergy_symptom,
+        h.food_allergy, h.food_allergy_name, h.food_allergy_symptom,
+        h.natural_allergy, h.natural_allergy_symptom,
+        h.family_asthma, h.family_rhinitis, h.family_allergic_conjunctivitis, h.family_atopic_dermatitis,
+        h.work_performance, h.physical_activity_problem, h.stairs_problem,
+        h.work_less_physical, h.work_careful_physical,
+        h.work_less_emotional, h.work_careless_emotional,
+        h.daily_activity_limit,
+        h.feel_calm, h.feel_energetic, h.feel_sad, h.social_limit
+    FROM users u
+    LEFT JOIN patient_profiles p ON u.id = p.user_id
+    LEFT JOIN patient_history h ON u.id = h.user_id
+    WHERE u.id = %(patient_id)s
+"""
+
+# symptom rows, newest first; raw_form only for the most recent few, the
+# rest is fetched by the page when a report is opened
+PATIENT_REPORTS_SQL = """
+    SELECT
+        id, created_at, tnss, pattern, avg_vas, follow_up, recommendation, {form_columns},
+        CASE WHEN ROW_NUMBER() OVER (ORDER BY created_at DESC) <= %(raw_form_rows)s
+             THEN COALESCE(raw_form, '{{}}'::jsonb)
+        END AS raw_form
+    FROM symptoms
+    WHERE user_id = %(patient_id)s
+    ORDER BY created_at DESC
+""".format(form_columns=", ".join(FORM_COLUMN_NAMES))
+
+
+def detail_context(patient, rows, locale):
     reports = [{
+        "id": r["id"],
         "created_at": r["created_at"],
         "tnss": r["tnss"],
         "pattern": r["pattern"],
         "avg_vas": r["avg_vas"],
         "follow_up": r["follow_up"],
-        "recommendation": r["recommendation"],
-        "data": r["raw_form"] if r["raw_form"] else {}
+        "recommendation": localize_recommendation(r["recommendation"], locale),
+        "data": expand_form(r) if r["raw_form"] is not None else None
     } for r in rows]
 
-    return render_template(
-        "patient_detail.html",
+    # chart series, oldest first
+    vas_rows = [{
+        "date": r["created_at"].date(),
+        "avg_vas": r["avg_vas"],
+        "recommendation": localize_recommendation(r["recommendation"], locale)
+    } for r in reversed(rows)]
+
+    return dict(
         patient=patient,
+        history=history_rows(patient),
         reports=reports,
         vas_rows=vas_rows
     )
 
-# ---------- Patient Form ---------- #
-@app.route("/patient_form", methods=["GET", "POST"])
-def patient_form():
-    if "user_id" not in session:
+
+@route("/patient/<int:patient_id>")
+def patient_detail(patient_id):
+    if session.get("role") != "doctor":
         return redirect(url_for("login"))
 
-    conn = get_db()
-    cur = conn.cursor()
+    params = {
+        "patient_id": patient_id,
+        "raw_form_rows": current_app.config["DETAIL_RAW_FORM_ROWS"],
+    }
+    cur = get_db().cursor()
+    cur.execute(PATIENT_DETAIL_SQL, params)
+    patient = cur.fetchone()
+    cur.execute(PATIENT_REPORTS_SQL, params)
+    rows = cur.fetchall()
+    cur.close()
 
-    # latest record
-    cur.execute("""
-        SELECT * FROM symptoms
-        WHERE user_id = %s
-        ORDER BY created_at DESC
-        LIMIT 1
-    """, (session["user_id"],))
-    last = cur.fetchone()
+    return render_template("patient_detail.html", **detail_context(patient, rows, current_locale()))
 
-    follow_up = last["follow_up"] if last else 0
-    need_followup = follow_up in (1, 2)
-    next_allowed = None
 
-    if last:
-        last_date = last["created_at"]  # already datetime
-        next_allowed = last_date + timedelta(days=14)
+@route("/patient/<int:patient_id>/reports/<int:report_id>/form")
+def patient_report_form(patient_id, report_id):
+    if session.get("role") != "doctor":
+        return redirect(url_for("login"))
 
-    # ---------- POST ----------
-    if request.method == "POST":
-        report_date = datetime.fromisoformat(request.form["report_date"])
+    cur = get_db().cursor()
+    cur.execute(f"""
+        SELECT raw_form, {", ".join(FORM_COLUMN_NAMES)} FROM symptoms
+        WHERE id = %s AND user_id = %s
+    """, (report_id, patient_id))
+    row = cur.fetchone()
+    cur.close()
+    if row is None:
+        return jsonify(error="not found"), 404
 
-        if last and report_date < next_allowed:
-            flash(f"กรอกได้อีกครั้งวันที่ {next_allowed:%Y-%m-%d}", "warning")
-            return redirect(url_for("patient_form"))
+    return jsonify(expand_form(row))
 
-        freq = int(request.form["symptom_frequency"])
-        avg_vas = (float(request.form["vas_score1"])+float(request.form["vas_score2"])+float(request.form["vas_score3"]))/3
-        pattern = classify_pattern(freq)
-        used_steroid = request.form.get("used_steroid_before", "no")
-        prev_follow_up = follow_up
-
-        tnss = (
-            int(request.form.get("Frequently sneeze", 0)) +
-            int(request.form.get("Stuffed nose", 0)) +
-            int(request.form.get("runny nose", 0)) +
-            int(request.form.get("itchy nose", 0))
-        )
+# ---------- Patient Form ---------- #
+# locking the user row serialises submissions from the same patient, so a
+# double submit can't slip past the 14-day gate; the lock is held until the
+# submission commits. The latest row is read by a separate statement so that
+# it sees whatever the previous lock holder wrote.
+LOCK_PATIENT_SQL = "SELECT id FROM users WHERE id = %(user_id)s FOR UPDATE"
+
+LATEST_REPORT_SQL = """
+    SELECT id, created_at, follow_up, pattern, avg_vas, treatment_codes, recommendation
+    FROM symptoms
+    WHERE user_id = %(user_id)s
+    ORDER BY created_at DESC
+    LIMIT 1
+"""
+
+# previous row's medicine_effect, record_count and the new row in one round
+# trip; no reminder due date when the patient has no email to send it to
+SUBMIT_REPORT_SQL = """
+    WITH effect AS (
+        UPDATE symptoms SET medicine_effect = %(medicine_effect)s::integer
+        WHERE id = %(last_id)s AND %(medicine_effect)s::integer IS NOT NULL
+    ), counted AS (
+        UPDATE patient_profiles SET record_count = record_count + 1
+        WHERE user_id = %(user_id)s
+    )
+    INSERT INTO symptoms
+    (user_id, avg_vas, tnss, pattern, recommendation, treatment_codes,
+    follow_up, created_at, submitted_at, reminder_due_at, raw_form, medicine_effect,
+    {columns})
+    VALUES (%(user_id)s, %(avg_vas)s, %(tnss)s, %(pattern)s, %(recommendation)s,
+            %(treatment_codes)s, %(follow_up)s, %(created_at)s,
+            NOW(),
+            CASE WHEN EXISTS (
+                SELECT 1 FROM patient_profiles
+                WHERE user_id = %(user_id)s AND email IS NOT NULL
+            ) THEN NOW() + INTERVAL '14 days' END,
+            %(raw_form)s, NULL,
+            {values})
+    RETURNING id, created_at, follow_up, pattern, avg_vas, recommendation
+""".format(
+    columns=", ".join(FORM_COLUMN_NAMES),
+    values=", ".join(f"%({column})s" for column in FORM_COLUMN_NAMES),
+)
+
+PATIENT_CARD_SQL = """
+    SELECT 
+        u.full_name,
+        p.email,
+        p.phone,
+        p.gender,
+        p.dob,
+        p.address
+    FROM users u
+    LEFT JOIN patient_profiles p ON u.id = p.user_id
+    WHERE u.id = %(user_id)s
+"""
+
+# a patient's reports older than a given one, newest first
+REPORT_HISTORY_SQL = """
+    SELECT id, created_at, avg_vas, pattern, recommendation
+    FROM symptoms
+    WHERE user_id = %(user_id)s AND (created_at, id) < (%(before_created)s, %(before_id)s)
+    ORDER BY created_at DESC, id DESC
+    LIMIT %(limit)s
+"""
+
+
+def next_allowed_date(last):
+    return last["created_at"] + timedelta(days=14) if last else None
+
+
+def submission_params(form, last, user_id, report_date):
+    """SUBMIT_REPORT_SQL parameters for a submitted assessment form."""
+    freq = int(form["symptom_frequency"])
+    avg_vas = (float(form["vas_score1"])+float(form["vas_score2"])+float(form["vas_score3"]))/3
+    pattern = classify_pattern(freq)
+    used_steroid = form.get("used_steroid_before", "no")
+    prev_follow_up = last["follow_up"] if last else 0
+
+    tnss = (
+        int(form.get("Frequently sneeze", 0)) +
+        int(form.get("Stuffed nose", 0)) +
+        int(form.get("runny nose", 0)) +
+        int(form.get("itchy nose", 0))
+    )
 
-        # 1️⃣ recommendation first
-        recommendation = generate_recommendation(
-            pattern, avg_vas, prev_follow_up, used_steroid
-        )
+    recommendation, treatment_codes, next_follow_up = decide(
+        prev_follow_up, pattern, avg_vas, used_steroid
+    )
 
-        # 2️⃣ follow-up logic
-        next_follow_up = prev_follow_up
-        if avg_vas < 5 and pattern == "intermittent":
-            next_follow_up = 0
-        elif prev_follow_up == 0 and avg_vas >= 5:
-            next_follow_up = 1
-        elif prev_follow_up == 1 and avg_vas >= 5:
-            next_follow_up = 2 if used_steroid == "yes" else 1
-        elif prev_follow_up == 2 and avg_vas >= 5:
-            next_follow_up = 3
-
-        # Create dictionary from form data and explicitly add VAS scores
-        form_data = {k: request.form.get(k) for k in request.form}
-        form_data['vas_score1'] = request.form.get('vas_score1')
-        form_data['vas_score2'] = request.form.get('vas_score2')
-        form_data['vas_score3'] = request.form.get('vas_score3')
-        raw_form = json.dumps(form_data)
-
-
-        # ----- medicine_effect: update previous row -----
-        medicine_effect_answer = request.form.get("medicine_effect")
-        if last and medicine_effect_answer:
-            try:
-                me_val = int(medicine_effect_answer)
-                cur.execute(
-                    "UPDATE symptoms SET medicine_effect = %s WHERE id = %s",
-                    (me_val, last["id"])
-                )
-            except ValueError:
-                pass
+    # ----- medicine_effect: answer about the previous row -----
+    medicine_effect = None
+    if last and form.get("medicine_effect"):
+        try:
+            medicine_effect = int(form["medicine_effect"])
+        except ValueError:
+            pass
+
+    return {
+        "medicine_effect": medicine_effect,
+        "last_id": last["id"] if last else None,
+        "user_id": user_id,
+        "avg_vas": avg_vas,
+        "tnss": tnss,
+        "pattern": pattern,
+        "recommendation": recommendation,
+        "treatment_codes": treatment_codes,
+        "follow_up": next_follow_up,
+        "created_at": report_date.isoformat(),  # patient date stays
+        "raw_form": json.dumps(compact_form(form)),
+        **form_column_values(form),
+    }
 
-        # insert new record
-        cur.execute("""
-                        INSERT INTO symptoms
-                        (user_id, avg_vas, tnss, pattern, recommendation,
-                        follow_up, created_at, submitted_at, raw_form, medicine_effect)
-                        VALUES (%s,%s,%s,%s,%s,%s,%s,NOW(),%s,%s)
-                    """, (
-                        session["user_id"],
-                        avg_vas,
-                        tnss,
-                        pattern,
-                        recommendation,
-                        next_follow_up,
-                        report_date.isoformat(),  # patient date stays
-                        raw_form,
-                        None
-                    ))
-
-
-        flash("บันทึกข้อมูลเรียบร้อย ดูผลการประเมินที่หน้า Result", "success")
-        return redirect(url_for("patient_form", show_result="1"))
 
-    # ================= GET =================
-    cur.execute(
-        "SELECT * FROM symptoms WHERE user_id = %s ORDER BY created_at DESC",
-        (session["user_id"],)
-    )
-    reports = cur.fetchall()
+def submission_stats(submission, last):
+    """(added, removed) stats buckets: the new row replaces last as the latest."""
+    return latest_symptom_buckets(submission), latest_symptom_buckets(last) if last else ()
 
-    cur.execute("""
-        SELECT 
-            u.full_name,
-            p.email,
-            p.phone,
-            p.gender,
-            p.dob,
-            p.address
-        FROM users u
-        LEFT JOIN patient_profiles p ON u.id = p.user_id
-        WHERE u.id = %s
-    """, (session["user_id"],))
-    patient = cur.fetchone()
 
-    conn.close()
+def latest_report_for_session(inserted):
+    return dict(inserted, created_at=inserted["created_at"].isoformat())
+
 
-    show_medicine_effect_question = bool(last)
+def pop_latest_report(session):
+    """The row a POST just inserted, handed over to the GET that follows."""
+    last = session.pop("latest_report", None)
+    if last:
+        last["created_at"] = datetime.fromisoformat(last["created_at"])
+    return last
+
+
+def history_params(user_id, before, limit):
+    return {
+        "user_id": user_id,
+        "before_created": before["created_at"],
+        "before_id": before["id"],
+        "limit": limit + 1,
+    }
+
+
+def patient_form_context(patient, last, older, has_more, locale):
+    follow_up = last["follow_up"] if last else 0
+
+    reports = [
+        dict(r, recommendation=localize_recommendation(r["recommendation"], locale))
+        for r in ([last] + older if last else [])
+    ]
 
     latest_html = ""
-    if reports:
+    if last:
         r = reports[0]
         latest_html = Markup(
             f"<b>Date:</b> {r['created_at'].date()}<br>"
@@ -920,21 +3681,246 @@ def patient_form():
             f"<pre>{r['recommendation']}</pre>"
         )
 
-    return render_template(
-        "patient_form.html",
+    return dict(
         patient=patient,
         reports=reports,
+        history_next=reports[-1] if has_more else None,
         latest_html=latest_html,
         today=datetime.utcnow().strftime("%Y-%m-%d"),
-        need_followup=need_followup,
-        show_medicine_effect_question=show_medicine_effect_question
+        need_followup=follow_up in (1, 2),
+        show_medicine_effect_question=bool(last)
+    )
+
+
+@route("/patient_form", methods=["GET", "POST"])
+def patient_form():
+    if "user_id" not in session:
+        return redirect(url_for("login"))
+
+    conn = get_db()
+    cur = conn.cursor()
+    user_id = session["user_id"]
+    params = {"user_id": user_id}
+
+    # ---------- POST ----------
+    if request.method == "POST":
+        cur.execute(LOCK_PATIENT_SQL, params)
+        cur.execute(LATEST_REPORT_SQL, params)
+        last = cur.fetchone()
+
+        report_date = datetime.fromisoformat(request.form["report_date"])
+        next_allowed = next_allowed_date(last)
+        if last and report_date < next_allowed:
+            conn.rollback()
+            flash(_("You can submit again on %(date)s", date=f"{next_allowed:%Y-%m-%d}"), "warning")
+            return redirect(url_for("patient_form"))
+
+        submission = submission_params(request.form, last, user_id, report_date)
+        cur.execute(SUBMIT_REPORT_SQL, submission)
+        inserted = cur.fetchone()
+
+        bump_stats(cur, *submission_stats(submission, last))
+        conn.commit()
+        cur.close()
+        get_cache().invalidate()
+
+        session["latest_report"] = latest_report_for_session(inserted)
+        flash(_("Saved. See your assessment on the Result page."), "success")
+        return redirect(url_for("patient_form", show_result="1"))
+
+    # ================= GET =================
+    # right after a submission the POST hands over the row it inserted
+    last = pop_latest_report(session)
+    if not last:
+        cur.execute(LATEST_REPORT_SQL, params)
+        last = cur.fetchone()
+
+    # the latest row is already in hand; the rest of the history is paged
+    older, has_more = [], False
+    if last:
+        older, has_more = report_history(
+            cur, user_id, last, current_app.config["PATIENT_HISTORY_PAGE_SIZE"] - 1
+        )
+
+    cur.execute(PATIENT_CARD_SQL, params)
+    patient = cur.fetchone()
+    cur.close()
+
+    return render_template(
+        "patient_form.html",
+        **patient_form_context(patient, last, older, has_more, current_locale())
     )
 
+def report_history(cur, user_id, before, limit):
+    """Up to ``limit`` reports older than ``before`` (a row with created_at
+    and id), newest first. Returns (rows, has_more)."""
+    cur.execute(REPORT_HISTORY_SQL, history_params(user_id, before, limit))
+    rows = cur.fetchall()
+    return rows[:limit], len(rows) > limit
+
+
+@route("/patient_form/history")
+def patient_form_history():
+    if "user_id" not in session:
+        return redirect(url_for("login"))
+
+    try:
+        before = {
+            "created_at": datetime.fromisoformat(request.args["before_created"]),
+            "id": int(request.args["before_id"]),
+        }
+    except (KeyError, ValueError):
+        return jsonify(error="before_created and before_id are required"), 400
+
+    cur = get_db().cursor()
+    rows, has_more = report_history(
+        cur, session["user_id"], before, current_app.config["PATIENT_HISTORY_PAGE_SIZE"]
+    )
+    cur.close()
+
+    return jsonify(
+        reports=[{
+            "id": r["id"],
+            "created_at": r["created_at"].isoformat(),
+            "date": r["created_at"].strftime("%Y-%m-%d"),
+            "avg_vas": r["avg_vas"],
+            "pattern": r["pattern"],
+            "recommendation": localize_recommendation(r["recommendation"], current_locale()),
+        } for r in rows],
+        has_more=has_more
+    )
+
+# ---------- Research export ---------- #
+@route("/export/symptoms.csv")
+def export_symptoms():
+    if session.get("role") != "doctor":
+        return redirect(url_for("login"))
+
+    filters = dict(
+        pattern=request.args.get("pattern") or None,
+        treatment=request.args.get("treatment") or None,
+    )
+    try:
+        for arg, key in (("from", "date_from"), ("to", "date_to")):
+            value = request.args.get(arg)
+            filters[key] = date.fromisoformat(value) if value else None
+    except ValueError:
+        return jsonify(error="from/to must be YYYY-MM-DD"), 400
+    if filters["treatment"] and filters["treatment"] not in TREATMENT_CODES:
+        return jsonify(error="unknown treatment"), 400
+
+    chunks = export_csv_chunks(get_db(), current_app.config["EXPORT_BATCH_SIZE"], **filters)
+    return Response(
+        stream_with_context(chunks),
+        mimetype="text/csv",
+        headers={"Content-Disposition": f"attachment; filename=symptoms-{date.today()}.csv"}
+    )
+
+# ---------- DB pool stats ---------- #
+@route("/stats/db_pool")
+def db_pool_stats():
+    if session.get("role") != "doctor":
+        return redirect(url_for("login"))
+
+    return jsonify(get_pool().stats())
+
+# ---------- Cache stats ---------- #
+@route("/stats/cache")
+def cache_stats():
+    if session.get("role") != "doctor":
+        return redirect(url_for("login"))
+
+    return jsonify(get_cache().stats())
+
+# ---------- SQL profile ---------- #
+@route("/stats/sql")
+def sql_stats():
+    if session.get("role") != "doctor":
+        return redirect(url_for("login"))
+
+    order = request.args.get("order", "seconds")
+    if order not in ("seconds", "mean", "max", "calls", "rows"):
+        return jsonify(error="order must be seconds, mean, max, calls or rows"), 400
+    limit = request.args.get("limit", 20, type=int)
+
+    ms = 1000
+    return jsonify(
+        slow_ms=current_app.config["SQL_SLOW_MS"],
+        top=[{
+            "fingerprint": row["fingerprint"],
+            "query": row["query"],
+            "calls": row["calls"],
+            "total_ms": round(row["seconds"] * ms, 2),
+            "mean_ms": round(row["mean"] * ms, 3),
+            "max_ms": round(row["max"] * ms, 2),
+            "rows": row["rows"],
+            "endpoints": row["endpoints"],
+        } for row in sql_profile.top(limit, order)],
+        slow_samples=list(reversed(sql_profile.samples)),
+    )
+
+# ---------- Metrics ---------- #
+@route("/metrics")
+def metrics_export():
+    token = current_app.config["METRICS_TOKEN"]
+    if token and request.headers.get("Authorization") != f"Bearer {token}":
+        return Response("unauthorized\n", 401, mimetype="text/plain")
+
+    gauges = []
+    pool = current_app.extensions.get("db_pool")
+    if pool is not None and pool.pid == os.getpid():
+        stats = pool.stats()
+        gauges += [
+            ("db_pool_connections", (("state", "idle"),), stats["idle"]),
+            ("db_pool_connections", (("state", "in_use"),), stats["in_use"]),
+        ]
+    return Response(metrics.render(gauges), mimetype="text/plain; version=0.0.4")
+
 # ---------- Logout ---------- #
-@app.route("/logout")
+@route("/logout")
 def logout():
+    locale = session.get("locale")
     session.clear()
+    if locale:
+        session["locale"] = locale
     return redirect(url_for("login"))
 
+# ---------------- App factory ---------------- #
+def create_app(config=None):
+    """Build the Flask app.
+
+    Nothing here touches the database or starts threads: connections are
+    opened on first use, the schema version is checked on the first request
+    and the reminder scheduler starts then too. That keeps imports fast and
+    makes the app safe to build before gunicorn forks (--preload).
+    """
+    app = Flask(__name__)
+    app.secret_key = "very_secret_key_here"
+    app.config.update(default_config())
+    if config:
+        app.config.update(config)
+    configure_templates(app)
+    sql_profile.configure(app.config)
+
+    for rule, view, options in _routes:
+        app.add_url_rule(rule, view_func=view, **options)
+    for command in _commands:
+        app.cli.add_command(command)
+
+    # first, so that the timings cover the other hooks too
+    app.before_request(start_request_timings)
+    app.after_request(record_request_metrics)
+    before_render_template.connect(template_started, app)
+    template_rendered.connect(template_finished, app)
+    app.before_request(check_schema_version)
+    app.before_request(select_locale)
+    app.before_request(start_scheduler_once)
+    app.teardown_appcontext(release_db)
+    app.register_error_handler(HashPoolBusy, hash_pool_busy)
+    return app
+
+
+app = create_app()
+
 if __name__=="__main__":
     app.run(debug=True,port=5000)
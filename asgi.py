@@ -0,0 +1,261 @@
+# asgi.py
+"""Async serving mode (optional; `gunicorn app:app` stays the default).
+
+    pip install quart "psycopg[binary,pool]" asgiref hypercorn
+    hypercorn asgi:app
+
+The database-bound pages (patient detail, doctor dashboard, doctor stats
+and the patient form) are served by async views on a psycopg 3 connection
+pool, so one worker keeps many requests in flight while Postgres answers.
+Every other path goes to the regular Flask app through WsgiToAsgi. SQL,
+caching, translations and templates are the ones app.py uses.
+"""
+import asyncio
+import json
+import os
+from datetime import datetime
+
+try:
+    from asgiref.wsgi import WsgiToAsgi
+    from psycopg.rows import dict_row
+    from psycopg_pool import AsyncConnectionPool
+    from quart import Quart, current_app, flash, g, redirect, render_template, request, session, url_for
+except ImportError as e:
+    raise ImportError(
+        'the async mode needs: pip install quart "psycopg[binary,pool]" asgiref'
+    ) from e
+from werkzeug.exceptions import HTTPException
+
+import app as sync
+
+
+# ---------------- DB ---------------- #
+def get_async_pool():
+    return current_app.extensions["async_db_pool"]
+
+
+async def fetch_one(sql, params=None):
+    async with get_async_pool().connection() as conn:
+        cur = await conn.execute(sql, params)
+        return await cur.fetchone()
+
+
+async def fetch_all(sql, params=None):
+    async with get_async_pool().connection() as conn:
+        cur = await conn.execute(sql, params)
+        return await cur.fetchall()
+
+
+# ---------------- Translations ---------------- #
+def current_locale():
+    return g.get("locale") or current_app.config["DEFAULT_LOCALE"]
+
+
+def _(message, **params):
+    return sync.translate(current_locale(), message, **params)
+
+
+async def select_locale():
+    lang = request.args.get("lang")
+    if lang in sync.LOCALES:
+        session["locale"] = lang
+        if session.get("role") == "patient":
+            async with get_async_pool().connection() as conn:
+                await conn.execute(sync.REMEMBER_LOCALE_SQL, {"locale": lang, "user_id": session["user_id"]})
+    g.locale = sync.choose_locale(
+        lang, session.get("locale"), request.accept_languages, current_app.config["DEFAULT_LOCALE"]
+    )
+
+
+# ---------------- Views ---------------- #
+async def doctor_dashboard():
+    if session.get("role") != "doctor":
+        return redirect(url_for("login"))
+
+    page_size = current_app.config["DASHBOARD_PAGE_SIZE"]
+    sql, params, filters = sync.dashboard_page_query(request.args, page_size)
+
+    async def load_page():
+        return await fetch_all(sql, params)
+
+    patients = await current_app.extensions["cache"].fetch_async(
+        "doctor_dashboard", json.dumps(params, sort_keys=True), load_page
+    )
+    return await render_template(
+        "doctor_dashboard.html", **sync.dashboard_context(patients, page_size, filters)
+    )
+
+
+async def doctor_stats():
+    if session.get("role") != "doctor":
+        return redirect(url_for("login"))
+
+    async def load_stats():
+        return sync.stats_context(await fetch_all(sync.STATS_SQL))
+
+    stats = await current_app.extensions["cache"].fetch_async("doctor_stats", "", load_stats)
+    return await render_template("doctor_stats.html", **stats)
+
+
+async def patient_detail(patient_id):
+    if session.get("role") != "doctor":
+        return redirect(url_for("login"))
+
+    params = {
+        "patient_id": patient_id,
+        "raw_form_rows": current_app.config["DETAIL_RAW_FORM_ROWS"],
+    }
+    # independent queries, each on its own connection
+    patient, rows = await asyncio.gather(
+        fetch_one(sync.PATIENT_DETAIL_SQL, params),
+        fetch_all(sync.PATIENT_REPORTS_SQL, params),
+    )
+    return await render_template(
+        "patient_detail.html", **sync.detail_context(patient, rows, current_locale())
+    )
+
+
+async def report_history(user_id, before, limit):
+    rows = await fetch_all(sync.REPORT_HISTORY_SQL, sync.history_params(user_id, before, limit))
+    return rows[:limit], len(rows) > limit
+
+
+async def patient_form():
+    if "user_id" not in session:
+        return redirect(url_for("login"))
+
+    user_id = session["user_id"]
+    params = {"user_id": user_id}
+
+    # ---------- POST ----------
+    if request.method == "POST":
+        form = await request.form
+        report_date = datetime.fromisoformat(form["report_date"])
+
+        # one transaction, committed when the block exits
+        async with get_async_pool().connection() as conn:
+            await conn.execute(sync.LOCK_PATIENT_SQL, params)
+            last = await (await conn.execute(sync.LATEST_REPORT_SQL, params)).fetchone()
+
+            next_allowed = sync.next_allowed_date(last)
+            if last and report_date < next_allowed:
+                await conn.rollback()
+                await flash(_("You can submit again on %(date)s", date=f"{next_allowed:%Y-%m-%d}"), "warning")
+                return redirect(url_for("patient_form"))
+
+            submission = sync.submission_params(form, last, user_id, report_date)
+            inserted = await (await conn.execute(sync.SUBMIT_REPORT_SQL, submission)).fetchone()
+
+            deltas = sync.stats_deltas(*sync.submission_stats(submission, last))
+            if deltas:
+                await conn.execute(sync.BUMP_STATS_SQL, deltas)
+        current_app.extensions["cache"].invalidate()
+
+        session["latest_report"] = sync.latest_report_for_session(inserted)
+        await flash(_("Saved. See your assessment on the Result page."), "success")
+        return redirect(url_for("patient_form", show_result="1"))
+
+    # ================= GET =================
+    page_size = current_app.config["PATIENT_HISTORY_PAGE_SIZE"]
+    last = sync.pop_latest_report(session)
+    if last:
+        (older, has_more), patient = await asyncio.gather(
+            report_history(user_id, last, page_size - 1),
+            fetch_one(sync.PATIENT_CARD_SQL, params),
+        )
+    else:
+        last, patient = await asyncio.gather(
+            fetch_one(sync.LATEST_REPORT_SQL, params),
+            fetch_one(sync.PATIENT_CARD_SQL, params),
+        )
+        older, has_more = await report_history(user_id, last, page_size - 1) if last else ([], False)
+
+    return await render_template(
+        "patient_form.html",
+        **sync.patient_form_context(patient, last, older, has_more, current_locale())
+    )
+
+
+ASYNC_VIEWS = (
+    ("/doctor_dashboard", doctor_dashboard, ["GET"]),
+    ("/doctor_stats", doctor_stats, ["GET"]),
+    ("/patient/<int:patient_id>", patient_detail, ["GET"]),
+    ("/patient_form", patient_form, ["GET", "POST"]),
+)
+
+
+# ---------------- App ---------------- #
+class Dispatcher:
+    """ASGI entry point: async views for their paths, the Flask app for the rest."""
+
+    def __init__(self, web, flask_app):
+        self.web = web
+        self.flask_app = flask_app
+        self.wsgi = WsgiToAsgi(flask_app)
+        self.endpoints = {view.__name__ for rule, view, methods in ASYNC_VIEWS}
+        self.urls = web.url_map.bind("localhost")
+
+    def is_async(self, scope):
+        try:
+            endpoint, args = self.urls.match(scope["path"], scope["method"])
+        except HTTPException:
+            return False
+        return endpoint in self.endpoints
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan" or (scope["type"] == "http" and self.is_async(scope)):
+            await self.web(scope, receive, send)
+        else:
+            await self.wsgi(scope, receive, send)
+
+
+def create_asgi_app(config=None):
+    flask_app = sync.create_app(config)
+
+    web = Quart(__name__)
+    web.secret_key = flask_app.secret_key
+    web.config.update(flask_app.config)
+    # async templates compile to different code, so they get their own bytecode files
+    sync.configure_templates(web, locale=current_locale, bytecode_pattern="__jinja2_async_%s.cache")
+
+    for rule, view, methods in ASYNC_VIEWS:
+        web.add_url_rule(rule, view_func=view, methods=methods)
+    # url_for() in the shared templates also builds links to the Flask routes
+    taken = {rule.endpoint for rule in web.url_map.iter_rules()}
+    for rule in flask_app.url_map.iter_rules():
+        if rule.endpoint not in taken:
+            web.url_map.add(web.url_rule_class(rule.rule, endpoint=rule.endpoint, methods=rule.methods))
+
+    web.before_request(select_locale)
+
+    @web.before_serving
+    async def open_pool():
+        config = web.config
+        db_url = os.environ["DATABASE_URL"]
+        pool = AsyncConnectionPool(
+            db_url,
+            min_size=config["DB_POOL_MIN_SIZE"],
+            max_size=config["DB_POOL_MAX_SIZE"],
+            max_idle=config["DB_POOL_IDLE_TIMEOUT"],
+            timeout=config["DB_POOL_CHECKOUT_TIMEOUT"],
+            kwargs={"row_factory": dict_row, "sslmode": sync.db_sslmode(db_url)},
+            open=False,
+        )
+        await pool.open()
+        web.extensions["async_db_pool"] = pool
+
+        # what the Flask app does on its first request, done once up front;
+        # the cache object is shared so writes on either side invalidate it
+        with flask_app.app_context():
+            sync.check_schema_version()
+            sync.start_scheduler_once()
+            web.extensions["cache"] = sync.get_cache()
+
+    @web.after_serving
+    async def close_pool():
+        await web.extensions.pop("async_db_pool").close()
+
+    return Dispatcher(web, flask_app)
+
+
+app = create_asgi_app()
@@ -0,0 +1,917 @@
+# bench.py
+"""Small benchmarks for my_health_app.
+
+    python bench.py boot [--runs N]
+    python bench.py login [--requests N] [--concurrency N] [--method M]
+    python bench.py render [--renders N]
+    python bench.py i18n [--calls N]
+    python bench.py async [--requests N] [--concurrency N]
+    python bench.py seed [--symptoms N] [--reports N] [--seed N] [--reset]
+    python bench.py routes [--requests N] [--concurrency N] [--save FILE] [--compare FILE]
+
+Each benchmark prints a short report. Run them before and after a change
+and compare the numbers.
+"""
+import argparse
+import io
+import itertools
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# modules a web worker should not have to import just to serve pages
+DEFERRED_MODULES = ("smtplib", "email.mime.text", "apscheduler")
+
+
+# ---------------- boot ---------------- #
+BOOT_PROBE = """
+import json, sys, time
+t0 = time.perf_counter()
+import app
+t1 = time.perf_counter()
+app.create_app()
+t2 = time.perf_counter()
+print(json.dumps({
+    "import_ms": (t1 - t0) * 1000,
+    "create_app_ms": (t2 - t1) * 1000,
+    "loaded": [m for m in %r if m in sys.modules],
+}))
+""" % (DEFERRED_MODULES,)
+
+
+def bench_boot(args):
+    """Cold `import app` and create_app() time, each run in a fresh interpreter."""
+    env = dict(os.environ)
+    # importing the app must not need a database; prove it
+    env.pop("DATABASE_URL", None)
+    runs = []
+    for _ in range(args.runs):
+        out = subprocess.check_output([sys.executable, "-c", BOOT_PROBE], cwd=HERE, env=env)
+        runs.append(json.loads(out.decode().strip().splitlines()[-1]))
+
+    for key in ("import_ms", "create_app_ms"):
+        values = [r[key] for r in runs]
+        print(f"{key:14} median {statistics.median(values):8.2f}  "
+              f"min {min(values):8.2f}  max {max(values):8.2f}")
+    loaded = sorted({m for r in runs for m in r["loaded"]})
+    print("deferred modules loaded at boot:", ", ".join(loaded) or "none")
+
+
+def percentiles(values):
+    """p50/p95/p99 of a list of timings."""
+    if len(values) < 2:
+        return {"p50": values[0], "p95": values[0], "p99": values[0]} if values else {}
+    q = statistics.quantiles(values, n=100, method="inclusive")
+    return {"p50": q[49], "p95": q[94], "p99": q[98]}
+
+
+def load_app(config=None):
+    """The real app, against DATABASE_URL, with background work disabled."""
+    sys.path.insert(0, HERE)
+    import app as appmodule
+    return appmodule, appmodule.create_app(dict({"SCHEDULER_MODE": "off"}, **(config or {})))
+
+
+BENCH_PASSWORD = "bench-password"
+
+
+def bench_user(appmodule, username, role):
+    """Create (or reset) an account the benchmarks log in with; returns
+    (username, password). Needs an app context."""
+    from flask import current_app
+    from werkzeug.security import generate_password_hash
+
+    conn = appmodule.get_db()
+    cur = conn.cursor()
+    cur.execute("""
+        WITH account AS (
+            INSERT INTO users (username, password, role, full_name)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (username) DO UPDATE SET password = EXCLUDED.password
+            RETURNING id
+        )
+        INSERT INTO patient_profiles (user_id)
+        SELECT id FROM account WHERE %s = 'patient'
+        ON CONFLICT (user_id) DO NOTHING
+    """, (username, generate_password_hash(BENCH_PASSWORD, current_app.config["PASSWORD_HASH_METHOD"]),
+          role, username.replace("_", " ").title(), role))
+    conn.commit()
+    return username, BENCH_PASSWORD
+
+
+def session_cookie(app, account):
+    """Session cookie value of a logged-in account."""
+    username, password = account
+    client = app.test_client()
+    response = client.post("/login", data={"username": username, "password": password})
+    assert response.status_code == 302, f"could not log in as {username}"
+    return client.get_cookie("session").value
+
+
+# ---------------- login ---------------- #
+def bench_login(args):
+    """Concurrent logins against the real app (needs DATABASE_URL)."""
+    from werkzeug.security import generate_password_hash
+
+    config = {}
+    if args.method:
+        config["PASSWORD_HASH_METHOD"] = args.method
+    if args.hash_workers:
+        config["PASSWORD_HASH_WORKERS"] = args.hash_workers
+    appmodule, app = load_app(config)
+
+    username, password = "bench_login", "bench-password"
+    with app.app_context():
+        conn = appmodule.get_db()
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT INTO users (username, password, role, full_name)
+            VALUES (%s, %s, 'patient', 'Bench Login')
+            ON CONFLICT (username) DO UPDATE SET password = EXCLUDED.password
+        """, (username, generate_password_hash(password, app.config["PASSWORD_HASH_METHOD"])))
+        conn.commit()
+
+    def one(_):
+        client = app.test_client()
+        started = time.perf_counter()
+        response = client.post("/login", data={"username": username, "password": password})
+        return response.status_code, (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(one, range(args.requests)))
+    elapsed = time.perf_counter() - started
+
+    ok = [ms for status, ms in results if status == 302]
+    statuses = {}
+    for status, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    print(f"method {app.config['PASSWORD_HASH_METHOD']}, "
+          f"{app.config['PASSWORD_HASH_WORKERS']} hash workers, concurrency {args.concurrency}")
+    print(f"{args.requests} logins in {elapsed:.2f}s ({args.requests / elapsed:.1f}/s), statuses {statuses}")
+    for name, value in percentiles(ok).items():
+        print(f"{name}  {value:8.1f} ms")
+
+
+# ---------------- render ---------------- #
+def render_contexts(appmodule):
+    """Template name -> made-up context shaped like the real views'."""
+
+    now = datetime(2026, 1, 1, 9, 30)
+    patient = {key: "sample answer" for key in appmodule.HISTORY_COLUMNS}
+    patient.update(id=1, full_name="Bench Patient", email="bench@example.com", phone="0800000000",
+                   address="Bangkok", dob="1990-01-01", gender="female", emergency_contact=None,
+                   insurance_provider=None, hospital_number="HN1")
+    decision = appmodule.decide(0, "persistent", 6, "no")
+    assert decision.recommendation is not None, "no guideline row for the sample report"
+    reports = [{
+        "id": n, "created_at": now - timedelta(days=14 * n), "tnss": 7, "pattern": "persistent",
+        "avg_vas": 6.0, "follow_up": decision.next_follow_up,
+        "recommendation": decision.recommendation,
+        "data": {"vas_score1": "6", "symptom_frequency": "5"} if n < 5 else None,
+    } for n in range(20)]
+    return {
+        "signup.html": {},
+        "patient_form.html": dict(
+            patient=patient, reports=reports[:10], history_next=reports[9], latest_html=None,
+            today=now.strftime("%Y-%m-%d"), need_followup=True, show_medicine_effect_question=True),
+        "patient_detail.html": dict(
+            patient=patient, history=appmodule.history_rows(patient), reports=reports,
+            vas_rows=[{"date": r["created_at"].strftime("%Y-%m-%d"), "avg_vas": r["avg_vas"]} for r in reports]),
+    }
+
+
+def bench_render(args):
+    """Template load and render times; needs no database."""
+    sys.path.insert(0, HERE)
+    import app as appmodule
+    from flask import render_template
+
+    contexts = render_contexts(appmodule)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        # what a fresh worker pays to get its templates ready
+        print("first load of all templates (ms):")
+        for label, directory in (("no bytecode cache", ""), ("bytecode cache, cold", cache_dir),
+                                 ("bytecode cache, warm", cache_dir)):
+            app = appmodule.create_app({"SCHEDULER_MODE": "off", "TEMPLATE_CACHE_DIR": directory})
+            started = time.perf_counter()
+            for name in contexts:
+                app.jinja_env.get_template(name)
+            print(f"  {label:22} {(time.perf_counter() - started) * 1000:8.2f}")
+
+    print(f"render, {args.renders} times each (ms per render):")
+    for name, context in contexts.items():
+        line = f"  {name:20}"
+        for fragments in (False, True):
+            app = appmodule.create_app({"SCHEDULER_MODE": "off", "FRAGMENT_CACHE": fragments})
+            with app.test_request_context("/"):
+                render_template(name, **context)  # load the template and fill the fragment cache
+                timings = []
+                for _ in range(args.renders):
+                    started = time.perf_counter()
+                    render_template(name, **context)
+                    timings.append((time.perf_counter() - started) * 1000)
+            line += f"  fragments {'on ' if fragments else 'off'} p50 {percentiles(timings)['p50']:7.3f}"
+        print(line)
+
+
+# ---------------- i18n ---------------- #
+def bench_i18n(args):
+    """Cost of translating per request; needs no database."""
+    import timeit
+    from gettext import translation
+    from flask import g, render_template
+
+    sys.path.insert(0, HERE)
+    import app as appmodule
+
+    app = appmodule.create_app({"SCHEDULER_MODE": "off"})
+    message = "Invalid login"
+    stored = next(d.recommendation for d in appmodule.DECISIONS.values() if d.recommendation)
+    parts = appmodule.RECOMMENDATION_FRAGMENTS[stored]
+
+    def per_call(fn):
+        return timeit.timeit(fn, number=args.calls) / args.calls * 1e6
+
+    with app.test_request_context("/"):
+        g.locale = "en"
+        appmodule._(message)  # load the catalog once
+        rows = [
+            ("_() with the memoized catalog", lambda: appmodule._(message)),
+            ("_() finding the .mo every call", lambda: translation(
+                "messages", appmodule.TRANSLATIONS_DIR, ["en"], fallback=True).gettext(message)),
+            ("recommendation, pre-translated", lambda: appmodule.localize_recommendation(stored, "en")),
+            ("recommendation, joined per call", lambda: "".join(map(appmodule._, parts))),
+        ]
+        print(f"per call (us), {args.calls} calls:")
+        for label, fn in rows:
+            print(f"  {label:34} {per_call(fn):8.3f}")
+
+        print("login.html render (us):")
+        for locale in appmodule.LOCALES:
+            g.locale = locale
+            render_template("login.html")
+            print(f"  {locale:34} {per_call(lambda: render_template('login.html')):8.3f}")
+
+
+# ---------------- async ---------------- #
+ASYNC_PATHS = ("/patient/{patient_id}", "/doctor_dashboard?query=a", "/doctor_stats")
+
+
+def asgi_get(asgi_app, path, cookie):
+    """One GET straight through an ASGI app; returns (status, ms)."""
+    import asyncio
+
+    path, _, query = path.partition("?")
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+        "method": "GET", "scheme": "http", "path": path, "raw_path": path.encode(),
+        "query_string": query.encode(), "root_path": "",
+        "headers": [(b"host", b"localhost"), (b"cookie", cookie.encode())],
+        "client": ("127.0.0.1", 0), "server": ("localhost", 80),
+    }
+    status = []
+    requests = [{"type": "http.request", "body": b"", "more_body": False}]
+
+    async def receive():
+        if requests:
+            return requests.pop()
+        await asyncio.Event().wait()  # the client never disconnects
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            status.append(message["status"])
+
+    async def run():
+        started = time.perf_counter()
+        await asgi_app(scope, receive, send)
+        return status[0], (time.perf_counter() - started) * 1000
+
+    return asyncio.ensure_future(run())
+
+
+def bench_async(args):
+    """The same database-bound pages served sync (threads) and async (asgi.py)."""
+    import asyncio
+
+    # measure the database work, not the view cache; asgi.py builds its own
+    # app from the environment, so set it there
+    os.environ["CACHE_TTL"] = "0"
+    os.environ["SCHEDULER_MODE"] = "off"
+    appmodule, app = load_app()
+    with app.app_context():
+        doctor = bench_user(appmodule, "bench_doctor", "doctor")
+        conn = appmodule.get_db()
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT user_id FROM symptoms GROUP BY user_id
+            HAVING bool_and(pattern IS NOT NULL) ORDER BY COUNT(*) DESC LIMIT 1
+        """)
+        patient = cur.fetchone()
+        conn.commit()
+    if not patient:
+        sys.exit("no symptoms in the database to show; run the app and submit a few forms first")
+    paths = [p.format(patient_id=patient["user_id"]) for p in ASYNC_PATHS]
+
+    cookie = "session=" + session_cookie(app, doctor)
+
+    def report(label, results, elapsed):
+        statuses = {}
+        for status, _ in results:
+            statuses[status] = statuses.get(status, 0) + 1
+        timings = percentiles([ms for status, ms in results if status == 200])
+        print(f"  {label:6} {len(results) / elapsed:8.1f} req/s  "
+              f"p50 {timings.get('p50', 0):7.1f} ms  p95 {timings.get('p95', 0):7.1f} ms  statuses {statuses}")
+
+    print(f"{args.requests} requests per page, concurrency {args.concurrency}, cache off")
+    for path in paths:
+        print(path)
+
+        def one(_):
+            c = app.test_client()
+            c.set_cookie("session", cookie.partition("=")[2])
+            started = time.perf_counter()
+            response = c.get(path)
+            return response.status_code, (time.perf_counter() - started) * 1000
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            results = list(pool.map(one, range(args.requests)))
+        report("sync", results, time.perf_counter() - started)
+
+        import asgi
+
+        async def run_async():
+            await asgi.app.web.startup()
+            try:
+                limit = asyncio.Semaphore(args.concurrency)
+
+                async def limited():
+                    async with limit:
+                        return await asgi_get(asgi.app, path, cookie)
+
+                await limited()  # warm the pool and the templates
+                started = time.perf_counter()
+                results = await asyncio.gather(*(limited() for _ in range(args.requests)))
+                return results, time.perf_counter() - started
+            finally:
+                await asgi.app.web.shutdown()
+
+        report("async", *asyncio.run(run_async()))
+
+
+# ---------------- seed ---------------- #
+SEED_PREFIX = "seed_"
+SEED_PASSWORD = "seed-password"
+
+# answers picked at random for every seeded patient (signup form values)
+SEED_CHOICES = {
+    "gender": ("male", "female", "other"),
+    "symptom_year_pattern": ("all_year", "all_year_worse_season", "seasonal"),
+    "duration_per_year": ("<1", "1-4", ">4"),
+    "weekly_frequency": ("<3", ">=4"),
+    "living_area": ("urban", "suburban", "rural"),
+    "near_road": ("yes", "no"),
+    "housing_type": ("house", "townhouse", "commercial", "condo"),
+    "air_conditioner": ("yes", "no"),
+    "smoking_status": ("no", "no", "ex", "current"),
+    "drug_allergy": ("no", "no", "yes"),
+    "food_allergy": ("no", "no", "yes"),
+    "work_performance": ("excellent", "very_good", "good", "fair", "poor"),
+    "physical_activity_problem": ("none", "minor", "major"),
+    "stairs_problem": ("none", "minor", "major"),
+}
+SEED_FLAGS = (
+    "season_summer", "season_rainy", "season_winter", "time_6_12", "time_12_18",
+    "time_18_24", "time_24_6", "pet_cat", "pet_dog", "trigger_dust", "trigger_pollen",
+    "trigger_smoke", "trigger_cold_air", "trigger_pollution",
+)
+# 0-3 severity selects on the assessment form
+SEVERITY_FIELDS = (
+    "Frequently sneeze", "runny nose", "itchy nose", "Stuffed nose", "phlegm_throat",
+    "itchy_eyes", "watery_eyes", "chronic_cough", "itchy_throat", "sore_throat", "headache",
+    "dry_mouth", "fatigue", "snoring", "mouth_breathing", "poor_sleep",
+    "daytime_sleepiness", "loss_of_smell",
+)
+SYMPTOM_COLUMNS = (
+    "user_id", "tnss", "avg_vas", "pattern", "recommendation", "treatment_codes", "follow_up",
+    "created_at", "submitted_at", "reminder_due_at", "email_sent", "raw_form", "medicine_effect",
+)  # followed by app.FORM_COLUMN_NAMES
+
+
+def seed_signup_form(rng, n, password_hash):
+    """A filled-in signup form for seeded patient number n."""
+    from werkzeug.datastructures import MultiDict
+
+    form = MultiDict({
+        "username": f"{SEED_PREFIX}{n:07d}",
+        "password": password_hash,
+        "full_name": f"Seed Patient {n}",
+        "email": f"{SEED_PREFIX}{n}@example.invalid",
+        "phone": f"08{rng.randrange(10 ** 8):08d}",
+        "address": rng.choice(("Bangkok", "Nonthaburi", "Chiang Mai", "Khon Kaen")),
+        "dob": (date(1950, 1, 1) + timedelta(days=rng.randrange(55 * 365))).isoformat(),
+        "hospital_number": f"HN{n:07d}",
+    })
+    for field, choices in SEED_CHOICES.items():
+        form[field] = rng.choice(choices)
+    for flag in SEED_FLAGS:
+        if rng.random() < 0.3:
+            form[flag] = "on"
+    return form
+
+
+def seed_symptom_rows(appmodule, rng, user_id, reports, until):
+    """A patient's biweekly reports ending shortly before `until`, scored the
+    way patient_form scores them. Values are in SYMPTOM_COLUMNS +
+    FORM_COLUMN_NAMES order."""
+    rows = []
+    last = None
+    persistent = rng.random()  # how often this patient has symptoms
+    first = until - timedelta(days=14 * reports + rng.randrange(14))
+    for i in range(reports):
+        created = first + timedelta(days=14 * i, hours=rng.randrange(7, 22), minutes=rng.randrange(60))
+        form = {
+            "report_date": created.strftime("%Y-%m-%d"),
+            "symptom_frequency": str(min(7, max(0, round(rng.gauss(1 + 5 * persistent, 1.5))))),
+            **{f"vas_score{k}": str(round(min(10.0, max(0.0, rng.gauss(5, 2.5))), 1)) for k in (1, 2, 3)},
+            **{field: str(min(3, int(rng.expovariate(1.2)))) for field in SEVERITY_FIELDS},
+        }
+        if last:
+            form["used_steroid_before"] = rng.choice(("yes", "no"))
+            form["medicine_effect"] = str(rng.randint(-3, 3))
+        sub = appmodule.submission_params(form, last, user_id, created)
+        if last:
+            rows[-1][SYMPTOM_COLUMNS.index("medicine_effect")] = sub["medicine_effect"]
+        rows.append([
+            user_id, sub["tnss"], sub["avg_vas"], sub["pattern"], sub["recommendation"],
+            sub["treatment_codes"], sub["follow_up"], created, created, created + timedelta(days=14),
+            True, sub["raw_form"], None,
+            *(sub[column] for column in appmodule.FORM_COLUMN_NAMES),
+        ])
+        last = {"id": None, "follow_up": sub["follow_up"]}
+    if rows:
+        rows[-1][SYMPTOM_COLUMNS.index("email_sent")] = False  # only the latest is still pending
+    return rows
+
+
+def bench_seed(args):
+    """Fill DATABASE_URL with synthetic patients and their report histories."""
+    from flask import current_app
+    from werkzeug.security import generate_password_hash
+
+    appmodule, app = load_app()
+    rng = random.Random(args.seed)
+    until = datetime.combine(args.until, datetime.min.time())
+
+    with app.app_context():
+        conn = appmodule.get_db()
+        cur = conn.cursor()
+        if args.reset:
+            cur.execute("DELETE FROM users WHERE username LIKE %s", (SEED_PREFIX.replace("_", "\\_") + "%",))
+            print(f"removed {cur.rowcount} seeded patients")
+        else:
+            # seeding again adds patients after the existing ones
+            cur.execute("SELECT COUNT(*) AS n FROM users WHERE username LIKE %s",
+                        (SEED_PREFIX.replace("_", "\\_") + "%",))
+            first = cur.fetchone()["n"] + 1
+            # one hash for everyone: seeding is not a password hashing benchmark
+            password_hash = generate_password_hash(SEED_PASSWORD, current_app.config["PASSWORD_HASH_METHOD"])
+
+            started = time.perf_counter()
+            patients = symptoms = 0
+            numbers = itertools.count(first)
+            while symptoms < args.symptoms:
+                batch, sizes = [], {}
+                while len(batch) < args.batch_size and symptoms < args.symptoms:
+                    n = next(numbers)
+                    sizes[n] = min(rng.randint(1, 2 * args.reports - 1), args.symptoms - symptoms)
+                    symptoms += sizes[n]
+                    batch.append([n, *appmodule.prepare_patient(seed_signup_form(rng, n, password_hash))])
+                appmodule.load_patient_batch(cur, batch)
+
+                cur.execute("SELECT line_no, user_id FROM import_staging WHERE user_id IS NOT NULL")
+                user_ids = {r["line_no"]: r["user_id"] for r in cur.fetchall()}
+                buf = io.StringIO()
+                for n, user_id in user_ids.items():
+                    for row in seed_symptom_rows(appmodule, rng, user_id, sizes[n], until):
+                        buf.write("\t".join(map(appmodule.copy_text, row)))
+                        buf.write("\n")
+                buf.seek(0)
+                columns = SYMPTOM_COLUMNS + appmodule.FORM_COLUMN_NAMES
+                cur.copy_expert(f"COPY symptoms ({', '.join(columns)}) FROM STDIN", buf)
+                cur.execute("""
+                    UPDATE patient_profiles p SET record_count = c.n
+                    FROM (SELECT user_id, COUNT(*) AS n FROM symptoms
+                          WHERE user_id = ANY(%s) GROUP BY user_id) c
+                    WHERE p.user_id = c.user_id
+                """, (list(user_ids.values()),))
+                conn.commit()
+                patients += len(user_ids)
+                print(f"… {patients} patients, {symptoms} reports")
+            print(f"seeded {patients} patients and {symptoms} reports in {time.perf_counter() - started:.1f}s "
+                  f"(password {SEED_PASSWORD!r})")
+
+        appmodule.rebuild_stats_summary(cur)
+        cur.execute("ANALYZE users; ANALYZE patient_profiles; ANALYZE patient_history; ANALYZE symptoms")
+        conn.commit()
+        appmodule.get_cache().invalidate()
+
+
+# ---------------- routes ---------------- #
+class QueryCounter:
+    """Counts statements per thread through a cursor factory given to the pool."""
+
+    def __init__(self, base):
+        self.local = threading.local()
+        counter = self
+
+        class CountingCursor(base):
+            def execute(self, query, vars=None):
+                counter.add()
+                return super().execute(query, vars)
+
+            def executemany(self, query, vars_list):
+                counter.add()
+                return super().executemany(query, vars_list)
+
+            def copy_expert(self, sql, file, size=8192):
+                counter.add()
+                return super().copy_expert(sql, file, size)
+
+        self.cursor_factory = CountingCursor
+
+    def add(self):
+        self.local.n = getattr(self.local, "n", 0) + 1
+
+    def take(self):
+        n, self.local.n = getattr(self.local, "n", 0), 0
+        return n
+
+
+def route_scenarios(appmodule, app, concurrency):
+    """(name, method, path, form data factory, session cookie factory) per
+    route; the factories are called once per request."""
+    from werkzeug.datastructures import MultiDict
+
+    with app.app_context():
+        conn = appmodule.get_db()
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT u.id, u.username FROM users u JOIN symptoms s ON s.user_id = u.id
+            WHERE u.username LIKE %s
+            GROUP BY u.id ORDER BY COUNT(*) DESC, u.id LIMIT 1
+        """, (SEED_PREFIX.replace("_", "\\_") + "%",))
+        busiest = cur.fetchone()
+        if busiest is None:
+            sys.exit("no seeded patients; run `python bench.py seed` first")
+
+        doctor = bench_user(appmodule, "bench_doctor", "doctor")
+        # one submitting patient per client thread: a patient can only
+        # report every 14 days, so each one walks its own calendar
+        writers = [bench_user(appmodule, f"bench_patient_{i}", "patient") for i in range(concurrency)]
+        cur.execute("""
+            DELETE FROM symptoms WHERE user_id IN (SELECT id FROM users WHERE username = ANY(%s))
+        """, ([username for username, _ in writers],))
+        conn.commit()
+
+    cookies = {
+        "doctor": session_cookie(app, doctor),
+        "reader": session_cookie(app, (busiest["username"], SEED_PASSWORD)),
+    }
+    writer_cookies = [session_cookie(app, account) for account in writers]
+    writer_dates = [itertools.count() for _ in writers]
+    assigned = itertools.count()
+    local = threading.local()
+
+    def writer():
+        if not hasattr(local, "writer"):
+            local.writer = next(assigned) % len(writers)
+        return local.writer
+
+    def report_form():
+        form = MultiDict({
+            "report_date": (date(2000, 1, 1) + timedelta(days=14 * next(writer_dates[writer()]))).isoformat(),
+            "symptom_frequency": "5", "vas_score1": "6.5", "vas_score2": "4", "vas_score3": "7",
+            "used_steroid_before": "no", "medicine_effect": "1",
+        })
+        for field in SEVERITY_FIELDS:
+            form[field] = "1"
+        return form
+
+    signups = itertools.count()
+    run = f"{os.getpid()}_{int(time.time())}"
+
+    def signup_form():
+        n = next(signups)
+        return {"role": "patient", "username": f"bench_signup_{run}_{n}", "password": BENCH_PASSWORD,
+                "full_name": f"Bench Signup {n}", "gender": "female", "email": f"signup{n}@example.invalid"}
+
+    def no_form():
+        return None
+
+    def anonymous():
+        return None
+
+    def doctor_cookie():
+        return cookies["doctor"]
+
+    def reader_cookie():
+        return cookies["reader"]
+
+    def writer_cookie():
+        return writer_cookies[writer()]
+
+    return [
+        ("login", "POST", "/login",
+         lambda: {"username": busiest["username"], "password": SEED_PASSWORD}, anonymous),
+        ("signup", "POST", "/signup", signup_form, anonymous),
+        ("patient_form GET", "GET", "/patient_form", no_form, reader_cookie),
+        ("patient_form POST", "POST", "/patient_form", report_form, writer_cookie),
+        ("patient_detail", "GET", f"/patient/{busiest['id']}", no_form, doctor_cookie),
+        ("doctor_dashboard", "GET", "/doctor_dashboard", no_form, doctor_cookie),
+        ("doctor_dashboard search", "GET", "/doctor_dashboard?query=seed_00001", no_form, doctor_cookie),
+        ("doctor_stats", "GET", "/doctor_stats", no_form, doctor_cookie),
+    ]
+
+
+def summarize(results, elapsed):
+    """Latency percentiles, throughput and status counts of (status, ms) results."""
+    statuses = {}
+    for status, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    summary = {k: round(v, 2) for k, v in percentiles([ms for _, ms in results]).items()}
+    summary.update(rps=round(len(results) / elapsed, 1), statuses=statuses)
+    return summary
+
+
+def run_client(app, counter, scenario, requests):
+    """Sequential requests through the Flask test client, counting queries."""
+    name, method, path, form, cookie = scenario
+    client = app.test_client()
+    results, queries = [], []
+    for i in range(requests + 1):
+        client.delete_cookie("session")
+        if cookie():
+            client.set_cookie("session", cookie())
+        data = form()
+        counter.take()
+        started = time.perf_counter()
+        response = client.open(path, method=method, data=data)
+        ms = (time.perf_counter() - started) * 1000
+        if i:  # the first one warms up templates and the cache
+            results.append((response.status_code, ms))
+            queries.append(counter.take())
+    # one request at a time, so throughput is 1 / mean latency
+    summary = summarize(results, sum(ms for _, ms in results) / 1000)
+    summary["queries"] = round(statistics.mean(queries), 2)
+    return summary
+
+
+def run_http(base, scenario, requests, concurrency):
+    """Concurrent requests over real HTTP connections."""
+    import urllib.error
+    import urllib.parse
+    import urllib.request
+
+    class NoRedirect(urllib.request.HTTPRedirectHandler):
+        def redirect_request(self, *args, **kwargs):
+            return None
+
+    opener = urllib.request.build_opener(NoRedirect)
+    name, method, path, form, cookie = scenario
+
+    def one(_):
+        data = form()
+        body = urllib.parse.urlencode(list(data.items(multi=True)) if hasattr(data, "getlist") else data,
+                                      doseq=True).encode() if data is not None else None
+        headers = {"Cookie": "session=" + cookie()} if cookie() else {}
+        started = time.perf_counter()
+        try:
+            with opener.open(urllib.request.Request(base + path, body, headers, method=method)) as response:
+                response.read()
+                status = response.status
+        except urllib.error.HTTPError as e:
+            status = e.code
+        return status, (time.perf_counter() - started) * 1000
+
+    one(None)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(requests)))
+    return summarize(results, time.perf_counter() - started)
+
+
+def run_reminder_job(appmodule, app, counter, runs):
+    """check_two_weeks_passed() over every seeded patient's pending reminder.
+    Mail goes to a closed local port, so sending fails fast."""
+    like = SEED_PREFIX.replace("_", "\\_") + "%"
+    timings, queries = [], []
+    with app.app_context():
+        conn = appmodule.get_db()
+        cur = conn.cursor()
+        for _ in range(runs):
+            # put the seeded patients' latest reports back to "due"
+            cur.execute("""
+                WITH latest AS (
+                    SELECT DISTINCT ON (s.user_id) s.id
+                    FROM symptoms s JOIN users u ON u.id = s.user_id
+                    WHERE u.username LIKE %s
+                    ORDER BY s.user_id, s.created_at DESC, s.id DESC
+                ), cleared AS (
+                    DELETE FROM email_outbox WHERE symptom_id IN (SELECT id FROM latest)
+                )
+                UPDATE symptoms SET email_sent = FALSE, reminder_due_at = LEAST(reminder_due_at, NOW())
+                WHERE id IN (SELECT id FROM latest)
+            """, (like,))
+            due = cur.rowcount
+            conn.commit()
+            counter.take()
+            started = time.perf_counter()
+            appmodule.check_two_weeks_passed()
+            timings.append((time.perf_counter() - started) * 1000)
+            queries.append(counter.take())
+    summary = {k: round(v, 2) for k, v in percentiles(timings).items()}
+    summary.update(reminders=due, queries=round(statistics.mean(queries), 2))
+    return summary
+
+
+def table_counts(appmodule, app):
+    with app.app_context():
+        cur = appmodule.get_db().cursor()
+        counts = {}
+        for table in ("users", "patient_profiles", "patient_history", "symptoms"):
+            cur.execute(f"SELECT COUNT(*) AS n FROM {table}")
+            counts[table] = cur.fetchone()["n"]
+        cur.connection.rollback()
+        return counts
+
+
+def compare_runs(baseline, current, tolerance):
+    """Print current vs baseline; returns the regressions found."""
+    regressions = []
+    for name, modes in current["routes"].items():
+        for mode, now in modes.items():
+            before = baseline.get("routes", {}).get(name, {}).get(mode)
+            if not before:
+                continue
+            line = f"  {name:26} {mode:6}"
+            if "p95" in now and "p95" in before:
+                change = now["p95"] / before["p95"] - 1 if before["p95"] else 0.0
+                line += f"  p95 {before['p95']:8.1f} -> {now['p95']:8.1f} ms ({change:+.0%})"
+                if change > tolerance:
+                    regressions.append(f"{name} {mode}: p95 {change:+.0%}")
+            if "queries" in now and "queries" in before:
+                line += f"  queries {before['queries']:g} -> {now['queries']:g}"
+                if now["queries"] > before["queries"]:
+                    regressions.append(f"{name} {mode}: {now['queries']:g} queries, was {before['queries']:g}")
+            print(line)
+    return regressions
+
+
+def bench_routes(args):
+    """Every main route through the test client and over concurrent HTTP."""
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    config = {
+        # reminder mail goes nowhere, quickly
+        "SMTP_HOST": "127.0.0.1", "SMTP_PORT": 9, "SMTP_SSL": False,
+        # serving threads and pool sized for the load
+        "DB_POOL_MAX_SIZE": max(5, args.concurrency),
+    }
+    if args.no_cache:
+        config["CACHE_TTL"] = 0
+    appmodule, app = load_app(config)
+    with app.app_context():
+        connect_kwargs = appmodule.get_pool().connect_kwargs
+        counter = QueryCounter(connect_kwargs["cursor_factory"])
+        connect_kwargs["cursor_factory"] = counter.cursor_factory
+
+    scenarios = route_scenarios(appmodule, app, args.concurrency)
+    if args.only:
+        scenarios = [s for s in scenarios if s[0] in args.only]
+    run = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "rows": table_counts(appmodule, app),
+        "settings": {"requests": args.requests, "concurrency": args.concurrency,
+                     "cache": not args.no_cache, "pool": config["DB_POOL_MAX_SIZE"]},
+        "routes": {},
+    }
+    print(f"rows: {run['rows']}")
+    print(f"{args.requests} requests per route; http concurrency {args.concurrency}")
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server("127.0.0.1", 0, app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_port}"
+    try:
+        for scenario in scenarios:
+            name = scenario[0]
+            results = run["routes"][name] = {
+                "client": run_client(app, counter, scenario, args.requests),
+                "http": run_http(base, scenario, args.requests, args.concurrency),
+            }
+            for mode, r in results.items():
+                print(f"  {name:26} {mode:6}  p50 {r['p50']:8.1f}  p95 {r['p95']:8.1f}  p99 {r['p99']:8.1f} ms"
+                      f"  {r['rps']:8.1f}/s" + (f"  {r['queries']:5.1f} queries" if "queries" in r else "")
+                      + f"  {r['statuses']}")
+    finally:
+        server.shutdown()
+
+    if not args.only or "reminder job" in args.only:
+        r = run_reminder_job(appmodule, app, counter, args.job_runs)
+        run["routes"]["reminder job"] = {"client": r}
+        print(f"  {'reminder job':26} {'client':6}  p50 {r['p50']:8.1f}  p95 {r['p95']:8.1f} ms"
+              f"  {r['reminders']} reminders  {r['queries']:5.1f} queries")
+
+    # signups made by the benchmark go away again
+    with app.app_context():
+        cur = appmodule.get_db().cursor()
+        cur.execute("DELETE FROM users WHERE username LIKE 'bench\\_signup\\_%'")
+        appmodule.rebuild_stats_summary(cur)
+        cur.connection.commit()
+        appmodule.get_cache().invalidate()
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(run, f, indent=2)
+        print(f"saved {args.save}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f"compared with {args.compare} ({baseline['created_at']}, rows {baseline['rows']}):")
+        regressions = compare_runs(baseline, run, args.tolerance)
+        if regressions:
+            print("regressions:\n  " + "\n  ".join(regressions))
+            sys.exit(1)
+        print("no regressions")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    boot = sub.add_parser("boot", help="time importing and building the app")
+    boot.add_argument("--runs", type=int, default=10)
+    boot.set_defaults(func=bench_boot)
+
+    login = sub.add_parser("login", help="login latency under concurrent load")
+    login.add_argument("--requests", type=int, default=100)
+    login.add_argument("--concurrency", type=int, default=16)
+    login.add_argument("--method", help="PASSWORD_HASH_METHOD to use")
+    login.add_argument("--hash-workers", type=int, help="PASSWORD_HASH_WORKERS to use")
+    login.set_defaults(func=bench_login)
+
+    render = sub.add_parser("render", help="template load and render times")
+    render.add_argument("--renders", type=int, default=500)
+    render.set_defaults(func=bench_render)
+
+    i18n = sub.add_parser("i18n", help="translation overhead per call and per page")
+    i18n.add_argument("--calls", type=int, default=20000)
+    i18n.set_defaults(func=bench_i18n)
+
+    asgi = sub.add_parser("async", help="database-bound pages, sync vs the async mode")
+    asgi.add_argument("--requests", type=int, default=200)
+    asgi.add_argument("--concurrency", type=int, default=32)
+    asgi.set_defaults(func=bench_async)
+
+    seed = sub.add_parser("seed", help="fill the database with synthetic patients")
+    seed.add_argument("--symptoms", type=int, default=100_000, help="reports to create in total")
+    seed.add_argument("--reports", type=int, default=26, help="average reports per patient")
+    seed.add_argument("--batch-size", type=int, default=1000, help="patients per transaction")
+    seed.add_argument("--seed", type=int, default=1, help="random seed; same seed, same data")
+    seed.add_argument("--until", type=date.fromisoformat, default=date.today(),
+                      help="date the histories lead up to (YYYY-MM-DD)")
+    seed.add_argument("--reset", action="store_true", help="remove every seeded patient instead")
+    seed.set_defaults(func=bench_seed)
+
+    routes = sub.add_parser("routes", help="latency, throughput and queries of every main route")
+    routes.add_argument("--requests", type=int, default=200, help="requests per route and mode")
+    routes.add_argument("--concurrency", type=int, default=8, help="HTTP client threads")
+    routes.add_argument("--job-runs", type=int, default=3, help="reminder job runs")
+    routes.add_argument("--only", nargs="+", metavar="ROUTE", help="route names to run")
+    routes.add_argument("--no-cache", action="store_true", help="turn the dashboard/stats cache off")
+    routes.add_argument("--save", metavar="FILE", help="write the results as JSON")
+    routes.add_argument("--compare", metavar="FILE", help="compare with a saved run; exit 1 on regressions")
+    routes.add_argument("--tolerance", type=float, default=0.2, help="allowed p95 slowdown (0.2 = 20%%)")
+    routes.set_defaults(func=bench_routes)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
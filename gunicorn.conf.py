@@ -0,0 +1,19 @@
+# gunicorn.conf.py
+# gunicorn picks this file up automatically: `gunicorn app:app`
+import gc
+import os
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:" + os.environ.get("PORT", "8000"))
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+
+# import the app once in the master and fork workers from it. Safe because
+# create_app() opens no connections and starts no threads; each worker builds
+# its own pool and scheduler on its first request.
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") == "1"
+
+
+def pre_fork(server, worker):
+    # move everything imported so far out of the collector's reach, so the
+    # first collection in a worker doesn't touch (and copy) the parent's pages
+    gc.freeze()